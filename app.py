@@ -1,17 +1,34 @@
-from bot_config import API_BASE_URL, validate_env_variables
-from gh_oauth_token import get_token, store_token
-from webhook_handlers import check_suite_request_handler, check_suite_override_handler
+from async_engine import async_engine_enabled, get_async_engine, peek_async_engine
+from bot_config import (API_BASE_URL, ASYNC_MAX_SUITES, JOB_QUEUE_MAX_SIZE, SHARED_QUEUE_DB,
+                        validate_env_variables)
+from gh_oauth_token import get_token, store_token, token_status
+from check_executor import get_check_executor, peek_check_executor
+from durations import duration_stats
+from events import is_handled, parse_event
+from etag_cache import response_cache
+from idempotency import webhook_deduplicator
+from rate_limiter import rate_limiter
+from result_cache import result_cache
+from shared_queue import get_shared_queue
+from job_queue import QueueFullError, get_job_queue, peek_job_queue
+from metrics import CONTENT_TYPE, WEBHOOK_LATENCY, metrics
+from page_cache import page_cache
+from state_store import state_store
+from suite_registry import suite_registry
+from webhook_handlers import check_suite_request_handler, check_suite_override_handler, resume_unfinished_suites
 
+import functools
 import json
 import logging
+import os
 import requests
 import sys
 import datetime
+import time
 import traceback
 import markdown2
 
-from flask import Flask, request, redirect, render_template
-from objectify_json import ObjectifyJSON
+from flask import Flask, g, jsonify, request, redirect, render_template
 
 log = logging.getLogger(__name__)
 
@@ -26,10 +43,59 @@ These pages basically just show static HTML
 """
 
 
+_README_PATH = "./README.md"
+_WELCOME_FILES = (_README_PATH, os.path.join(app.root_path, "templates", "index.html"),
+                  os.path.join(app.root_path, "templates", "base.html"))
+
+
 @app.route("/")
 def welcome():
-    """Welcome page"""
-    return render_template("index.html", readme_html=markdown2.markdown_path("./README.md"))
+    """Welcome page, rendered once and served from memory until README.md or its templates change."""
+    page = page_cache.get("welcome", _WELCOME_FILES,
+                          lambda: render_template("index.html", readme_html=markdown2.markdown_path(_README_PATH)))
+
+    response = app.response_class(page.body, mimetype="text/html")
+    response.set_etag(page.etag)
+    response.headers["Last-Modified"] = page.last_modified
+    return response.make_conditional(request)
+
+
+def queue_status() -> dict:
+    """Depth and capacity of whatever queues suites in this process' execution mode. Nothing is started:
+    a local queue or engine that hasn't been used yet is simply empty.
+    """
+    shared = get_shared_queue()
+    if shared is not None:
+        return {"mode": "shared", "depth": shared.stats()["queued"], "max_size": shared.max_size}
+
+    if async_engine_enabled():
+        engine = peek_async_engine()
+        return {"mode": "asyncio",
+                "depth": engine.suites if engine else 0,
+                "max_size": engine.max_suites if engine else ASYNC_MAX_SUITES,
+                }
+
+    job_queue = peek_job_queue()
+    return {"mode": "threads",
+            "depth": job_queue.depth() if job_queue else 0,
+            "max_size": job_queue.max_size if job_queue else JOB_QUEUE_MAX_SIZE,
+            }
+
+
+@app.route("/healthz", methods=["GET"])
+def health():
+    """Liveness and readiness for probes, without rendering anything: 503 when the suite queue is full or the
+    installation token has expired (no token yet is fine, the app may not be installed).
+    """
+    queue = queue_status()
+    token = token_status()
+
+    ready = queue["depth"] < queue["max_size"] and (token is None or token["seconds_left"] > 0)
+    body = {"status": "ok" if ready else "unavailable",
+            "queue": queue,
+            "token": token,
+            }
+    return jsonify(body), 200 if ready else 503
 
 
 """
@@ -57,7 +123,22 @@ def authenticate(app_id):
     return redirect("https://www.github.com", code=302)
 
 
+def timed_webhook(handler):
+    """Record the handling time of each delivery, by event and by the action the handler saved in `g.action`."""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            WEBHOOK_LATENCY.labels(request.headers.get('X-Github-Event', ""), g.get("action", "")) \
+                .observe(time.perf_counter() - started)
+
+    return wrapper
+
+
 @app.route("/webhook", methods=["POST"])
+@timed_webhook
 def process_message():
     """
     WEBHOOK RECEIVER
@@ -74,30 +155,103 @@ def process_message():
     - Is your webhook forwarding tool (i.e., pysmee or smee-client) running?
     - Is github SENDING webhooks to the same https://smee.io URL you"re RECEIVING from?
 
+    Add `?force_rerun=1` to the URL to ignore cached validation results.
+
     """
-    webhook = ObjectifyJSON(request.json)
-    event = request.headers['X-Github-Event']
-    action = str(webhook.action).lower()
-
-    if event == "pull_request" and (action == "opened" or action == "updated"):
-        log.info("Check suite requested.")
-        check_suite_request_handler(webhook)
-    elif event == "check_suite" and action == "rerequested":
-        log.info("Check suite re-requested.")
-        check_suite_request_handler(webhook)
-    elif event == "check_run" and action == "created":
-        log.info(f"Check run {webhook.check_run.name} create confirmed.")
-    elif event == "issue_comment" and action == "created":
-        log.info(f"Comment posted")
-        check_suite_override_handler(webhook)
-    else:
-        log.info(f"Ignore webhook event {event} action {action}")
+    event_type = request.headers.get('X-Github-Event', "")
+    delivery_id = request.headers.get('X-Github-Delivery')
+
+    # Route on the headers; events we don't handle are never parsed.
+    if not is_handled(event_type):
+        log.info(f"Ignore webhook event {event_type}")
+        return "GOOD"
+
+    if webhook_deduplicator.is_duplicate_delivery(delivery_id):
+        log.info(f"Ignore redelivered webhook {delivery_id}")
+        return "DUPLICATE"
+
+    event = parse_event(event_type, request.get_data())
+    if event is None:
+        log.info(f"Ignore webhook event {event_type}")
+        return "GOOD"
+    g.action = event.action
+
+    force_rerun = request.args.get("force_rerun", "").lower() in ("1", "true", "yes")
+
+    # Anything that needs GitHub round-trips is queued; the delivery is acknowledged with a 202.
+    try:
+        if event_type == "pull_request":
+            log.info("Check suite requested.")
+            check_suite_request_handler(event, force_rerun)
+            return "ACCEPTED", 202
+        elif event_type == "check_suite":
+            log.info("Check suite re-requested.")
+            check_suite_request_handler(event, force_rerun)
+            return "ACCEPTED", 202
+        elif event_type == "check_run":
+            log.info(f"Check run {event.name} create confirmed.")
+        elif event_type == "issue_comment":
+            log.info(f"Comment posted")
+            check_suite_override_handler(event)
+            return "ACCEPTED", 202
+
+    except QueueFullError as exc:
+        log.warning(f"Rejecting webhook event {event_type} action {event.action}: {exc}")
+        webhook_deduplicator.forget_delivery(delivery_id)
+        return "BUSY", 503, {"Retry-After": "10"}
 
     return "GOOD"
 
 
+@app.route("/jobs", methods=["GET"])
+def job_stats():
+    """Queue depth, age of the oldest waiting job, worker counters, cache hit rates, validation run times
+    and GitHub rate limit budgets.
+    """
+    return jsonify(suites=get_job_queue().stats(),
+                   checks=get_check_executor().stats(),
+                   dedup=webhook_deduplicator.stats(),
+                   results=result_cache.stats(),
+                   responses=response_cache.stats(),
+                   pages=page_cache.stats(),
+                   durations=duration_stats.snapshot(),
+                   rate_limits=rate_limiter.stats(),
+                   state=state_store.stats(),
+                   shared_queue=get_shared_queue().stats() if SHARED_QUEUE_DB else None,
+                   engine=get_async_engine().stats() if async_engine_enabled() else None,
+                   )
+
+
+"""
+METRICS
+========
+Prometheus text format. The latency histograms and counters are recorded where
+the work happens (see `metrics`); the gauges below are read at scrape time.
+"""
+
+metrics.gauge("esp_suites_in_flight", "Check suites currently running.", lambda: suite_registry.stats()["in_flight"])
+metrics.gauge("esp_suites_queued", "Check suites waiting to run (job queue, shared queue or asyncio engine).",
+              lambda: queue_status()["depth"])
+def checks_queued() -> int:
+    """Validations waiting for a check executor worker; 0 while the executor isn't running (e.g. in the web
+    process of the shared queue mode, or with the asyncio engine), which isn't started just to be measured.
+    """
+    executor = peek_check_executor()
+    return executor.stats()["queued"] if executor else 0
+
+
+metrics.gauge("esp_checks_queued", "Validations waiting for a check executor worker.", checks_queued)
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return app.response_class(metrics.render(), content_type=CONTENT_TYPE)
+
+
 if __name__ == "app" or __name__ == "__main__":
     print(
         f"\n\033[96m\033[1m--- STARTING THE APP: [{datetime.datetime.now().strftime('%m/%d, %H:%M:%S')}] ---\033[0m \n")
     validate_env_variables()
+    if not SHARED_QUEUE_DB:
+        resume_unfinished_suites()  # worker.py does it in multi-process mode
     app.run()
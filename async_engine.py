@@ -0,0 +1,343 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from bot_config import (
+    ASYNC_MAX_CHECKS,
+    ASYNC_MAX_SUITES,
+    CHANGE_AWARE_PLANNING,
+    CHECK_RUN_UPDATE_DEBOUNCE,
+    EXECUTION_ENGINE,
+    REVIEW_FLUSH_DEADLINE,
+)
+from checks import Check, ProcessCheckRun
+from constances import APP_NAME, CHECK_RUN_STATUS_COMPLETED, CHECK_RUN_STATUS_IN_PROGRESS, CHECK_RUN_TITLE, \
+    CHECK_STATUS_CANCELLED, CHECK_STATUS_FAILURE
+from durations import duration_stats
+from events import SuiteEvent
+from gh_async import (
+    aiohttp,
+    get_async_github_client,
+    get_pull_request_files_async,
+    post_check_run_annotations_async,
+    post_check_run_result_async,
+    post_pull_request_review_async,
+    update_check_run_async,
+)
+from job_queue import QueueFullError
+from metrics import CHECK_QUEUE_WAIT
+from state_store import state_store
+
+log = logging.getLogger(__name__)
+
+"""
+ASYNCIO ENGINE
+===============
+With EXECUTION_ENGINE=asyncio (and aiohttp installed), suites run as coroutines
+on one background event loop thread instead of job queue and check executor
+threads. Waiting on validations and on GitHub then costs a coroutine rather than
+a thread, so thousands of checks can be in flight at once. The limits are
+explicit: ASYNC_MAX_SUITES suites (beyond that the webhook gets a 503, as with a
+full job queue), ASYNC_MAX_CHECKS running checks and ASYNC_MAX_GITHUB_CALLS
+GitHub calls.
+
+`AsyncProcessCheckRun` reuses the planning, progress and summary logic of
+`ProcessCheckRun`; only the waiting and the GitHub calls differ. The threads
+engine stays the default.
+"""
+
+
+_enabled = EXECUTION_ENGINE == "asyncio" and aiohttp is not None
+if EXECUTION_ENGINE == "asyncio" and aiohttp is None:
+    log.warning("EXECUTION_ENGINE=asyncio needs aiohttp (requirements-async.txt), falling back to threads.")
+
+
+def async_engine_enabled() -> bool:
+    return _enabled
+
+
+class AsyncEngine:
+    def __init__(self, max_suites: int = ASYNC_MAX_SUITES, max_checks: int = ASYNC_MAX_CHECKS):
+        self.max_suites = max_suites
+        self.max_checks = max_checks
+
+        self.loop = asyncio.new_event_loop()
+        self.check_slots: Optional[asyncio.Semaphore] = None
+        self._thread = threading.Thread(target=self._run, name="async-engine", daemon=True)
+        self._ready = threading.Event()
+
+        self._lock = threading.Lock()
+        self.suites = 0
+        self.running_checks = 0
+        self.completed_suites = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        self._thread.start()
+        self._ready.wait()
+        log.info(f"Started the asyncio engine (max {self.max_suites} suites, {self.max_checks} checks).")
+
+    def submit_suite(self, suite: "AsyncProcessCheckRun") -> None:
+        """Run the suite on the event loop. Raises `QueueFullError` when ASYNC_MAX_SUITES are in flight."""
+        with self._lock:
+            if self.suites >= self.max_suites:
+                self.rejected += 1
+                raise QueueFullError(f"asyncio engine is full ({self.max_suites} suites).")
+            self.suites += 1
+
+        self.submit(self._run_suite(suite))
+
+    def submit(self, coroutine: Awaitable[Any]) -> Future:
+        """Schedule a coroutine from any thread."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call_soon(self, callback: Callable[..., Any], *args: Any) -> None:
+        """Run a callback on the event loop, from any thread."""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def shutdown(self, timeout: float = 10) -> None:
+        """Let the coroutines in flight (suites, their last check run updates) finish for up to `timeout` seconds,
+        then close the GitHub session and stop the loop.
+        """
+        if self._thread.is_alive():
+            try:
+                self.submit(self._drain(timeout)).result(timeout=timeout + 5)
+            finally:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"suites": self.suites,
+                "max_suites": self.max_suites,
+                "running_checks": self.running_checks,
+                "max_checks": self.max_checks,
+                "completed_suites": self.completed_suites,
+                "rejected": self.rejected,
+                "github": get_async_github_client().stats(),
+                }
+
+    async def _run_suite(self, suite: "AsyncProcessCheckRun") -> None:
+        try:
+            await suite.run()
+        except Exception as exc:
+            log.exception(f"Suite {suite.head_sha} crashed.")
+            suite.finish_suite(exc)
+        finally:
+            with self._lock:
+                self.suites -= 1
+                self.completed_suites += 1
+
+    async def _drain(self, timeout: float) -> None:
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            log.info(f"Waiting for {len(tasks)} coroutine(s) to finish.")
+            await asyncio.wait(tasks, timeout=timeout)
+        await get_async_github_client().close()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.check_slots = asyncio.Semaphore(self.max_checks)
+        self._ready.set()
+        self.loop.run_forever()
+
+
+class AsyncProcessCheckRun(ProcessCheckRun):
+    """`ProcessCheckRun` as a coroutine. `cancel`, `update_check_results` and `flush_review` may still be called
+    from any thread; they hand the work over to the event loop.
+    """
+    __slots__ = ("_engine", "_cancelled_async", "_update_handle", "_async_send_lock")
+
+    def __init__(self, event: SuiteEvent, force_rerun: bool = False, engine: Optional[AsyncEngine] = None):
+        super().__init__(event, force_rerun=force_rerun)
+        self._engine = engine or get_async_engine()
+
+        # Created on the event loop.
+        self._cancelled_async: Optional[asyncio.Event] = None
+        self._update_handle: Optional[asyncio.TimerHandle] = None
+        self._async_send_lock: Optional[asyncio.Lock] = None
+
+    async def run(self) -> None:
+        self._cancelled_async = asyncio.Event()
+        if self.cancelled:
+            log.info(f"Suite {self.head_sha} was superseded before it started.")
+            return
+
+        files = await get_pull_request_files_async(self.base_url, self.pull_number,
+                                                   installation_id=self.installation_id) \
+            if CHANGE_AWARE_PLANNING else None
+        self.plan_checks(files)
+
+        if self.check_run_id is None:
+            self.check_run_id = await post_check_run_result_async(name=APP_NAME,
+                                                                  head_sha=self.head_sha,
+                                                                  base_url=self.base_url,
+                                                                  check_status=CHECK_RUN_STATUS_IN_PROGRESS,
+                                                                  output_title=CHECK_RUN_TITLE,
+                                                                  output_summary=self.generate_output_summary(),
+                                                                  installation_id=self.installation_id,
+                                                                  )
+            state_store.save_suite(self, CHECK_RUN_STATUS_IN_PROGRESS)
+        else:
+            # SQLite reads, off the event loop.
+            await asyncio.get_running_loop().run_in_executor(None, self.restore_finished_checks)
+
+        runnable = self.runnable_checks()
+        if not runnable:
+            await self.send_check_results_async()
+            return
+
+        # Longest expected first, so that the slowest checks get the free slots when the engine is saturated.
+        runnable.sort(key=lambda check: duration_stats.expected(check.name), reverse=True)
+        await asyncio.gather(*(self.run_check_async(check) for check in runnable))
+
+    async def run_check_async(self, check: Check) -> None:
+        queued_at = time.monotonic()
+        async with self._engine.check_slots:
+            CHECK_QUEUE_WAIT.labels(check.name).observe(time.monotonic() - queued_at)
+            self._engine.running_checks += 1
+            try:
+                if self.cancelled:
+                    check.status = CHECK_STATUS_CANCELLED
+                    return
+
+                # The result cache may read and commit SQLite (RESULT_CACHE_DB), off the event loop.
+                loop = asyncio.get_running_loop()
+                if await loop.run_in_executor(None, self.cached_result, check):
+                    return
+
+                check.started_at = time.monotonic()
+                await check.process_check_async(self._cancelled_async)
+                await loop.run_in_executor(None, self.record_result, check)
+            except Exception:
+                log.exception(f"Check {check.name} crashed.")
+                check.status = CHECK_STATUS_FAILURE
+            finally:
+                self._engine.running_checks -= 1
+                self.on_check_done(check)
+
+    def cancel(self) -> None:
+        if not self.cancelled:
+            self._engine.call_soon(self._wake_cancelled)
+        super().cancel()
+
+    def close_superseded(self) -> None:
+        """The update is already handed over to the event loop."""
+        self.update_check_results()
+
+    def _wake_cancelled(self) -> None:
+        if self._cancelled_async is not None:
+            self._cancelled_async.set()
+
+    def update_check_results(self) -> None:
+        """Same debounce as `ProcessCheckRun.update_check_results`, with a loop timer instead of a thread."""
+        self._engine.call_soon(self._schedule_update)
+
+    def _schedule_update(self) -> None:
+        _, status = self.determine_check_run_progress()
+
+        if status == CHECK_RUN_STATUS_COMPLETED:
+            if self._update_handle is not None:
+                self._update_handle.cancel()
+                self._update_handle = None
+
+        elif CHECK_RUN_UPDATE_DEBOUNCE > 0:
+            if self._update_handle is None:
+                self._update_handle = self._engine.loop.call_later(CHECK_RUN_UPDATE_DEBOUNCE, self._flush_update)
+            return
+
+        asyncio.ensure_future(self.send_check_results_async())
+
+    def _flush_update(self) -> None:
+        self._update_handle = None
+        asyncio.ensure_future(self.send_check_results_async())
+
+    async def send_check_results_async(self) -> None:
+        if self._async_send_lock is None:
+            self._async_send_lock = asyncio.Lock()
+
+        async with self._async_send_lock:
+            with self._send_lock:
+                update = self.next_update()
+            if update is None:
+                return
+
+            status, conclusion, title, summary, priority = update
+            if self.check_run_id is None:
+                self.check_run_id = await post_check_run_result_async(name=APP_NAME,
+                                                                      head_sha=self.head_sha,
+                                                                      base_url=self.base_url,
+                                                                      check_status=status,
+                                                                      check_conclusion=conclusion,
+                                                                      output_title=title,
+                                                                      output_summary=summary,
+                                                                      priority=priority,
+                                                                      installation_id=self.installation_id,
+                                                                      )
+                written = self.check_run_id is not None
+            else:
+                written = await update_check_run_async(base_url=self.base_url,
+                                                       check_run_id=self.check_run_id,
+                                                       check_status=status,
+                                                       check_conclusion=conclusion,
+                                                       output_title=title,
+                                                       output_summary=summary,
+                                                       priority=priority,
+                                                       installation_id=self.installation_id,
+                                                       )
+            with self._send_lock:
+                self.record_update(status, conclusion, summary, written)
+
+        if status == CHECK_RUN_STATUS_COMPLETED and written:
+            annotations = self.completed_annotations()
+            if annotations:
+                await post_check_run_annotations_async(self.base_url, self.check_run_id, status, conclusion, title,
+                                                       summary, annotations, installation_id=self.installation_id)
+            await self.flush_review_async()
+
+    def retry_update(self, delay: float) -> None:
+        self._engine.loop.call_later(delay, lambda: asyncio.ensure_future(self.send_check_results_async()))
+
+    def add_review_failure(self, check: Check) -> None:
+        """Same REVIEW_FLUSH_DEADLINE as the threads engine, with a loop timer instead of a thread per suite."""
+        with self._review_lock:
+            self._review_failures.append(check)
+            if self._review_timer is None and REVIEW_FLUSH_DEADLINE > 0:
+                self._review_timer = self._engine.loop.call_later(REVIEW_FLUSH_DEADLINE, self.flush_review)
+
+    def flush_review(self) -> None:
+        self._engine.submit(self.flush_review_async())
+
+    async def flush_review_async(self) -> None:
+        review = self.take_review()
+        if review:
+            await post_pull_request_review_async(self.base_url, self.pull_number, body=review[0], comments=review[1],
+                                                 commit_id=self.head_sha, installation_id=self.installation_id)
+
+
+_engine: Optional[AsyncEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_async_engine() -> AsyncEngine:
+    """Return the process-wide engine, starting its event loop thread on first use."""
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = AsyncEngine()
+                engine.start()
+                atexit.register(engine.shutdown)
+                _engine = engine
+
+    return _engine
+
+
+def peek_async_engine() -> Optional[AsyncEngine]:
+    """Return the engine if it is running, without starting its event loop thread."""
+    return _engine
@@ -0,0 +1,89 @@
+"""
+GITHUB CLIENT BENCHMARK
+========================
+Compares per-call `requests.get` (a new connection every time, like the old
+`make_github_rest_api_call`) with the pooled `GitHubClient`, against a local
+keep-alive HTTP server standing in for api.github.com.
+
+    python benchmarks/bench_gh_client.py --requests 2000 --threads 8
+
+Run it from the repository root so `gh_client` and `bot_config` can be imported.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gh_client import GitHubClient  # noqa: E402
+
+_BODY = json.dumps({"head": {"sha": "0" * 40}}).encode()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections open between requests
+    disable_nagle_algorithm = True
+
+    def _reply(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(_BODY)))
+        self.end_headers()
+        self.wfile.write(_BODY)
+
+    do_GET = do_POST = do_PATCH = _reply
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def _start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _run(label: str, call, url: str, total: int, threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for response in pool.map(lambda _: call(url), range(total)):
+            response.raise_for_status()
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed
+    print(f"{label:<28} {total:>6} requests in {elapsed:6.2f}s  {rate:9.1f} req/s")
+    return rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    server = _start_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/repos/org/repo/pulls/1"
+    client = GitHubClient(pool_maxsize=args.threads)
+
+    before = _run("requests.get (no session)", lambda u: requests.get(u, headers={"Accept": "application/json"}),
+                  url, args.requests, args.threads)
+    after = _run("GitHubClient (pooled)", lambda u: client.request("GET", u), url, args.requests, args.threads)
+    print(f"speed-up: {after / before:.2f}x")
+
+    client.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+LOAD BENCHMARK
+===============
+Runs the bot (`flask run`, in a child process) against the fake GitHub API of
+`fake_github.py`, replays webhooks to its /webhook route at a target rate and
+reports:
+- webhook ack latency (p50/p99/max) and the status codes returned;
+- suite completion time, from the delivery to the check run being completed
+  on the fake API (p50/p99/max);
+- GitHub calls per suite, by endpoint;
+- peak RSS of the bot process.
+
+    python benchmarks/bench_load.py --suites 500 --rate 50 --output results.json
+    EXECUTION_ENGINE=asyncio python benchmarks/bench_load.py --suites 2000 --rate 200
+
+The validations run on a virtual clock: VALIDATION_TIME_SCALE (--time-scale)
+shrinks their simulated run times, so a 300s validation takes 3s by default.
+Pushes are spread over --prs pull requests, so later commits supersede earlier
+ones; --rerequest-share and --override-share mix in check_suite re-requests and
+ESPOVERRIDE comments. With --payloads, recorded `<event>*.json` deliveries are
+replayed instead, their api.github.com URLs pointed at the fake API.
+
+The bot inherits the environment, so any of its settings (EXECUTION_ENGINE,
+JOB_QUEUE_WORKERS, ...) can be compared between runs. Results are JSON, so that
+two runs can be diffed.
+"""
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+import requests
+
+_BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+_REPOSITORY_ROOT = os.path.dirname(_BENCHMARKS)
+sys.path.insert(0, _BENCHMARKS)
+
+from fake_github import FakeGitHub, add_arguments, from_arguments, start_fake_github  # noqa: E402
+
+_REPOSITORY = "org/repo"
+_INSTALLATION_ID = "1"
+_OVERRIDE_STRING = "ESPOVERRIDE"  # constances.ESP_OVERRIDE_STRING
+
+# Settings of the bot worth recording with the results.
+_BOT_SETTING_PREFIXES = ("EXECUTION_", "ASYNC_", "JOB_QUEUE_", "CHECK_", "GH_HTTP_", "RATE_LIMIT_", "SHARED_QUEUE_",
+                         "SUITE_STATE_", "RESULT_CACHE_", "CHANGE_AWARE_", "DEDUP_")
+
+# Gauges of the bot's /metrics that are all 0 once it has nothing left to do.
+_BUSY_GAUGES = ("esp_suites_in_flight", "esp_suites_queued", "esp_checks_queued")
+
+
+class Delivery:
+    __slots__ = ("event", "body", "pull_number", "head_sha", "sent_at", "ack_seconds", "status")
+
+    def __init__(self, event: str, body: bytes, pull_number: Optional[int] = None, head_sha: Optional[str] = None):
+        self.event = event
+        self.body = body
+        self.pull_number = pull_number
+        self.head_sha = head_sha
+        self.sent_at: Optional[float] = None
+        self.ack_seconds: Optional[float] = None
+        self.status: Optional[int] = None
+
+
+def _sha(*parts: Any) -> str:
+    return hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+
+
+def _generated_deliveries(args: argparse.Namespace, api_url: str) -> List[Delivery]:
+    rng = random.Random(args.seed)
+    repository = {"url": f"{api_url}/repos/{_REPOSITORY}", "full_name": _REPOSITORY}
+    installation = {"id": int(_INSTALLATION_ID)}
+    deliveries, rerequests = [], []
+
+    for i in range(args.suites):
+        number, revision = i % args.prs + 1, i // args.prs
+        sha = _sha(number, revision)
+        pull = {"number": number, "head": {"sha": sha, "ref": f"branch-{number}"}}
+        # Later pushes are delivered as "synchronize", like GitHub does.
+        body = {"action": "opened" if revision == 0 else "synchronize", "number": number,
+                "pull_request": pull, "repository": repository, "installation": installation}
+        deliveries.append(Delivery("pull_request", json.dumps(body).encode(), number, sha))
+
+        # Re-requests are for the PR's last commit, sent once it got its results, like a user retrying a flaky run.
+        if rng.random() < args.rerequest_share and i + args.prs >= args.suites:
+            suite = {"head_sha": sha, "pull_requests": [{"number": number}], "head_commit": {"tree_id": _sha("tree", sha)}}
+            body = {"action": "rerequested", "check_suite": suite, "repository": repository,
+                    "installation": installation}
+            rerequests.append(Delivery("check_suite", json.dumps(body).encode(), number, sha))
+
+        if rng.random() < args.override_share:
+            issue = {"number": number, "repository_url": repository["url"],
+                     "pull_request": {"url": f"{repository['url']}/pulls/{number}"}}
+            # Second precision, as GitHub sends it (and as the bot parses it for the override latency).
+            comment = {"body": f"{_OVERRIDE_STRING}\nflaky",
+                       "created_at": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
+            body = {"action": "created", "issue": issue, "comment": comment, "repository": repository,
+                    "installation": installation}
+            deliveries.append(Delivery("issue_comment", json.dumps(body).encode(), number))
+
+    return deliveries + rerequests
+
+
+def _recorded_deliveries(directory: str, api_url: str) -> List[Delivery]:
+    deliveries = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        event = os.path.basename(path).rsplit(".", 1)[0].rstrip("-_0123456789")
+        with open(path, "rb") as f:
+            body = f.read().replace(b"https://api.github.com", api_url.encode())
+
+        payload = json.loads(body)
+        number = (payload.get("pull_request") or payload.get("issue") or {}).get("number")
+        sha = (payload.get("pull_request") or {}).get("head", {}).get("sha") \
+            or (payload.get("check_suite") or {}).get("head_sha")
+        deliveries.append(Delivery(event, body, number, sha))
+    return deliveries
+
+
+def _start_bot(api_url: str, workdir: str, port: int, time_scale: float) -> subprocess.Popen:
+    """`flask run` with the app of this repository, with its private/ files in `workdir`."""
+    env = dict(os.environ,
+               FLASK_APP=os.path.join(_REPOSITORY_ROOT, "app.py"),
+               API_BASE_URL=api_url,
+               GH_APP_ID="1",
+               GH_TOKEN_PERSIST="0",
+               VALIDATION_TIME_SCALE=str(time_scale),
+               PYTHONUNBUFFERED="1")
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    return subprocess.Popen([sys.executable, "-m", "flask", "run", "--port", str(port), "--no-reload"],
+                            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def _write_private_key(workdir: str) -> None:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    os.makedirs(os.path.join(workdir, "private"), exist_ok=True)
+    with open(os.path.join(workdir, "private", "gh-app.key"), "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+
+
+def _wait_until_up(bot_url: str, bot: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if bot.poll() is not None:
+            sys.exit(f"The bot exited with {bot.returncode}, see its log.")
+        try:
+            requests.get(f"{bot_url}/jobs", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    sys.exit("The bot didn't start in time.")
+
+
+def _replay(bot_url: str, github: FakeGitHub, deliveries: Sequence[Delivery], rate: float, concurrency: int,
+            first_id: int = 0) -> float:
+    """Send the deliveries at `rate` per second (open loop: a slow ack doesn't hold back the next delivery).
+    Their delivery ids are numbered from `first_id`.
+    """
+    local = threading.local()
+
+    def send(index: int, delivery: Delivery) -> None:
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+
+        if delivery.event == "pull_request" and delivery.pull_number:
+            github.set_pull_head(_REPOSITORY, delivery.pull_number, delivery.head_sha)
+
+        headers = {"X-Github-Event": delivery.event, "X-Github-Delivery": f"bench-{first_id + index}",
+                   "Content-Type": "application/json"}
+        delivery.sent_at = time.time()
+        started = time.perf_counter()
+        try:
+            delivery.status = session.post(f"{bot_url}/webhook", data=delivery.body, headers=headers, timeout=30) \
+                .status_code
+        except requests.RequestException:
+            delivery.status = 0
+        delivery.ack_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, delivery in enumerate(deliveries):
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, index, delivery)
+    return time.perf_counter() - started
+
+
+def _wait_for_suites(bot_url: str, github: FakeGitHub, shas: Sequence[str], timeout: float) -> None:
+    """Until every suite has completed its check run, or the bot is idle: a suite superseded before it started
+    never creates one. Without `shas`, until the bot is idle.
+    """
+    deadline = time.monotonic() + timeout
+    idle_polls = 0
+    while time.monotonic() < deadline and not (shas and all(sha in github.completed_at for sha in shas)):
+        time.sleep(0.5)
+        idle_polls = idle_polls + 1 if _bot_is_idle(bot_url) else 0
+        if idle_polls >= 3:
+            return
+
+
+def _bot_is_idle(bot_url: str) -> bool:
+    try:
+        text = requests.get(f"{bot_url}/metrics", timeout=5).text
+    except requests.RequestException:
+        return False
+
+    gauges = dict(line.split(" ", 1) for line in text.splitlines() if line.startswith(_BUSY_GAUGES))
+    return len(gauges) == len(_BUSY_GAUGES) and all(float(value) == 0 for value in gauges.values())
+
+
+def _percentiles(values: Sequence[float], scale: float = 1) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def at(q: float) -> float:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * scale, 3)
+
+    return {"p50": at(0.5), "p99": at(0.99), "max": round(ordered[-1] * scale, 3)}
+
+
+def _peak_rss_mb(bot: subprocess.Popen) -> float:
+    """Peak RSS of the bot, read once it has exited (ru_maxrss is in KB on Linux, in bytes on macOS)."""
+    bot.send_signal(signal.SIGINT)
+    try:
+        bot.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        bot.kill()
+        bot.wait()
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", type=int, default=200, help="number of pushes (pull_request deliveries)")
+    parser.add_argument("--prs", type=int, default=50, help="pull requests the pushes are spread over")
+    parser.add_argument("--rate", type=float, default=20, help="deliveries per second")
+    parser.add_argument("--concurrency", type=int, default=32, help="deliveries in flight at most")
+    parser.add_argument("--rerequest-share", type=float, default=0.05)
+    parser.add_argument("--override-share", type=float, default=0.05)
+    parser.add_argument("--payloads", help="directory of recorded deliveries to replay instead")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="VALIDATION_TIME_SCALE of the bot")
+    parser.add_argument("--port", type=int, default=5055, help="port of the bot")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the suites to complete")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    github = from_arguments(args)
+    server = start_fake_github(github)
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+    bot_url = f"http://127.0.0.1:{args.port}"
+
+    deliveries = _recorded_deliveries(args.payloads, api_url) if args.payloads \
+        else _generated_deliveries(args, api_url)
+    if not deliveries:
+        sys.exit(f"No payloads found in {args.payloads}")
+
+    with tempfile.TemporaryDirectory(prefix="esp-bench-") as workdir:
+        _write_private_key(workdir)
+        bot = _start_bot(api_url, workdir, args.port, args.time_scale)
+        try:
+            _wait_until_up(bot_url, bot)
+            requests.get(f"{bot_url}/authenticate/1", params={"installation_id": _INSTALLATION_ID},
+                         allow_redirects=False, timeout=10)
+
+            # Generated re-requests go out once the pushes' suites are done, so that they can reuse their results.
+            rerequests = [] if args.payloads else [d for d in deliveries if d.event == "check_suite"]
+            pushes = [d for d in deliveries if d.event != "check_suite"] if rerequests else deliveries
+
+            print(f"Replaying {len(pushes)} deliveries at {args.rate}/s ...")
+            replay_seconds = _replay(bot_url, github, pushes, args.rate, args.concurrency)
+
+            first_sent: Dict[str, float] = {}
+            for delivery in pushes:
+                if delivery.head_sha and delivery.status == 202:
+                    first_sent.setdefault(delivery.head_sha, delivery.sent_at)
+            print(f"Waiting for {len(first_sent)} suites to complete ...")
+            _wait_for_suites(bot_url, github, list(first_sent), args.timeout)
+
+            if rerequests:
+                print(f"Replaying {len(rerequests)} re-requests ...")
+                replay_seconds += _replay(bot_url, github, rerequests, args.rate, args.concurrency, len(pushes))
+                _wait_for_suites(bot_url, github, (), args.timeout)
+            service = requests.get(f"{bot_url}/jobs", timeout=10).json()
+        finally:
+            peak_rss = _peak_rss_mb(bot)
+            server.shutdown()
+
+    report = _report(args, deliveries, first_sent, github, replay_seconds, peak_rss, service)
+    print(json.dumps({key: report[key] for key in ("webhooks", "suites", "github", "peak_rss_mb")}, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved to {args.output}")
+
+
+def _report(args: argparse.Namespace, deliveries: Sequence[Delivery], first_sent: Dict[str, float],
+            github: FakeGitHub, replay_seconds: float, peak_rss: float, service: Dict[str, Any]) -> Dict[str, Any]:
+    completion = [github.completed_at[sha] - sent_at for sha, sent_at in first_sent.items()
+                  if sha in github.completed_at]
+    stats = github.stats()
+    by_route = stats["by_route"]
+    suite_calls = sum(count for route, count in by_route.items() if not route.endswith("access_token"))
+    suites = max(len(first_sent), 1)
+
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "args": vars(args),
+            "environment": {name: value for name, value in os.environ.items()
+                            if name.isupper() and name.startswith(_BOT_SETTING_PREFIXES)},
+            "webhooks": {"sent": len(deliveries),
+                         "achieved_rate": round(len(deliveries) / replay_seconds, 1),
+                         "statuses": dict(Counter(str(delivery.status) for delivery in deliveries)),
+                         "ack_ms": _percentiles([d.ack_seconds for d in deliveries if d.ack_seconds is not None],
+                                                scale=1000),
+                         },
+            "suites": {"accepted": len(first_sent),
+                       "completed": len(completion),
+                       "without_check_run": len(first_sent) - len(completion),  # superseded before they started
+                       "conclusions": stats["conclusions"],
+                       "completion_s": _percentiles(completion),
+                       },
+            "github": {"calls": suite_calls,
+                       "calls_per_suite": round(suite_calls / suites, 2),
+                       "per_suite_by_route": {route: round(count / suites, 2) for route, count in sorted(by_route.items())},
+                       "token_requests": by_route.get("POST access_token", 0),
+                       "injected_errors": stats["injected_errors"],
+                       "rate_limited": stats["rate_limited"],
+                       "not_modified": stats["not_modified"],
+                       },
+            "peak_rss_mb": peak_rss,
+            "service": service,
+            }
+
+
+if __name__ == "__main__":
+    main()
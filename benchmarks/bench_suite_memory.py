@@ -0,0 +1,55 @@
+"""
+SUITE MEMORY BENCHMARK
+=======================
+Bytes held per in-flight check suite: a `ProcessCheckRun` with its checks
+planned, the way it sits in the suite registry while its validations run.
+
+    python benchmarks/bench_suite_memory.py --suites 1 100 1000
+
+Run it from the repository root so `checks` and `events` can be imported.
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checks import ProcessCheckRun  # noqa: E402
+from events import SuiteEvent  # noqa: E402
+
+
+def _suite(i: int) -> ProcessCheckRun:
+    event = SuiteEvent("pull_request", "opened", f"https://api.github.com/repos/org/repo{i % 50}",
+                       f"org/repo{i % 50}", f"{i:040x}", None, i)
+    suite = ProcessCheckRun(event)
+    suite.plan_checks(None)
+    return suite
+
+
+def _measure(count: int) -> float:
+    _suite(0)  # warm up the imports and interned strings
+    gc.collect()
+
+    tracemalloc.start()
+    suites = [_suite(i) for i in range(count)]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    checks = sum(len(suite.checks) for suite in suites)
+    print(f"{count:>6} suites ({checks:>6} checks)  {retained / count:9.0f} bytes/suite")
+    return retained / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", type=int, nargs="+", default=[1, 100, 1000])
+    args = parser.parse_args()
+
+    for count in args.suites:
+        _measure(count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+WEBHOOK PARSING BENCHMARK
+==========================
+Compares wrapping the whole delivery in `ObjectifyJSON` (what the webhook
+route used to do) with `events.parse_event`, which only keeps the fields the
+bot reads. Reports the parse time and the memory still held per event.
+
+    python benchmarks/bench_webhook_parsing.py --events 2000
+    python benchmarks/bench_webhook_parsing.py --payloads path/to/recorded/deliveries
+
+Recorded deliveries are `<event>*.json` files, e.g. `pull_request-1.json`, as
+saved from the "Recent Deliveries" tab of the GitHub App. Without them,
+payloads shaped like GitHub's (same keys, similar size) are generated.
+
+Run it from the repository root so `events` and `constances` can be imported.
+"""
+import argparse
+import gc
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from events import parse_event  # noqa: E402
+
+try:
+    from objectify_json import ObjectifyJSON
+except ImportError:
+    ObjectifyJSON = None
+
+_SHA = "9f1c2b7e4d5a6f8091a2b3c4d5e6f7a8b9c0d1e2"
+
+
+def _user(login: str) -> dict:
+    return {"login": login, "id": 1234567, "node_id": "MDQ6VXNlcjEyMzQ1Njc=", "type": "User", "site_admin": False,
+            **{f"{field}_url": f"https://api.github.com/users/{login}/{field}"
+               for field in ("avatar", "gravatar", "html", "followers", "following", "gists", "starred",
+                             "subscriptions", "organizations", "repos", "events", "received_events")}}
+
+
+def _repository() -> dict:
+    url = "https://api.github.com/repos/org/repo"
+    repo = {"id": 123456789, "node_id": "MDEwOlJlcG9zaXRvcnkxMjM0NTY3ODk=", "name": "repo", "full_name": "org/repo",
+            "private": False, "owner": _user("org"), "html_url": "https://github.com/org/repo",
+            "description": "A repository " * 8, "fork": False, "url": url, "default_branch": "main",
+            "created_at": "2020-01-01T00:00:00Z", "updated_at": "2026-10-01T00:00:00Z", "size": 4321,
+            "stargazers_count": 42, "watchers_count": 42, "language": "Python", "open_issues_count": 7}
+    for field in ("forks", "keys", "collaborators", "teams", "hooks", "issue_events", "events", "assignees",
+                  "branches", "tags", "blobs", "git_tags", "git_refs", "trees", "statuses", "languages",
+                  "stargazers", "contributors", "subscribers", "subscription", "commits", "git_commits",
+                  "comments", "issue_comment", "contents", "compare", "merges", "archive", "downloads", "issues",
+                  "pulls", "milestones", "notifications", "labels", "releases", "deployments"):
+        repo[f"{field}_url"] = f"{url}/{field}"
+    return repo
+
+
+def _pull_request_payload() -> dict:
+    pull = {"url": "https://api.github.com/repos/org/repo/pulls/17", "id": 987654321, "number": 17,
+            "state": "open", "title": "Make it faster", "body": "Some description.\n" * 40, "user": _user("dev"),
+            "labels": [{"id": i, "name": f"label-{i}", "color": "ededed"} for i in range(5)],
+            "requested_reviewers": [_user(f"reviewer{i}") for i in range(3)],
+            "head": {"label": "dev:branch", "ref": "branch", "sha": _SHA, "user": _user("dev"), "repo": _repository()},
+            "base": {"label": "org:main", "ref": "main", "sha": "0" * 40, "user": _user("org"), "repo": _repository()},
+            "commits": 3, "additions": 120, "deletions": 40, "changed_files": 6}
+    return {"action": "opened", "number": 17, "pull_request": pull, "repository": _repository(),
+            "sender": _user("dev"), "installation": {"id": 1, "node_id": "MDIzOkludGVncmF0aW9uSW5zdGFsbGF0aW9uMQ=="}}
+
+
+def _check_suite_payload() -> dict:
+    suite = {"id": 5555, "head_branch": "branch", "head_sha": _SHA, "status": "completed", "conclusion": "failure",
+             "url": "https://api.github.com/repos/org/repo/check-suites/5555",
+             "pull_requests": [{"url": "https://api.github.com/repos/org/repo/pulls/17", "id": 987654321,
+                                "number": 17, "head": {"ref": "branch", "sha": _SHA},
+                                "base": {"ref": "main", "sha": "0" * 40}}],
+             "app": {"id": 1, "slug": "esp", "owner": _user("org"), "name": "ESP", "description": "x" * 200},
+             "head_commit": {"id": _SHA, "tree_id": "1" * 40, "message": "Make it faster\n" * 5,
+                             "timestamp": "2026-10-01T00:00:00Z",
+                             "author": {"name": "Dev", "email": "dev@example.com"},
+                             "committer": {"name": "Dev", "email": "dev@example.com"}}}
+    return {"action": "rerequested", "check_suite": suite, "repository": _repository(), "sender": _user("dev"),
+            "installation": {"id": 1}}
+
+
+def _issue_comment_payload(body: str) -> dict:
+    issue = {"url": "https://api.github.com/repos/org/repo/issues/17",
+             "repository_url": "https://api.github.com/repos/org/repo", "number": 17, "title": "Make it faster",
+             "user": _user("dev"), "labels": [], "state": "open", "body": "Some description.\n" * 40,
+             "pull_request": {"url": "https://api.github.com/repos/org/repo/pulls/17"}}
+    comment = {"id": 42, "user": _user("reviewer0"), "body": body, "created_at": "2026-10-01T00:00:00Z",
+               "updated_at": "2026-10-01T00:00:00Z", "author_association": "MEMBER"}
+    return {"action": "created", "issue": issue, "comment": comment, "repository": _repository(),
+            "sender": _user("reviewer0"), "installation": {"id": 1}}
+
+
+def _generated_payloads() -> List[Tuple[str, bytes]]:
+    from constances import ESP_OVERRIDE_STRING
+
+    return [("pull_request", json.dumps(_pull_request_payload()).encode()),
+            ("check_suite", json.dumps(_check_suite_payload()).encode()),
+            ("issue_comment", json.dumps(_issue_comment_payload("LGTM, thanks!")).encode()),
+            ("issue_comment", json.dumps(_issue_comment_payload(f"{ESP_OVERRIDE_STRING} flaky")).encode())]
+
+
+def _recorded_payloads(directory: str) -> List[Tuple[str, bytes]]:
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        event = os.path.basename(path).rsplit(".", 1)[0].rstrip("-_0123456789")
+        with open(path, "rb") as f:
+            payloads.append((event, f.read()))
+    return payloads
+
+
+def _objectify(event: str, body: bytes):
+    # The fields the handlers used to read from the wrapped payload.
+    webhook = ObjectifyJSON(json.loads(body))
+    if event == "issue_comment":
+        str(webhook.comment.body)
+    else:
+        str(webhook.repository.url)
+    return webhook
+
+
+def _measure(label: str, parse: Callable[[str, bytes], object], payloads: List[Tuple[str, bytes]], total: int) -> None:
+    events = [payloads[i % len(payloads)] for i in range(total)]
+
+    gc.collect()
+    start = time.perf_counter()
+    for event, body in events:
+        parse(event, body)
+    elapsed = time.perf_counter() - start
+
+    # Memory that stays alive while the parsed events wait in the job queue.
+    gc.collect()
+    tracemalloc.start()
+    kept = [parse(event, body) for event, body in events]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+
+    print(f"{label:<28} {elapsed / total * 1e6:9.1f} us/event  {retained / total:11.0f} bytes/event retained")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--payloads", help="directory of recorded deliveries")
+    args = parser.parse_args()
+
+    payloads = _recorded_payloads(args.payloads) if args.payloads else _generated_payloads()
+    if not payloads:
+        sys.exit(f"No payloads found in {args.payloads}")
+    print(f"{len(payloads)} payloads, {sum(len(body) for _, body in payloads) // len(payloads)} bytes on average")
+
+    if ObjectifyJSON is not None:
+        _measure("ObjectifyJSON(json.loads)", _objectify, payloads, args.events)
+    else:
+        print("objectify_json is not installed, skipping the baseline.")
+    _measure("events.parse_event", parse_event, payloads, args.events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+FAKE GITHUB API
+================
+A local stand-in for the parts of api.github.com the bot talks to, for load
+tests and benchmarks (see `bench_load.py`):
+
+    POST  /app/installations/{id}/access_tokens
+    POST  /repos/{owner}/{repo}/check-runs
+    PATCH /repos/{owner}/{repo}/check-runs/{id}
+    GET   /repos/{owner}/{repo}/commits/{sha}/check-runs
+    GET   /repos/{owner}/{repo}/pulls/{number}
+    GET   /repos/{owner}/{repo}/pulls/{number}/files
+    POST  /repos/{owner}/{repo}/pulls/{number}/reviews
+
+Every answer is delayed by a configurable latency, a share of them fail with a
+502, and every call counts against a rate limit quota reported in the
+X-RateLimit-* headers; once it's spent, calls get GitHub's 403. GETs carry an
+ETag and answer a matching If-None-Match with a 304, which doesn't count.
+
+The server remembers the check runs it was sent, so a benchmark can tell when
+each suite completed. It can also run on its own, to point a bot at:
+
+    python benchmarks/fake_github.py --port 8080 --latency-ms 50
+    API_BASE_URL=http://127.0.0.1:8080 flask run
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+_ROUTES = (
+    ("POST", re.compile(r"^/app/installations/(?P<installation>[^/]+)/access_tokens$"), "access_token"),
+    ("POST", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/check-runs$"), "create_check_run"),
+    ("PATCH", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/check-runs/(?P<id>\d+)$"), "update_check_run"),
+    ("GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/commits/(?P<sha>[^/]+)/check-runs$"), "list_check_runs"),
+    ("GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/pulls/(?P<number>\d+)$"), "get_pull"),
+    ("GET", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/pulls/(?P<number>\d+)/files$"), "list_pull_files"),
+    ("POST", re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/pulls/(?P<number>\d+)/reviews$"), "create_review"),
+)
+
+_EXPIRES_AT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class FakeGitHub:
+    """The state of the fake API: check runs, PR heads, counters and the knobs of the run."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: int = 5000, rate_limit_window: float = 3600, token_ttl: float = 3600,
+                 files: Tuple[str, ...] = ("README.md", "app.py"), seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.token_ttl = token_ttl
+        self.files = files
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._check_runs: Dict[int, Dict[str, Any]] = {}
+        self._runs_by_sha: Dict[str, List[int]] = {}
+        self._pull_heads: Dict[Tuple[str, int], str] = {}
+        self._next_id = 1
+
+        self.calls: Counter = Counter()  # by "METHOD route"
+        self.injected_errors = 0
+        self.rate_limited = 0
+        self.not_modified = 0
+        self.completed_at: Dict[str, float] = {}      # head SHA -> epoch seconds its check run completed
+        self.conclusions: Counter = Counter()
+
+        self._window_start = time.time()
+        self._remaining = rate_limit
+
+    def set_pull_head(self, repository: str, number: int, sha: str) -> None:
+        """What GET /pulls/{number} reports as the head commit, e.g. set by a replayer before each push."""
+        with self._lock:
+            self._pull_heads[(repository, number)] = sha
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": sum(self.calls.values()),
+                    "by_route": dict(self.calls),
+                    "injected_errors": self.injected_errors,
+                    "rate_limited": self.rate_limited,
+                    "not_modified": self.not_modified,
+                    "check_runs": len(self._check_runs),
+                    "completed_suites": len(self.completed_at),
+                    "conclusions": dict(self.conclusions),
+                    }
+
+    def handle(self, method: str, path: str, headers, body: bytes) -> Tuple[int, Dict[str, str], Any]:
+        """Route a request; returns the status, extra headers and the JSON body."""
+        path, _, query = path.partition("?")
+        for route_method, pattern, name in _ROUTES:
+            match = pattern.match(path) if route_method == method else None
+            if match:
+                break
+        else:
+            return 404, {}, {"message": "Not Found"}
+
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter) if self.latency or self.jitter else 0
+        if delay > 0:
+            time.sleep(delay)
+
+        with self._lock:
+            self.calls[f"{method} {name}"] += 1
+            if name != "access_token":
+                if self._random.random() < self.error_rate:
+                    self.injected_errors += 1
+                    return 502, {}, {"message": "Server Error"}
+
+                rate_headers = self._spend_quota()
+                if rate_headers is None:
+                    self.rate_limited += 1
+                    return 403, self._rate_headers(), {"message": "API rate limit exceeded"}
+            else:
+                rate_headers = {}
+
+            payload = json.loads(body) if body else {}
+            status, result = getattr(self, f"_{name}")(payload, query, **match.groupdict())
+
+        if method == "GET" and status == 200:
+            etag = '"' + hashlib.sha1(json.dumps(result, sort_keys=True).encode()).hexdigest()[:20] + '"'
+            rate_headers["ETag"] = etag
+            if headers.get("If-None-Match") == etag:
+                with self._lock:
+                    self.not_modified += 1
+                    self._remaining += 1  # conditional hits are free on GitHub
+                return 304, rate_headers, None
+
+        return status, rate_headers, result
+
+    def _spend_quota(self) -> Optional[Dict[str, str]]:
+        now = time.time()
+        if now - self._window_start >= self.rate_limit_window:
+            self._window_start, self._remaining = now, self.rate_limit
+        if self._remaining <= 0:
+            return None
+        self._remaining -= 1
+        return self._rate_headers()
+
+    def _rate_headers(self) -> Dict[str, str]:
+        return {"X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(self._remaining),
+                "X-RateLimit-Reset": str(int(self._window_start + self.rate_limit_window)),
+                }
+
+    def _access_token(self, payload, query, installation):
+        expires_at = time.strftime(_EXPIRES_AT_FORMAT, time.gmtime(time.time() + self.token_ttl))
+        return 201, {"token": f"fake-token-{installation}-{self._next_id}", "expires_at": expires_at}
+
+    def _create_check_run(self, payload, query, repo):
+        run_id, self._next_id = self._next_id, self._next_id + 1
+        run = {"id": run_id, "name": payload.get("name"), "head_sha": payload.get("head_sha"),
+               "app": {"name": payload.get("name")}}
+        self._check_runs[run_id] = run
+        self._runs_by_sha.setdefault(run["head_sha"], []).append(run_id)
+        self._apply(run, payload)
+        return 201, run
+
+    def _update_check_run(self, payload, query, repo, id):
+        run = self._check_runs.get(int(id))
+        if run is None:
+            return 404, {"message": "Not Found"}
+        self._apply(run, payload)
+        return 200, run
+
+    def _apply(self, run: Dict[str, Any], payload: Dict[str, Any]) -> None:
+        for field in ("status", "conclusion", "output"):
+            if field in payload:
+                run[field] = payload[field]
+        if run.get("status") == "completed":
+            self.completed_at.setdefault(run["head_sha"], time.time())
+            self.conclusions[run.get("conclusion") or ""] += 1
+
+    def _list_check_runs(self, payload, query, repo, sha):
+        runs = [self._check_runs[run_id] for run_id in self._runs_by_sha.get(sha, ())]
+        status = dict(part.split("=", 1) for part in query.split("&") if "=" in part).get("status")
+        if status:
+            runs = [run for run in runs if run.get("status") == status]
+        return 200, {"total_count": len(runs), "check_runs": runs}
+
+    def _get_pull(self, payload, query, repo, number):
+        sha = self._pull_heads.get((repo, int(number)), "0" * 40)
+        return 200, {"number": int(number), "state": "open", "head": {"sha": sha}}
+
+    def _list_pull_files(self, payload, query, repo, number):
+        return 200, [{"filename": name, "status": "modified"} for name in self.files]
+
+    def _create_review(self, payload, query, repo, number):
+        return 200, {"id": self._next_id, "state": "CHANGES_REQUESTED"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections open, like api.github.com
+    disable_nagle_algorithm = True
+    github: FakeGitHub = None
+
+    def _reply(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        status, headers, result = self.github.handle(self.command, self.path, self.headers, body)
+        data = json.dumps(result).encode() if result is not None else b""
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PATCH = _reply
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def start_fake_github(github: FakeGitHub, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Serve `github` from a background thread; the URL is `http://{host}:{server.server_address[1]}`."""
+    handler = type("FakeGitHubHandler", (_Handler,), {"github": github})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.request_queue_size = 128
+    threading.Thread(target=server.serve_forever, name="fake-github", daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean GitHub latency")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="latency is uniform in mean +/- jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with a 502")
+    # GitHub's own quota is 5000 calls per hour and installation; the default is high enough not to be the bottleneck.
+    parser.add_argument("--rate-limit", type=int, default=100000, help="calls per rate limit window")
+    parser.add_argument("--rate-limit-window", type=float, default=60, help="seconds")
+    parser.add_argument("--token-ttl", type=float, default=3600, help="lifetime of the installation tokens")
+    parser.add_argument("--files", default="README.md,app.py", help="files every PR changes, comma separated")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def from_arguments(args: argparse.Namespace) -> FakeGitHub:
+    return FakeGitHub(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, error_rate=args.error_rate,
+                      rate_limit=args.rate_limit, rate_limit_window=args.rate_limit_window, token_ttl=args.token_ttl,
+                      files=tuple(name for name in args.files.split(",") if name), seed=args.seed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    github = from_arguments(args)
+    server = start_fake_github(github, args.host, args.port)
+    print(f"Fake GitHub API on http://{args.host}:{server.server_address[1]}, Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(github.stats()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
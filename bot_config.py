@@ -28,6 +28,136 @@ GH_APP_CLIENT_SECRET = os.getenv("GH_APP_CLIENT_SECRET", -1)
 GH_APP_PRIVATE_KEY_PATH = os.getenv("GH_APP_PRIVATE_KEY_PATH", -1)
 
 
+"""
+TUNING
+=======
+Optional knobs for the background processing. The defaults are fine for local
+development; override them in your .env file for busier installations.
+"""
+
+
+# Background job queue that runs check suites off the webhook request thread.
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", 100))
+JOB_QUEUE_WORKERS = int(os.getenv("JOB_QUEUE_WORKERS", 4))
+JOB_QUEUE_SUBMIT_TIMEOUT = float(os.getenv("JOB_QUEUE_SUBMIT_TIMEOUT", 0.05))
+
+# Worker pool shared by the checks of every suite, with a cap on how many can wait for a worker.
+CHECK_EXECUTOR_WORKERS = int(os.getenv("CHECK_EXECUTOR_WORKERS", 16))
+CHECK_EXECUTOR_MAX_QUEUED = int(os.getenv("CHECK_EXECUTOR_MAX_QUEUED", 1000))
+
+# Shared HTTP connection pool used for every GitHub API call.
+GH_HTTP_POOL_CONNECTIONS = int(os.getenv("GH_HTTP_POOL_CONNECTIONS", 4))    # number of hosts to keep pools for
+GH_HTTP_POOL_MAXSIZE = int(os.getenv("GH_HTTP_POOL_MAXSIZE", 20))           # kept-alive connections per host
+GH_HTTP_CONNECT_TIMEOUT = float(os.getenv("GH_HTTP_CONNECT_TIMEOUT", 3.05))
+GH_HTTP_READ_TIMEOUT = float(os.getenv("GH_HTTP_READ_TIMEOUT", 10))
+GH_HTTP_RETRIES = int(os.getenv("GH_HTTP_RETRIES", 3))
+GH_HTTP_BACKOFF_FACTOR = float(os.getenv("GH_HTTP_BACKOFF_FACTOR", 0.3))
+
+# GitHub rate limit budget per installation: bucket size, refill rate until the quota is known, the share of
+# the quota below which low priority calls are dropped / only high priority calls go out, and retry policy.
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 100))
+RATE_LIMIT_DEFAULT_RATE = float(os.getenv("RATE_LIMIT_DEFAULT_RATE", 10))
+RATE_LIMIT_LOW_RESERVE = float(os.getenv("RATE_LIMIT_LOW_RESERVE", 0.1))
+RATE_LIMIT_HIGH_RESERVE = float(os.getenv("RATE_LIMIT_HIGH_RESERVE", 0.02))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", 60))
+GH_RATE_LIMIT_RETRIES = int(os.getenv("GH_RATE_LIMIT_RETRIES", 3))
+
+# Number of GET responses kept for conditional requests (ETag / Last-Modified).
+ETAG_CACHE_SIZE = int(os.getenv("ETAG_CACHE_SIZE", 1000))
+
+# Installation tokens are cached in memory and refreshed in the background this many seconds before they expire.
+GH_TOKEN_REFRESH_MARGIN = float(os.getenv("GH_TOKEN_REFRESH_MARGIN", 300))
+GH_TOKEN_PERSIST = os.getenv("GH_TOKEN_PERSIST", "1").lower() not in ("0", "false", "no")  # keep private/.secret
+
+# Webhook deduplication: how long delivery ids and (repo, head SHA, trigger) keys are remembered, and how many.
+DEDUP_DELIVERY_TTL = float(os.getenv("DEDUP_DELIVERY_TTL", 3600))
+DEDUP_SUITE_TTL = float(os.getenv("DEDUP_SUITE_TTL", 60))
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", 10000))
+
+# Validation results cached by (validation, tree SHA, config version); set RESULT_CACHE_DB to also keep them in SQLite.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 5000))
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", "")
+
+# Only run the language-specific validations whose language the PR's changed files use.
+CHANGE_AWARE_PLANNING = os.getenv("CHANGE_AWARE_PLANNING", "1").lower() not in ("0", "false", "no")
+
+# Number of recent run times kept per validation for the p50/p90 estimates.
+DURATION_WINDOW = int(os.getenv("DURATION_WINDOW", 200))
+
+# Failed validations are posted as one review when the suite completes, or this many seconds after the first failure.
+REVIEW_FLUSH_DEADLINE = float(os.getenv("REVIEW_FLUSH_DEADLINE", 120))
+
+# How many check runs an ESPOVERRIDE comment neutralizes at the same time.
+NEUTRALIZE_CONCURRENCY = int(os.getenv("NEUTRALIZE_CONCURRENCY", 8))
+
+# Suites, checks and check run ids are kept in SQLite so that a restart can pick up unfinished suites; "" disables it.
+# Writes are batched every SUITE_STATE_FLUSH_INTERVAL seconds. Unfinished suites younger than SUITE_STATE_RESUME_MAX_AGE
+# seconds are resumed on startup, older ones are closed.
+SUITE_STATE_DB = os.getenv("SUITE_STATE_DB", "private/esp-state.db")
+SUITE_STATE_FLUSH_INTERVAL = float(os.getenv("SUITE_STATE_FLUSH_INTERVAL", 0.5))
+SUITE_STATE_RESUME_MAX_AGE = float(os.getenv("SUITE_STATE_RESUME_MAX_AGE", 3600))
+
+# Multi-process mode: with SHARED_QUEUE_DB set, webhooks are queued in this SQLite file and run by `worker.py`
+# processes, which lease jobs and ack them once handled. Jobs of a PR all go to the worker that owns the PR.
+SHARED_QUEUE_DB = os.getenv("SHARED_QUEUE_DB", "")
+SHARED_QUEUE_MAX_SIZE = int(os.getenv("SHARED_QUEUE_MAX_SIZE", 1000))
+SHARED_QUEUE_LEASE_TIMEOUT = float(os.getenv("SHARED_QUEUE_LEASE_TIMEOUT", 60))   # a leased job not acked is retried
+SHARED_QUEUE_OWNER_TTL = float(os.getenv("SHARED_QUEUE_OWNER_TTL", 30))           # PR ownership lapses unless renewed
+SHARED_QUEUE_MAX_ATTEMPTS = int(os.getenv("SHARED_QUEUE_MAX_ATTEMPTS", 5))
+SHARED_QUEUE_POLL_INTERVAL = float(os.getenv("SHARED_QUEUE_POLL_INTERVAL", 0.1))
+
+# "threads" runs suites on the job queue and checks on the check executor; "asyncio" runs them all on one event
+# loop thread (needs aiohttp), with at most ASYNC_MAX_SUITES suites, ASYNC_MAX_CHECKS running checks and
+# ASYNC_MAX_GITHUB_CALLS GitHub calls in flight.
+EXECUTION_ENGINE = os.getenv("EXECUTION_ENGINE", "threads").lower()
+ASYNC_MAX_SUITES = int(os.getenv("ASYNC_MAX_SUITES", 1000))
+ASYNC_MAX_CHECKS = int(os.getenv("ASYNC_MAX_CHECKS", 5000))
+ASYNC_MAX_GITHUB_CALLS = int(os.getenv("ASYNC_MAX_GITHUB_CALLS", 50))
+
+# Share of GitHub calls whose request payload is logged, at DEBUG level only.
+GH_PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv("GH_PAYLOAD_LOG_SAMPLE_RATE", 0.1))
+
+# The simulated validations take `estimate_time` times this many seconds; the load benchmark compresses time with it.
+VALIDATION_TIME_SCALE = float(os.getenv("VALIDATION_TIME_SCALE", 1))
+
+# Rendered static pages are checked for changes to their files at most every this many seconds.
+PAGE_CACHE_CHECK_INTERVAL = float(os.getenv("PAGE_CACHE_CHECK_INTERVAL", 1))
+
+# Send the per-file results of the validations as check run annotations, in batches, once the suite completes.
+CHECK_RUN_ANNOTATIONS = os.getenv("CHECK_RUN_ANNOTATIONS", "0").lower() not in ("0", "false", "no")
+
+# Where validations run: "simulated" (waits for their `estimate_time`), "subprocess" (runs their `command` in a checkout
+# of the head commit) or "http" (a job of the task API at VALIDATION_JOB_API_URL). VALIDATION_BACKENDS overrides it per
+# validation, e.g. "flake8=subprocess,mypy=subprocess".
+VALIDATION_BACKEND = os.getenv("VALIDATION_BACKEND", "simulated").lower()
+VALIDATION_BACKENDS = dict(item.strip().split("=", 1) for item in os.getenv("VALIDATION_BACKENDS", "").split(",")
+                           if "=" in item)
+
+# Limits of a validation run unless it sets its own `timeout` / `cpu_limit`: wall clock seconds, CPU seconds and
+# address space of subprocess validations (0 for no limit), and how many lines of their output are kept.
+VALIDATION_TIMEOUT = float(os.getenv("VALIDATION_TIMEOUT", 600))
+VALIDATION_CPU_LIMIT = int(os.getenv("VALIDATION_CPU_LIMIT", 300))
+VALIDATION_MEMORY_LIMIT_MB = int(os.getenv("VALIDATION_MEMORY_LIMIT_MB", 0))
+VALIDATION_LOG_LINES = int(os.getenv("VALIDATION_LOG_LINES", 200))
+
+# Subprocess validations run in checkouts of the head commits under this directory; the most recent ones are kept.
+VALIDATION_WORKSPACE_DIR = os.getenv("VALIDATION_WORKSPACE_DIR", "private/workspaces")
+VALIDATION_WORKSPACE_KEEP = int(os.getenv("VALIDATION_WORKSPACE_KEEP", 20))
+VALIDATION_GIT_URL = os.getenv("VALIDATION_GIT_URL", "https://github.com/{repository}.git")
+
+# Task API of the http validation backend, and how often its jobs are polled (backing off from the first interval).
+VALIDATION_JOB_API_URL = os.getenv("VALIDATION_JOB_API_URL", "")
+VALIDATION_JOB_API_TOKEN = os.getenv("VALIDATION_JOB_API_TOKEN", "")
+VALIDATION_JOB_POLL_INTERVAL = float(os.getenv("VALIDATION_JOB_POLL_INTERVAL", 2))
+VALIDATION_JOB_POLL_MAX_INTERVAL = float(os.getenv("VALIDATION_JOB_POLL_MAX_INTERVAL", 30))
+
+# Check run progress updates arriving within this many seconds are sent as one PATCH.
+CHECK_RUN_UPDATE_DEBOUNCE = float(os.getenv("CHECK_RUN_UPDATE_DEBOUNCE", 2))
+
+# A conclusion GitHub didn't accept is sent again, backing off from 2s to 60s, this many times.
+CHECK_RUN_CONCLUSION_RETRIES = int(os.getenv("CHECK_RUN_CONCLUSION_RETRIES", 10))
+
+
 def validate_env_variables():
     env_vars = {
         "GH_USER": GH_USER,
@@ -0,0 +1,180 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from bot_config import CHECK_EXECUTOR_MAX_QUEUED, CHECK_EXECUTOR_WORKERS
+
+log = logging.getLogger(__name__)
+
+"""
+CHECK EXECUTOR
+===============
+A single, size-limited pool of worker threads shared by every check suite.
+
+Queued checks are grouped by a fairness key (the repository). Workers take one
+check from each repository in turn, so a repository with many open PRs gets
+its share of the pool but can't starve the others. Within a repository, the
+check with the highest priority (the longest expected run time) goes first, so
+that the slowest checks don't end up starting last when the pool is saturated.
+"""
+
+
+class ExecutorFullError(Exception):
+    """Raised when a check can't be queued because the executor is at capacity."""
+
+
+class Task:
+    __slots__ = ("key", "func", "args", "priority", "enqueued_at")
+
+    def __init__(self, key: str, func: Callable[..., Any], args: tuple, priority: float = 0):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class FairExecutor:
+    def __init__(self, workers: int = CHECK_EXECUTOR_WORKERS, max_queued: int = CHECK_EXECUTOR_MAX_QUEUED,
+                 name: str = "checks"):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.name = name
+
+        # Pending tasks per key (heaps of (-priority, sequence, task)), and the keys that
+        # have pending tasks in round-robin order.
+        self._queues: Dict[str, List[Tuple[float, int, Task]]] = {}
+        self._sequence = itertools.count()
+        self._ready: Deque[str] = deque()
+        self._queued = 0
+
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+
+        # Counters, read through `stats()`.
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-worker-{i}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+        log.info(f"Started {self.workers} {self.name} workers (max {self.max_queued} queued).")
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop accepting tasks, let the workers drain what is already queued and exit."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def submit(self, key: str, func: Callable[..., Any], *args: Any, priority: float = 0) -> None:
+        """Queue `func(*args)` under the fairness `key`; higher `priority` tasks of a key run first.
+        Raises `ExecutorFullError` when at capacity.
+        """
+        task = Task(key, func, args, priority)
+
+        with self._cond:
+            if self._queued >= self.max_queued:
+                self._rejected += 1
+                raise ExecutorFullError(f"{self.name} executor is full ({self.max_queued} queued).")
+
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = []
+                self._ready.append(key)
+            heapq.heappush(queue, (-priority, next(self._sequence), task))
+
+            self._queued += 1
+            self._submitted += 1
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"workers": self.workers,
+                    "active_workers": self._active,
+                    "queued": self._queued,
+                    "max_queued": self.max_queued,
+                    "queued_keys": len(self._queues),
+                    "submitted": self._submitted,
+                    "completed": self._completed,
+                    "rejected": self._rejected,
+                    }
+
+    def _next_task(self) -> Optional[Task]:
+        with self._cond:
+            while not self._ready:
+                if not self._running:
+                    return None
+                self._cond.wait()
+
+            key = self._ready.popleft()
+            queue = self._queues[key]
+            _, _, task = heapq.heappop(queue)
+
+            # Go to the back of the line if there's more work for this key.
+            if queue:
+                self._ready.append(key)
+            else:
+                del self._queues[key]
+
+            self._queued -= 1
+            self._active += 1
+            return task
+
+    def _work(self) -> None:
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+
+            try:
+                task.func(*task.args)
+            except Exception:
+                log.exception(f"Task for {task.key} failed.")
+
+            with self._cond:
+                self._active -= 1
+                self._completed += 1
+
+
+_executor: Optional[FairExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_check_executor() -> FairExecutor:
+    """Return the process-wide check executor, starting its workers on first use."""
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                executor = FairExecutor()
+                executor.start()
+                _executor = executor
+
+    return _executor
+
+
+def peek_check_executor() -> Optional[FairExecutor]:
+    """Return the check executor if something already started it, without starting it (for probes and gauges)."""
+    return _executor
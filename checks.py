@@ -1,206 +1,685 @@
+import asyncio
+import calendar
 import logging
 import threading
+import time
 
-from objectify_json import ObjectifyJSON
-from time import sleep
-from typing import Any, Dict, Tuple, Optional, List
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+from typing import Any, Dict, Tuple, Optional, List, Sequence
 
 from constances import (
     APP_NAME,
     CHECK_RUN_STATUS_COMPLETED,
     CHECK_RUN_STATUS_IN_PROGRESS,
+    CHECK_STATUS_CANCELLED,
     CHECK_STATUS_FAILURE,
     CHECK_STATUS_RUNNING,
     CHECK_STATUS_NEUTRAL,
+    CHECK_STATUS_SKIPPED,
     CHECK_STATUS_SUCCESS,
+    CHECK_RUN_SUMMARY_LIMIT,
     CHECK_RUN_TITLE,
+    CHECK_RUN_TITLE_SUPERSEDED,
     ESP_OVERRIDE_STRING,
     check_status_lookup,
-    validations,
+    validations_by_name,
+)
+from bot_config import (
+    CHANGE_AWARE_PLANNING,
+    CHECK_RUN_ANNOTATIONS,
+    CHECK_RUN_CONCLUSION_RETRIES,
+    CHECK_RUN_UPDATE_DEBOUNCE,
+    NEUTRALIZE_CONCURRENCY,
+    REVIEW_FLUSH_DEADLINE,
+    VALIDATION_TIME_SCALE,
 )
-from gh_utils import get_check_runs, post_check_run_result, get_latest_sha, post_pull_request_review
+from check_executor import ExecutorFullError, get_check_executor
+from result_cache import result_cache, validation_config_version
+from gh_utils import (
+    get_check_runs,
+    get_latest_sha,
+    get_pull_request_files,
+    post_check_run_annotations,
+    post_check_run_result,
+    post_pull_request_review,
+    update_check_run,
+)
+from durations import duration_stats
+from events import CommentEvent, SuiteEvent
+from job_queue import QueueFullError, get_job_queue
+from metrics import CHECK_QUEUE_WAIT, CHECK_RESULTS, CHECK_RUN_TIME, OVERRIDE_LATENCY
+from planner import plan_validations
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW
+from state_store import state_store
+from suite_registry import suite_registry
+from validation_backends import ValidationResult, backend_name, get_validation_backend
 
 log = logging.getLogger(__name__)
 
 
+# Last line of a summary too long for all of its checks.
+_OMITTED_CHECKS = "_... and {} more validation(s), see the check execution URL._"
+
+
 class ProcessCheckRun:
-    def __init__(self, webhook: ObjectifyJSON):
-        self.webhook = webhook
+    """The state of one check suite. The fields of the webhook event are copied once here and shared by
+    all of the suite's checks; the event itself isn't kept.
+    """
+    __slots__ = ("force_rerun", "_result", "trigger", "base_url", "head_sha", "pull_number", "suite_key", "tree_sha",
+                 "installation_id", "checks", "cancel_event", "check_run_id", "_update_timer", "_update_lock", "_send_lock",
+                 "_completed_sent", "_conclusion_attempts", "done", "_review_lock", "_review_failures", "_review_timer", "_progress_lock",
+                 "_pending", "_failed")
+
+    link = "https://crt.prod.linkedin.com/#/testing/executions/e49a13da-126a-4726-a045-09dbdbb68a2f/execution"
+
+    def __init__(self, event: SuiteEvent, force_rerun: bool = False):
+        # Ignore cached validation results and run everything again.
+        self.force_rerun = force_rerun
 
         # Test variables.
         self._result = False  # failed
         # self._result = True  # success
 
-        self.base_url: str = str(webhook.repository.url)
-        self.head_sha: str = str(webhook.pull_request.head.sha) if webhook.pull_request else str(webhook.check_suite.head_sha)
+        # check run can be triggered by either pull request [opened, synchronize] or check suite [rerequested]
+        self.trigger: str = event.trigger
+        self.base_url: str = event.repository_url
+        self.head_sha: str = event.head_sha
+        self.pull_number: int = event.pull_number
+        self.suite_key = (event.repository_full_name, self.pull_number)
+        # Every GitHub call of the suite is made as this installation (its token, rate limit and ETag cache).
+        self.installation_id: Optional[str] = event.installation_id
+
+        # Results are cached by tree, so that a new commit with the same content can reuse them, and by head SHA,
+        # the only one pull_request deliveries carry (see `result_shas`).
+        self.tree_sha: str = event.tree_sha or self.head_sha
 
         self.checks: List[Check] = []
 
-        self.link = "https://crt.prod.linkedin.com/#/testing/executions/e49a13da-126a-4726-a045-09dbdbb68a2f/execution"
+        # Set when a newer commit of the same PR supersedes this suite.
+        self.cancel_event = threading.Event()
 
-    def generate_output_summary(self) -> str:
-        """Aggregate all the test results from checks."""
-        summary = ""
+        # The check run is created once, then updated in place by its ID.
+        self.check_run_id: Optional[int] = None
+        self._update_timer: Optional[threading.Timer] = None
+        self._update_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._completed_sent = False  # set once GitHub accepted the conclusion
+        self._conclusion_attempts = 0
 
-        for check in self.checks:
-            summary += check.get_check_result() + "\n"
+        # Resolved once the suite is over (its conclusion sent, or nothing to close), or failed if it crashed;
+        # a worker acks the suite's shared queue job then.
+        self.done: Future = Future()
 
-        summary += f"\n***\n#### [Check execution URL]({self.link})"
+        # Failed checks waiting to be reported in the suite's single review, and the timer that
+        # flushes them early when the suite takes long.
+        self._review_lock = threading.Lock()
+        self._review_failures: List[Check] = []
+        self._review_timer: Optional[threading.Timer] = None
 
+        # Progress counters, kept up to date as each check reports back.
+        self._progress_lock = threading.Lock()
+        self._pending = 0
+        self._failed = 0
+
+    def generate_output_summary(self) -> str:
+        """Aggregate all the test results from checks, within GitHub's CHECK_RUN_SUMMARY_LIMIT.
+        Each check's section is rendered once per status change (see `Check.get_check_result`).
+        """
+        footer = f"\n***\n#### [Check execution URL]({self.link})"
+        eta = self.estimate_remaining_time()
+        if eta:
+            footer = f"\n:hourglass: Expected to finish in about {eta[0]:.0f}s (at most {eta[1]:.0f}s).\n" + footer
+
+        sections = [check.get_check_result() for check in self.checks]
+        budget = CHECK_RUN_SUMMARY_LIMIT - len(footer)
+        if sum(map(len, sections)) + len(sections) > budget:
+            sections = self._fit_sections(budget)
+
+        summary = "".join([section + "\n" for section in sections] + [footer])
+        if len(summary) > CHECK_RUN_SUMMARY_LIMIT:
+            # GitHub rejects the whole update (422), a cut summary is the lesser evil.
+            log.error(f"Summary of {self.head_sha} is {len(summary)} characters, cutting it to {CHECK_RUN_SUMMARY_LIMIT}.")
+            summary = summary[:CHECK_RUN_SUMMARY_LIMIT]
         return summary
 
+    def _fit_sections(self, budget: int) -> List[str]:
+        """Sections that fit in `budget` characters (one newline after each). Every check keeps at least its result
+        line; details are then added to the failed checks first, then to the others, in check order. When not even
+        the result lines fit, the last checks are left out and counted instead.
+        """
+        collapsed = [check.get_check_result(collapsed=True) for check in self.checks]
+        room = budget - sum(len(section) + 1 for section in collapsed)
+
+        if room < 0:
+            sections, room = [], budget - len(_OMITTED_CHECKS.format(len(collapsed))) - 1
+            for section in collapsed:
+                room -= len(section) + 1
+                if room < 0:
+                    break
+                sections.append(section)
+            return sections + [_OMITTED_CHECKS.format(len(collapsed) - len(sections))]
+
+        sections = list(collapsed)
+        order = sorted(range(len(self.checks)), key=lambda i: self.checks[i].status != CHECK_STATUS_FAILURE)
+        for i in order:
+            full = self.checks[i].get_check_result()
+            if len(full) - len(collapsed[i]) <= room:
+                room -= len(full) - len(collapsed[i])
+                sections[i] = full
+        return sections
+
+    def estimate_remaining_time(self) -> Optional[Tuple[float, float]]:
+        """p50 and p90 estimates of the time until the last running check finishes, None when nothing runs."""
+        now = time.monotonic()
+        p50 = p90 = None
+
+        for check in self.checks:
+            if check.status != CHECK_STATUS_RUNNING:
+                continue
+            elapsed = now - check.started_at if check.started_at else 0
+            p50 = max(p50 or 0, duration_stats.expected(check.name, 50) - elapsed, 0)
+            p90 = max(p90 or 0, duration_stats.expected(check.name, 90) - elapsed, 0)
+
+        return (p50, p90) if p50 is not None else None
+
     def start(self) -> None:
+        """Run the whole check suite. Called from a job queue worker, never from the webhook request."""
+        if self.cancelled:
+            log.info(f"Suite {self.head_sha} was superseded before it started.")
+            return
+
         # Note: in the real implementation these threads will be done through spawning jobs through task API.
-        start_check_runs_thread = threading.Thread(target=self.create_checks())
-        start_check_runs_thread.start()
+        try:
+            self.create_checks()
+        except Exception as exc:
+            self.finish_suite(exc)
+            raise
+
+    def finish_suite(self, error: Optional[BaseException] = None) -> None:
+        """Resolve `done`, once."""
+        try:
+            if error is None:
+                self.done.set_result(None)
+            else:
+                self.done.set_exception(error)
+        except InvalidStateError:
+            pass
+
+    @property
+    def result_shas(self) -> Tuple[str, ...]:
+        """The SHAs results are cached and looked up under: the tree's when the event had it, then the head's."""
+        return (self.tree_sha, self.head_sha) if self.tree_sha != self.head_sha else (self.head_sha,)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cancel(self) -> None:
+        """Cooperatively stop the suite: queued checks are skipped, running ones stop waiting,
+        and the check run is closed right away as superseded.
+        """
+        if self.cancelled:
+            return
+
+        log.info(f"Cancelling superseded suite {self.head_sha} of {self.suite_key[0]} PR {self.pull_number}.")
+        self.cancel_event.set()
+        self.close_superseded()
+
+    def close_superseded(self) -> None:
+        """Send the superseded check run update from the job queue: `cancel` is called from the webhook request,
+        which mustn't wait on GitHub or on the rate limit budget.
+        """
+        try:
+            get_job_queue().submit(self.update_check_results, name=f"close superseded suite {self.head_sha}")
+        except QueueFullError:
+            thread = threading.Thread(target=self.update_check_results, name=f"close-{self.head_sha[:7]}",
+                                      daemon=True)
+            thread.start()
 
     def create_checks(self) -> None:
-        """Create all check objects, then start processing them."""
-        for test in validations:
-            check = Check(test["name"], self.webhook, self._result)
+        """Create the check objects of the validations relevant to the PR's changes, then start processing them.
+        The other validations are reported as skipped.
+        A suite resumed after a restart already has its check run; its checks that had finished keep their result.
+        """
+        files = get_pull_request_files(self.base_url, self.pull_number, installation_id=self.installation_id) \
+            if CHANGE_AWARE_PLANNING else None
+        self.plan_checks(files)
+
+        if self.check_run_id is None:
+            self.check_run_id = post_check_run_result(name=APP_NAME,
+                                                      head_sha=self.head_sha,
+                                                      base_url=self.base_url,
+                                                      check_status=CHECK_RUN_STATUS_IN_PROGRESS,
+                                                      output_title=CHECK_RUN_TITLE,
+                                                      output_summary=self.generate_output_summary(),
+                                                      installation_id=self.installation_id,
+                                                      )
+            state_store.save_suite(self, CHECK_RUN_STATUS_IN_PROGRESS)
+        else:
+            self.restore_finished_checks()
+
+        self.process_checks()
+
+    def restore_finished_checks(self) -> None:
+        """Give the checks that had finished before a restart their stored result."""
+        finished = state_store.finished_checks(self.suite_key[0], self.head_sha)
+        for check in self.checks:
+            if check.status == CHECK_STATUS_RUNNING and check.name in finished:
+                check.status, check.link = finished[check.name]
+        log.info(f"Resuming suite {self.head_sha} with {len(finished)} check(s) already done.")
+
+    def plan_checks(self, files: Optional[List[str]]) -> None:
+        """Create a check per validation; the ones that `files` can't affect are marked as skipped."""
+        scheduled, skipped = plan_validations(files)
+
+        for test in scheduled:
+            check = Check(test["name"], self, self._result)
+            # Results of a validation run elsewhere (simulated vs. real) aren't interchangeable.
+            version = validation_config_version(dict(test, backend=backend_name(test["name"])))
+            check.result_keys = tuple((test["name"], sha, version) for sha in self.result_shas)
             self.checks.append(check)
 
             # Simulate some tests success, some failed.
             # self._result ^= True
 
-        self.process_checks()
+        for test in skipped:
+            check = Check(test["name"], self, self._result)
+            check.status = CHECK_STATUS_SKIPPED
+            self.checks.append(check)
 
     def process_checks(self) -> None:
-        """Kick start every check and update the result as they're available.
-        Then update the check run conclusion when every test is done.
+        """Queue every check on the shared executor. Each check reports back through `on_check_done` as soon as it
+        finishes, which updates the result and, for the last one, the check run conclusion.
         """
-        threads = set()
-
-        for check in self.checks:
-            thread = threading.Thread(target=check.process_check)
-            threads.add(thread)
-
-        # Start every check.
-        for thread in threads:
-            thread.start()
-
-        # Update the results whenever any test is done.
-        while threads:
-            sleep(1)
-            removing = set()
-            for thread in threads:
-                if not thread.is_alive():
-                    self.update_check_results()
-                    removing.add(thread)
-            threads -= removing
+        runnable = self.runnable_checks()
+        if not runnable:
+            self.update_check_results()
+            return
+
+        # Longest expected first, so that the slowest checks start early when the executor is saturated.
+        executor = get_check_executor()
+        for check in runnable:
+            try:
+                executor.submit(self.base_url, self.run_check, check, time.monotonic(),
+                                priority=duration_stats.expected(check.name))
+            except ExecutorFullError as exc:
+                log.error(f"Could not schedule {check.name}: {exc}")
+                check.status = CHECK_STATUS_FAILURE
+                self.on_check_done(check)
+
+    def runnable_checks(self) -> List["Check"]:
+        """The checks still to run; the progress counters start from them."""
+        runnable = [check for check in self.checks if check.status == CHECK_STATUS_RUNNING]
+        with self._progress_lock:
+            self._pending = len(runnable)
+            self._failed = sum(check.status == CHECK_STATUS_FAILURE for check in self.checks)
+        return runnable
+
+    def run_check(self, check: "Check", queued_at: Optional[float] = None) -> None:
+        if queued_at is not None:
+            CHECK_QUEUE_WAIT.labels(check.name).observe(time.monotonic() - queued_at)
+
+        try:
+            if self.cancelled:
+                check.status = CHECK_STATUS_CANCELLED
+                return
+
+            if self.cached_result(check):
+                return
+
+            check.started_at = time.monotonic()
+            check.process_check()
+            self.record_result(check)
+        except Exception:
+            log.exception(f"Check {check.name} crashed.")
+            check.status = CHECK_STATUS_FAILURE
+        finally:
+            self.on_check_done(check)
+
+    def cached_result(self, check: "Check") -> bool:
+        """Take the result of an earlier run of the same tree, if there is one."""
+        cached = None if self.force_rerun else result_cache.lookup(check.result_keys)
+        if cached:
+            log.info(f"Using cached result of {check.name} for {self.tree_sha}")
+            check.status, check.link, check.cached = cached.status, cached.link, True
+        return bool(cached)
+
+    def record_result(self, check: "Check") -> None:
+        if check.status in (CHECK_STATUS_SUCCESS, CHECK_STATUS_FAILURE):
+            elapsed = time.monotonic() - check.started_at
+            duration_stats.record(check.name, elapsed)
+            CHECK_RUN_TIME.labels(check.name).observe(elapsed)
+            if check.cacheable:
+                for key in check.result_keys:
+                    result_cache.put(key, check.status, check.link)
+
+    def on_check_done(self, check: "Check") -> None:
+        """Completion callback of a single check."""
+        CHECK_RESULTS.labels(check.name, check.status, "true" if check.cached else "false").inc()
+        if check.status in (CHECK_STATUS_SUCCESS, CHECK_STATUS_FAILURE):
+            state_store.save_check(self, check)
+
+        with self._progress_lock:
+            self._pending -= 1
+            if check.status == CHECK_STATUS_FAILURE:
+                self._failed += 1
+
+        if check.review_comments:
+            self.add_review_failure(check)
+
+        self.update_check_results()
+
+    def add_review_failure(self, check: "Check") -> None:
+        """Collect a failed check for the suite's review; the first one starts the REVIEW_FLUSH_DEADLINE timer."""
+        with self._review_lock:
+            self._review_failures.append(check)
+            if self._review_timer is None and REVIEW_FLUSH_DEADLINE > 0:
+                self._review_timer = threading.Timer(REVIEW_FLUSH_DEADLINE, self.flush_review)
+                self._review_timer.daemon = True
+                self._review_timer.start()
+
+    def flush_review(self) -> None:
+        """Post every collected failure as one review. Nothing is posted for a superseded suite."""
+        review = self.take_review()
+        if review:
+            post_pull_request_review(self.base_url, self.pull_number, body=review[0], comments=review[1],
+                                     commit_id=self.head_sha, installation_id=self.installation_id)
+
+    def take_review(self) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        """Body and comments of the review of the failures collected so far, if there's one to post."""
+        with self._review_lock:
+            failures, self._review_failures = self._review_failures, []
+            if self._review_timer is not None:
+                self._review_timer.cancel()
+                self._review_timer = None
+
+        if not failures or self.cancelled:
+            return None
+
+        body = "The following validation(s) detect some error(s):\n" + \
+               "".join(f"- {check.name}\n" for check in failures)
+        comments = [comment for check in failures for comment in check.review_comments]
+        return body, comments
 
     def determine_check_run_progress(self) -> Tuple[str, str]:
         """Determine the progress of the check run.
         When all of the checks are done, the check run status will be completed with conclusion based on the check results.
         Otherwise, there's no conclusion yet and the status will be CHECK_RUN_STATUS_IN_PROGRESS.
         """
-        check_size = len(self.checks)
-        conclusion = CHECK_STATUS_SUCCESS
-        status = CHECK_RUN_STATUS_COMPLETED
-
-        for check in self.checks:
-            if check.status != CHECK_STATUS_RUNNING:
-                check_size -= 1
+        if self.cancelled:
+            return CHECK_STATUS_CANCELLED, CHECK_RUN_STATUS_COMPLETED
 
-            # Any of the check is failed, the entire check run will be considered as failed.
-            if check.status == CHECK_STATUS_FAILURE:
-                conclusion = CHECK_STATUS_FAILURE
+        with self._progress_lock:
+            pending, failed = self._pending, self._failed
 
         # if there's one check is not done yet, the entire check run is still in progress.
-        if check_size:
-            status = CHECK_RUN_STATUS_IN_PROGRESS
-            conclusion = ""
+        if pending:
+            return "", CHECK_RUN_STATUS_IN_PROGRESS
 
-        return conclusion, status
+        # Any of the check is failed, the entire check run will be considered as failed.
+        conclusion = CHECK_STATUS_FAILURE if failed else CHECK_STATUS_SUCCESS
+        return conclusion, CHECK_RUN_STATUS_COMPLETED
 
     def update_check_results(self) -> None:
-        """Update date the entire check run result page."""
+        """Update the entire check run result page.
+        Progress updates are coalesced: the first one starts a CHECK_RUN_UPDATE_DEBOUNCE timer and
+        every check finishing before it fires is covered by the same API call.
+        The completed update is always sent right away.
+        """
+        _, status = self.determine_check_run_progress()
+
+        with self._update_lock:
+            if status == CHECK_RUN_STATUS_COMPLETED:
+                if self._update_timer is not None:
+                    self._update_timer.cancel()
+                    self._update_timer = None
+
+            elif CHECK_RUN_UPDATE_DEBOUNCE > 0:
+                # Either start the window or let the pending update cover this change.
+                if self._update_timer is None:
+                    self._update_timer = threading.Timer(CHECK_RUN_UPDATE_DEBOUNCE, self._flush_check_results)
+                    self._update_timer.daemon = True
+                    self._update_timer.start()
+                return
+
+        self.send_check_results()
+
+    def _flush_check_results(self) -> None:
+        with self._update_lock:
+            self._update_timer = None
+        self.send_check_results()
+
+    def next_update(self) -> Optional[Tuple[str, str, str, str, int]]:
+        """Status, conclusion, title, summary and priority of the next check run write, None if there's nothing
+        to write. Called with the send lock held.
+        """
+        # A late progress update must never overwrite the conclusion.
+        if self._completed_sent:
+            return None
+
         conclusion, status = self.determine_check_run_progress()
-        post_check_run_result(name=APP_NAME,
-                              head_sha=self.head_sha,
-                              base_url=self.base_url,
-                              check_status=status,
-                              check_conclusion=conclusion,
-                              output_title=CHECK_RUN_TITLE,
-                              output_summary=self.generate_output_summary(),
-                              )
+        title = CHECK_RUN_TITLE_SUPERSEDED if self.cancelled else CHECK_RUN_TITLE
+
+        # Nothing to close if the suite was superseded before its check run was created.
+        if self.check_run_id is None and self.cancelled:
+            self.finish_suite()
+            return None
+
+        # Conclusions must get through; progress updates can be dropped when the rate limit runs low.
+        priority = PRIORITY_HIGH if status == CHECK_RUN_STATUS_COMPLETED else PRIORITY_LOW
+        return status, conclusion, title, self.generate_output_summary(), priority
+
+    def send_check_results(self) -> None:
+        """Write the current state of every check to the check run."""
+        with self._send_lock:
+            update = self.next_update()
+            if update is None:
+                return
+
+            status, conclusion, title, summary, priority = update
+            if self.check_run_id is None:
+                self.check_run_id = post_check_run_result(name=APP_NAME,
+                                                          head_sha=self.head_sha,
+                                                          base_url=self.base_url,
+                                                          check_status=status,
+                                                          check_conclusion=conclusion,
+                                                          output_title=title,
+                                                          output_summary=summary,
+                                                          priority=priority,
+                                                          installation_id=self.installation_id,
+                                                          )
+                written = self.check_run_id is not None
+            else:
+                written = update_check_run(base_url=self.base_url,
+                                           check_run_id=self.check_run_id,
+                                           check_status=status,
+                                           check_conclusion=conclusion,
+                                           output_title=title,
+                                           output_summary=summary,
+                                           priority=priority,
+                                           installation_id=self.installation_id,
+                                           )
+            self.record_update(status, conclusion, summary, written)
+
+        if status == CHECK_RUN_STATUS_COMPLETED and written:
+            annotations = self.completed_annotations()
+            if annotations:
+                post_check_run_annotations(self.base_url, self.check_run_id, status, conclusion, title, summary,
+                                           annotations, installation_id=self.installation_id)
+            self.flush_review()
+
+    def record_update(self, status: str, conclusion: str, summary: str, written: bool) -> None:
+        """Book-keeping after a check run write, with the send lock held. The conclusion only counts as sent, and the
+        suite as completed in the state store, once GitHub took it; until then it's tried again with a backoff.
+        """
+        if status != CHECK_RUN_STATUS_COMPLETED:
+            state_store.save_suite(self, status, conclusion, summary)
+            return
+
+        if written:
+            self._completed_sent = True
+            suite_registry.unregister(self)
+            state_store.save_suite(self, status, conclusion, summary)
+            self.finish_suite()
+            return
+
+        self._conclusion_attempts += 1
+        if self._conclusion_attempts > CHECK_RUN_CONCLUSION_RETRIES:
+            # The state store still has the suite in progress, so the next start closes or resumes its check run.
+            log.error(f"Giving up on the conclusion of suite {self.head_sha} after {self._conclusion_attempts} "
+                      f"attempts.")
+            suite_registry.unregister(self)
+            self.finish_suite()
+            return
+
+        delay = min(2 ** self._conclusion_attempts, 60)
+        log.warning(f"Could not send the conclusion of suite {self.head_sha}, retrying in {delay}s.")
+        self.retry_update(delay)
+
+    def retry_update(self, delay: float) -> None:
+        timer = threading.Timer(delay, self.send_check_results)
+        timer.daemon = True
+        timer.start()
+
+    def completed_annotations(self) -> List[Dict[str, Any]]:
+        """The annotations of every check, added to the check run once it's completed (with CHECK_RUN_ANNOTATIONS),
+        instead of the per-file results bloating the summary.
+        """
+        if not CHECK_RUN_ANNOTATIONS or self.cancelled or self.check_run_id is None:
+            return []
+        return [annotation for check in self.checks for annotation in check.annotations]
 
 
 class Check:
-    def __init__(self, name: str, webhook: ObjectifyJSON, _result: bool):
-        self.name = name
+    """One validation of a suite. Suite-level fields are read from the suite rather than copied."""
+    __slots__ = ("name", "suite", "status", "link", "cached", "started_at", "review_comments", "annotations",
+                 "details", "cacheable", "result_keys", "_fragment", "_result")
 
-        self.base_url: str = str(webhook.repository.url)
-
-        self.check_suite_re_request = False
-        self.pull_number: int = int(str(webhook.pull_request.number))
-
-        # check run can be triggered by either pull request [opened, updated] or check suite [rerequested]
-        if not webhook.pull_request:
-            self.check_suite_re_request = True
-            self.pull_number = int(str(webhook.check_suite.pull_requests[0].number))  # same PR has the same number
+    def __init__(self, name: str, suite: ProcessCheckRun, _result: bool):
+        self.name = name
+        self.suite = suite
 
         self.status = CHECK_STATUS_RUNNING
         self.link = ""
-        self.head_sha = webhook
+        self.cached = False  # result reused from an earlier run of the same tree
+        self.started_at: Optional[float] = None  # time.monotonic() when it got a worker
+        self.review_comments: Sequence[Dict[str, Any]] = ()
+        self.annotations: Sequence[Dict[str, Any]] = ()  # per-file results, for the check run
+        self.details = ""  # markdown shown under the result, collapsed first when the summary gets too long
+        self.cacheable = True  # False when the result says more about the infrastructure than about the code
+        self._fragment: Tuple[tuple, str, str] = ((), "", "")  # (what it was rendered from, full, collapsed)
+        self.result_keys: Tuple[Tuple[str, str, str], ...] = ()  # where its result is cached, see `result_shas`
 
         # test variable
         self._result = _result
 
-    def get_process_time(self) -> int:
-        for test in validations:
-            if self.name == test["name"]:
-                return test["estimate_time"]
+    @property
+    def base_url(self) -> str:
+        return self.suite.base_url
+
+    @property
+    def head_sha(self) -> str:
+        return self.suite.head_sha
+
+    @property
+    def pull_number(self) -> int:
+        return self.suite.pull_number
+
+    @property
+    def check_suite_re_request(self) -> bool:
+        return self.suite.trigger == "check_suite"
+
+    @property
+    def cancel_event(self) -> threading.Event:
+        return self.suite.cancel_event
+
+    def get_process_time(self) -> float:
+        test = validations_by_name.get(self.name)
+        if test:
+            return test["estimate_time"] * VALIDATION_TIME_SCALE
 
         log.warning(f"Can't find the test {self.name}'s estimate time.")
-        return 5
+        return 5 * VALIDATION_TIME_SCALE
 
     def get_link(self) -> str:
-        for test in validations:
-            if self.name == test["name"]:
-                return test["good_link"] if self._result else test["bad_link"]
+        test = validations_by_name.get(self.name)
+        if test:
+            return test["good_link"] if self._result else test["bad_link"]
 
-        log.warning(f"Can't find the test {self.name}'s estimate time.")
+        log.warning(f"Can't find the test {self.name}'s link.")
         return ""
 
     def process_check(self) -> None:
         log.info(f"Starting {self.name}")
-        sleep(self.get_process_time())  # imitate the delay each test would take before getting the result is back.
-        self.status = CHECK_STATUS_SUCCESS
-        self.link = self.get_link()
-
-        if not self._result:
-            self.status = CHECK_STATUS_FAILURE
-            # post a request change when the check fails
-            post_pull_request_review(self.base_url,
-                                     self.pull_number,
-                                     body=f"{self.name} detects some error(s).",
-                                     path="README.md", position=1,
-                                     comment_body="This needs to be fixed.",
-                                     )
+        self.finish(get_validation_backend(self.name).run(self))
 
+    async def process_check_async(self, cancelled: asyncio.Event) -> None:
+        """`process_check` for the asyncio engine: `cancelled` cuts the wait short."""
+        log.info(f"Starting {self.name}")
+        self.finish(await get_validation_backend(self.name).run_async(self, cancelled))
+
+    def finish(self, result: ValidationResult) -> None:
+        """Take the result of the validation backend."""
+        self.status = result.status
+        if result.status == CHECK_STATUS_CANCELLED:
+            log.info(f"Cancelled {self.name}")
+            return
+
+        self.link = result.link
+        self.details = result.details
+        self.annotations = result.annotations
+        self.review_comments = result.review_comments
+        self.cacheable = result.cacheable
         log.info(f"Finish {self.name}")
 
-    def get_check_result(self) -> str:
-        link = f"[See more details]({self.link})\n" if self.link else ""
-        return f"### {self.name}\n" \
-               f"{check_status_lookup[self.status]['icon']} The test is {check_status_lookup[self.status]['text']}.\n" \
-               f"{link}"
-
-
-def neutralize_failed_check_runs(base_url: str, head_sha: str) -> None:
-    """Go through the check runs of the given head SHA and replace the conclusion from 'failure' to 'neutral'."""
-    for run in get_check_runs(base_url, head_sha):
-        if run["app"]["name"] == APP_NAME:
-            log.info(f"Neutralizing the check run.")
-            post_check_run_result(name=run["name"],
-                                  head_sha=head_sha,
-                                  base_url=base_url,
-                                  check_status=CHECK_RUN_STATUS_COMPLETED,
-                                  check_conclusion=CHECK_STATUS_NEUTRAL,
-                                  output_title=f"{CHECK_RUN_TITLE} - Overrided",
-                                  output_summary=run["output"]["summary"],
-                                  )
+    def get_check_result(self, collapsed: bool = False) -> str:
+        """The check's section of the summary; `collapsed` leaves the details out.
+        It's only rendered again when the status, link or details changed since the last call.
+        """
+        rendered_from = (self.status, self.link, self.cached, self.details)
+        fragment = self._fragment
+        if fragment[0] != rendered_from:
+            link = f"[See more details]({self.link})\n" if self.link else ""
+            cached = " (cached)" if self.cached else ""
+            result = f"### {self.name}\n" \
+                     f"{check_status_lookup[self.status]['icon']} The test is {check_status_lookup[self.status]['text']}{cached}.\n" \
+                     f"{link}"
+            full = f"{result}<details><summary>Details</summary>\n\n{self.details}\n\n</details>\n" if self.details \
+                else result
+            # One assignment, so that a concurrent reader never pairs a key with the fragments of another.
+            fragment = self._fragment = (rendered_from, full, result)
+
+        return fragment[2] if collapsed else fragment[1]
+
+
+def neutralize_failed_check_runs(base_url: str, head_sha: str, failed_runs: List[Dict[str, Any]] = None,
+                                 installation_id: str = None) -> int:
+    """Go through the check runs of the given head SHA and replace the conclusion from 'failure' to 'neutral'.
+    Only our own failed runs are rewritten, NEUTRALIZE_CONCURRENCY of them at a time. Returns how many were.
+    `failed_runs` (with their "id" and ["output"]["summary"]) are read from GitHub when not given.
+    """
+    if failed_runs is None:
+        failed_runs = [run for run in get_check_runs(base_url, head_sha, status=CHECK_RUN_STATUS_COMPLETED,
+                                                     installation_id=installation_id)
+                       if run["app"]["name"] == APP_NAME and run.get("conclusion") == CHECK_STATUS_FAILURE]
+    if not failed_runs:
+        return 0
+
+    def neutralize(run: Dict[str, Any]) -> bool:
+        log.info(f"Neutralizing the check run {run['id']}.")
+        return update_check_run(base_url=base_url,
+                                check_run_id=run["id"],
+                                check_status=CHECK_RUN_STATUS_COMPLETED,
+                                check_conclusion=CHECK_STATUS_NEUTRAL,
+                                output_title=f"{CHECK_RUN_TITLE} - Overrided",
+                                output_summary=run["output"]["summary"],
+                                priority=PRIORITY_HIGH,
+                                installation_id=installation_id,
+                                )
+
+    with ThreadPoolExecutor(max_workers=min(NEUTRALIZE_CONCURRENCY, len(failed_runs))) as pool:
+        return sum(pool.map(neutralize, failed_runs))
 
 
 def comment_contains_override_string(comment: str) -> bool:
@@ -212,20 +691,40 @@ def comment_contains_override_string(comment: str) -> bool:
     return False
 
 
-def neutralize_latest_check_suite(webhook):
+def neutralize_latest_check_suite(event: CommentEvent):
     """Neutralize all of the failed check runs of the last commit in the PR that the comment is from."""
-    base_url = webhook.issue.repository_url
-    head_sha = get_latest_sha(base_url, webhook.issue.number)
-
-    if not comment_contains_override_string(str(webhook.comment.body)):
+    if not comment_contains_override_string(event.body):
         log.debug(f"Ignore the comment.")
         return
 
     log.info(f"ESP override string detected.")
 
+    base_url = event.repository_url
+
+    # The suite state store knows the PR's latest suite and its check run; GitHub is only asked when it doesn't.
+    record = state_store.latest_suite(event.repository_full_name, event.issue_number)
+    if record and record.check_run_id:
+        head_sha = record.head_sha
+        failed_runs = [{"id": record.check_run_id, "output": {"summary": record.summary or ""}}] \
+            if record.conclusion == CHECK_STATUS_FAILURE else []
+    else:
+        head_sha = get_latest_sha(base_url, event.issue_number, installation_id=event.installation_id)
+        failed_runs = None
+
     if not head_sha:
         log.error("Abort neutralizing the latest check suite.")
         return
 
-    log.info(f"Neutralizing {webhook.repository.full_name} PR {webhook.issue.number} head sha {head_sha}")
-    neutralize_failed_check_runs(base_url, head_sha)
+    log.info(f"Neutralizing {event.repository_full_name} PR {event.issue_number} head sha {head_sha}")
+    neutralized = neutralize_failed_check_runs(base_url, head_sha, failed_runs, installation_id=event.installation_id)
+    if record and neutralized:
+        state_store.update_conclusion(event.repository_full_name, head_sha, CHECK_RUN_STATUS_COMPLETED,
+                                      CHECK_STATUS_NEUTRAL)
+
+    # Latency from the comment being posted to every run being neutralized.
+    try:
+        latency = time.time() - calendar.timegm(time.strptime(event.created_at, "%Y-%m-%dT%H:%M:%SZ"))
+        OVERRIDE_LATENCY.observe(latency)
+        log.info(f"Neutralized {neutralized} check run(s) {latency:.1f}s after the override comment.")
+    except ValueError:
+        log.warning(f"Can't compute the override latency from {event.created_at}.")
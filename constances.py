@@ -5,6 +5,12 @@ APP_NAME: str = "Early Signal Platform"
 ESP_OVERRIDE_STRING: str = "ESPOVERRIDE"
 
 CHECK_RUN_TITLE: str = "Test Results"
+CHECK_RUN_TITLE_SUPERSEDED: str = f"{CHECK_RUN_TITLE} - Superseded"
+CHECK_RUN_TITLE_INTERRUPTED: str = f"{CHECK_RUN_TITLE} - Interrupted"
+
+# GitHub's limits on a check run's output.
+CHECK_RUN_SUMMARY_LIMIT: int = 65535                # characters of output.summary
+CHECK_RUN_ANNOTATIONS_PER_REQUEST: int = 50         # annotations per create/update call
 
 CHECK_RUN_STATUS_IN_PROGRESS: str = "in_progress"
 CHECK_RUN_STATUS_COMPLETED: str = "completed"
@@ -13,6 +19,8 @@ CHECK_STATUS_RUNNING: str = "in_progress"           # Run status: in_progress
 CHECK_STATUS_SUCCESS: str = "success"               # Run status: completed, run conclusion: success
 CHECK_STATUS_FAILURE: str = "failure"               # Run status: completed, run conclusion: failure
 CHECK_STATUS_NEUTRAL: str = "neutral"               # Run status: completed, run conclusion: neutral
+CHECK_STATUS_CANCELLED: str = "cancelled"           # Run status: completed, run conclusion: cancelled
+CHECK_STATUS_SKIPPED: str = "skipped"               # Not run: the PR doesn't touch the validation's language
 
 check_status_lookup: Dict[str, Dict[str, str]] = {
     CHECK_STATUS_RUNNING: {"icon": ":clock1030:",
@@ -27,6 +35,19 @@ check_status_lookup: Dict[str, Dict[str, str]] = {
     CHECK_STATUS_NEUTRAL: {"icon": ":thought_balloon:",  # ":white_circle:",
                            "text": "neutralized",
                            },
+    CHECK_STATUS_CANCELLED: {"icon": ":no_entry_sign:",
+                             "text": "cancelled",
+                             },
+    CHECK_STATUS_SKIPPED: {"icon": ":fast_forward:",
+                           "text": "skipped (no relevant file changed)",
+                           },
+}
+
+# Which changed files make a validation with the given `language` relevant.
+language_file_patterns: Dict[str, List[str]] = {
+    "python": ["*.py", "*.pyi", "setup.cfg", "requirements*.txt", "*/requirements*.txt", "mypy.ini", ".flake8"],
+    "javascript": ["*.js", "*.jsx", "*.mjs", "*.ts", "*.tsx", "*.html", "package.json", "*/package.json"],
+    "java": ["*.java", "pom.xml", "*/pom.xml", "*.gradle", "checkstyle*.xml"],
 }
 
 validations: List[Dict[str, Any]] = [
@@ -48,12 +69,14 @@ validations: List[Dict[str, Any]] = [
     {"name": "flake8",
      "estimate_time": 1,
      "language": "python",
+     "command": ["flake8", "."],
      "good_link": "http://cia-file-store.corp.linkedin.com:1177/files/20-03-13/18/65/65df8523-0961-4447-bf99-352b65484dd7/0/console.log",
      "bad_link": "http://cia-file-store.corp.linkedin.com:1177/files/20-03-11/23/59/595c4644-a889-4338-b87c-fcc2f18e49a1/0/console.log",
      },
     {"name": "mypy",
      "estimate_time": 5,
      "language": "python",
+     "command": ["mypy", "."],
      "good_link": "http://cia-file-store.corp.linkedin.com:1177/files/20-03-13/18/65/65df8523-0961-4447-bf99-352b65484dd7/0/console.log",
      "bad_link": "http://cia-file-store.corp.linkedin.com:1177/files/20-03-11/23/59/595c4644-a889-4338-b87c-fcc2f18e49a1/0/console.log",
      },
@@ -69,4 +92,7 @@ validations: List[Dict[str, Any]] = [
      "good_link": "http://cia-file-store.corp.linkedin.com:1177/files/20-03-13/18/65/65df8523-0961-4447-bf99-352b65484dd7/0/console.log",
      "bad_link": "http://cia-file-store.corp.linkedin.com:1177/files/20-03-11/23/59/595c4644-a889-4338-b87c-fcc2f18e49a1/0/console.log",
      },
-]
\ No newline at end of file
+]
+
+# Validations by name, so that lookups don't scan the list.
+validations_by_name: Dict[str, Dict[str, Any]] = {test["name"]: test for test in validations}
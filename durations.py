@@ -0,0 +1,63 @@
+import logging
+import threading
+
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from bot_config import DURATION_WINDOW
+from constances import validations_by_name
+
+log = logging.getLogger(__name__)
+
+"""
+VALIDATION DURATIONS
+=====================
+Keeps the most recent run times of every validation, so that estimates follow
+reality instead of the fixed `estimate_time` in `constances.validations`. The
+fixed value is only used until a validation has run at least once.
+"""
+
+_default_estimate = 5
+
+
+class DurationStats:
+    def __init__(self, window: int = DURATION_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, name: str, q: float) -> Optional[float]:
+        """The `q` percentile (0-100) of the recorded durations, or None without samples."""
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+
+        if not samples:
+            return None
+        index = min(int(round(q / 100 * (len(samples) - 1))), len(samples) - 1)
+        return samples[index]
+
+    def expected(self, name: str, q: float = 50) -> float:
+        """Expected duration of a validation: the `q` percentile of its runs, else its configured estimate."""
+        measured = self.percentile(name, q)
+        if measured is not None:
+            return measured
+
+        test = validations_by_name.get(name)
+        return test["estimate_time"] if test else _default_estimate
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            names = list(self._samples)
+        return {name: {"p50": self.expected(name, 50), "p90": self.expected(name, 90),
+                       "samples": len(self._samples[name])}
+                for name in names}
+
+
+duration_stats = DurationStats()
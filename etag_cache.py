@@ -0,0 +1,86 @@
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+
+from bot_config import ETAG_CACHE_SIZE
+
+log = logging.getLogger(__name__)
+
+"""
+CONDITIONAL REQUESTS
+=====================
+GitHub answers a GET with `304 Not Modified` when the `If-None-Match` (ETag) or
+`If-Modified-Since` we send still matches, and 304s don't count against the
+primary rate limit. This cache keeps the last full response of every GET by
+(installation, URL), so that a 304 can be served from it.
+"""
+
+CacheKey = Tuple[str, str]  # (installation, url)
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = ETAG_CACHE_SIZE):
+        self.max_size = max_size
+        self._responses: "OrderedDict[CacheKey, requests.Response]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url: str, installation_id: Optional[str] = None) -> CacheKey:
+        return str(installation_id or "default"), url
+
+    def conditional_headers(self, key: CacheKey) -> Dict[str, str]:
+        """Validators to send with the request, if we have a cached response for it."""
+        with self._lock:
+            response = self._responses.get(key)
+        if response is None:
+            return {}
+
+        headers = {}
+        if response.headers.get("ETag"):
+            headers["If-None-Match"] = response.headers["ETag"]
+        if response.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = response.headers["Last-Modified"]
+        return headers
+
+    def resolve(self, key: CacheKey, response: requests.Response) -> requests.Response:
+        """Return the response to hand to the caller: the cached one on a 304, else `response`,
+        which is remembered when it carries a validator.
+        """
+        with self._lock:
+            if response.status_code == 304:
+                cached = self._responses.get(key)
+                if cached is not None:
+                    self._responses.move_to_end(key)
+                    self.hits += 1
+                    return cached
+                log.warning(f"Got 304 for {key[1]} without a cached response.")
+                return response
+
+            self.misses += 1
+            if response.status_code == 200 and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+                self._responses[key] = response
+                self._responses.move_to_end(key)
+                while len(self._responses) > self.max_size:
+                    self._responses.popitem(last=False)
+            else:
+                self._responses.pop(key, None)
+
+            return response
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._responses),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                }
+
+
+response_cache = ResponseCache()
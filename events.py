@@ -0,0 +1,153 @@
+import json
+import logging
+
+from typing import Any, Dict, Optional, Union
+
+from constances import ESP_OVERRIDE_STRING
+
+log = logging.getLogger(__name__)
+
+"""
+WEBHOOK EVENTS
+===============
+Webhook payloads are large (a pull_request delivery is tens of KB) and we read a
+handful of fields from them. Deliveries are routed on their headers first, and
+the ones we handle are decoded into the small records below; the parsed payload
+is dropped right away.
+"""
+
+# Events and actions we act on, checked before the body is parsed.
+HANDLED_ACTIONS = {
+    "pull_request": ("opened", "synchronize", "updated"),  # GitHub sends "synchronize" for new commits
+    "check_suite": ("rerequested",),
+    "check_run": ("created",),
+    "issue_comment": ("created",),
+}
+
+
+class SuiteEvent:
+    """A request to run the check suite of a commit (pull_request or check_suite event)."""
+    __slots__ = ("trigger", "action", "repository_url", "repository_full_name", "head_sha", "tree_sha",
+                 "pull_number", "installation_id")
+
+    def __init__(self, trigger: str, action: str, repository_url: str, repository_full_name: str,
+                 head_sha: str, tree_sha: Optional[str], pull_number: Optional[int],
+                 installation_id: Optional[str] = None):
+        self.trigger = trigger
+        self.action = action
+        self.repository_url = repository_url
+        self.repository_full_name = repository_full_name
+        self.head_sha = head_sha
+        self.tree_sha = tree_sha
+        self.pull_number = pull_number
+        self.installation_id = installation_id  # the GitHub App installation the calls are made as
+
+
+class CommentEvent:
+    """An issue_comment event."""
+    __slots__ = ("action", "repository_url", "repository_full_name", "issue_number", "body", "created_at",
+                 "installation_id")
+
+    def __init__(self, action: str, repository_url: str, repository_full_name: str, issue_number: int,
+                 body: str, created_at: str, installation_id: Optional[str] = None):
+        self.action = action
+        self.repository_url = repository_url
+        self.repository_full_name = repository_full_name
+        self.issue_number = issue_number
+        self.body = body
+        self.created_at = created_at
+        self.installation_id = installation_id
+
+
+class CheckRunEvent:
+    __slots__ = ("action", "name")
+
+    def __init__(self, action: str, name: str):
+        self.action = action
+        self.name = name
+
+
+WebhookEvent = Union[SuiteEvent, CommentEvent, CheckRunEvent]
+
+
+def is_handled(event: str) -> bool:
+    return event in HANDLED_ACTIONS
+
+
+def parse_event(event: str, body: bytes) -> Optional[WebhookEvent]:
+    """Decode the fields we use from a delivery of the given event type.
+    Returns None for events and actions we ignore, and for malformed payloads.
+    """
+    if event not in HANDLED_ACTIONS:
+        return None
+
+    # Most comments aren't overrides; don't even parse them.
+    if event == "issue_comment" and ESP_OVERRIDE_STRING.encode() not in body:
+        return None
+
+    try:
+        payload: Dict[str, Any] = json.loads(body)
+        action = str(payload.get("action", "")).lower()
+        if action not in HANDLED_ACTIONS[event]:
+            return None
+
+        return _decoders[event](payload, action)
+
+    except (ValueError, KeyError, TypeError, IndexError) as exc:
+        log.error(f"Malformed {event} payload: {exc!r}")
+        return None
+
+
+def _installation(payload: Dict[str, Any]) -> Optional[str]:
+    """The id of the installation the delivery is for; GitHub App deliveries always carry it."""
+    installation = payload.get("installation") or {}
+    return str(installation["id"]) if installation.get("id") else None
+
+
+def _pull_request(payload: Dict[str, Any], action: str) -> SuiteEvent:
+    pull_request = payload["pull_request"]
+    return SuiteEvent("pull_request", action,
+                      payload["repository"]["url"], payload["repository"]["full_name"],
+                      pull_request["head"]["sha"], None, int(pull_request["number"]), _installation(payload))
+
+
+def _check_suite(payload: Dict[str, Any], action: str) -> SuiteEvent:
+    check_suite = payload["check_suite"]
+    pull_requests = check_suite.get("pull_requests") or []
+    head_commit = check_suite.get("head_commit") or {}
+    return SuiteEvent("check_suite", action,
+                      payload["repository"]["url"], payload["repository"]["full_name"],
+                      check_suite["head_sha"], head_commit.get("tree_id"),
+                      int(pull_requests[0]["number"]) if pull_requests else None,  # same PR has the same number
+                      _installation(payload))
+
+
+def _issue_comment(payload: Dict[str, Any], action: str) -> CommentEvent:
+    return CommentEvent(action, payload["issue"]["repository_url"], payload["repository"]["full_name"],
+                        int(payload["issue"]["number"]), payload["comment"]["body"] or "",
+                        payload["comment"].get("created_at") or "", _installation(payload))
+
+
+def _check_run(payload: Dict[str, Any], action: str) -> CheckRunEvent:
+    return CheckRunEvent(action, payload["check_run"]["name"])
+
+
+_decoders = {
+    "pull_request": _pull_request,
+    "check_suite": _check_suite,
+    "issue_comment": _issue_comment,
+    "check_run": _check_run,
+}
+
+
+def event_to_dict(event: WebhookEvent) -> Dict[str, Any]:
+    """The fields of an event record, e.g. to hand it to another process."""
+    return {field: getattr(event, field) for field in type(event).__slots__}
+
+
+def suite_event_from_dict(fields: Dict[str, Any]) -> SuiteEvent:
+    return SuiteEvent(**fields)
+
+
+def comment_event_from_dict(fields: Dict[str, Any]) -> CommentEvent:
+    return CommentEvent(**fields)
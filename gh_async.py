@@ -0,0 +1,302 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from typing import Any, Dict, List, Optional
+
+try:
+    import aiohttp
+except ImportError:  # only needed by the asyncio engine
+    aiohttp = None
+
+from bot_config import (
+    API_BASE_URL,
+    ASYNC_MAX_GITHUB_CALLS,
+    GH_HTTP_BACKOFF_FACTOR,
+    GH_HTTP_CONNECT_TIMEOUT,
+    GH_HTTP_POOL_MAXSIZE,
+    GH_HTTP_READ_TIMEOUT,
+    GH_HTTP_RETRIES,
+    GH_PAYLOAD_LOG_SAMPLE_RATE,
+    GH_RATE_LIMIT_RETRIES,
+    RATE_LIMIT_MAX_WAIT,
+)
+from gh_client import DEFAULT_HEADERS, SUPPORTED_METHODS, _RETRYABLE_METHODS, _RETRYABLE_STATUSES
+from gh_oauth_token import cached_token, retrieve_token
+from gh_utils import annotation_batches, check_run_payload
+from metrics import GITHUB_LATENCY, github_endpoint
+from rate_limiter import PRIORITY_LOW, PRIORITY_NORMAL, is_rate_limited, rate_limiter, retry_delay
+
+log = logging.getLogger(__name__)
+
+"""
+ASYNC GITHUB CALLS
+===================
+The `gh_client` / `gh_utils` calls the asyncio engine needs, on top of one
+`aiohttp.ClientSession`. The session keeps up to GH_HTTP_POOL_MAXSIZE kept-alive
+connections, and at most ASYNC_MAX_GITHUB_CALLS calls are in flight at a time.
+They share the rate limit budgets of the sync calls.
+
+Everything here must run on the engine's event loop (see `async_engine`).
+"""
+
+
+class AsyncResponse:
+    """The parts of a `requests.Response` the callers and `rate_limiter` look at."""
+    __slots__ = ("status_code", "headers", "text", "links")
+
+    def __init__(self, status_code: int, headers, text: str, links: Dict[str, Any]):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+        self.links = links
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+class AsyncGitHubClient:
+    def __init__(self, pool_maxsize: int = GH_HTTP_POOL_MAXSIZE, max_in_flight: int = ASYNC_MAX_GITHUB_CALLS,
+                 connect_timeout: float = GH_HTTP_CONNECT_TIMEOUT, read_timeout: float = GH_HTTP_READ_TIMEOUT,
+                 retries: int = GH_HTTP_RETRIES, backoff_factor: float = GH_HTTP_BACKOFF_FACTOR):
+        self.pool_maxsize = pool_maxsize
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+        # Created on the event loop, by the first request.
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      data: Any = None) -> AsyncResponse:
+        """Send a request through the shared session. 5xx answers to idempotent requests are retried with backoff,
+        like the sync client does.
+        """
+        method = method.upper()
+        if method not in SUPPORTED_METHODS:
+            raise ValueError(f"Invalid Request Method {method}.")
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers=DEFAULT_HEADERS,
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(connect=self.connect_timeout, sock_read=self.read_timeout),
+            )
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+
+        async with self._slots:
+            self.in_flight += 1
+            started = time.perf_counter()
+            status = "error"
+            try:
+                for attempt in range(self.retries + 1):
+                    async with self._session.request(method, url, headers=headers, data=data) as response:
+                        text = await response.text()
+                        links = {key: {"url": str(link["url"])} for key, link in response.links.items()}
+                        result = AsyncResponse(response.status, response.headers, text, links)
+                    status = result.status_code
+
+                    if result.status_code not in _RETRYABLE_STATUSES or method not in _RETRYABLE_METHODS \
+                            or attempt == self.retries:
+                        return result
+                    await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+            finally:
+                self.in_flight -= 1
+                GITHUB_LATENCY.labels(method, github_endpoint(url), status).observe(time.perf_counter() - started)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                }
+
+
+_client: Optional[AsyncGitHubClient] = None
+
+
+def get_async_github_client() -> AsyncGitHubClient:
+    """The engine's client. Only ever called from the engine's event loop, so no lock is needed."""
+    global _client
+
+    if _client is None:
+        _client = AsyncGitHubClient()
+    return _client
+
+
+async def make_github_rest_api_call_async(url: str = None, api_path: str = None, method: str = "GET",
+                                          params: Dict[str, Any] = None, priority: int = PRIORITY_NORMAL,
+                                          installation_id: str = None) -> Optional[AsyncResponse]:
+    """`gh_utils.make_github_rest_api_call` for the asyncio engine. Waiting for the rate limit budget
+    doesn't block the event loop. GETs aren't conditional.
+    """
+    # A refresh is a blocking HTTP call under a file lock; it mustn't stall the event loop.
+    token = cached_token(installation_id) or \
+        await asyncio.get_running_loop().run_in_executor(None, retrieve_token, installation_id)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    if not url:
+        url = f"{API_BASE_URL}/{api_path}"
+
+    data = json.dumps(params) if params is not None else None
+    log.info(f"sending {method.upper()} request to {url}")
+    if data and log.isEnabledFor(logging.DEBUG) and random.random() < GH_PAYLOAD_LOG_SAMPLE_RATE:
+        log.debug(f"{method.upper()} {url} payload: {data}")
+
+    budget = rate_limiter.budget(installation_id)
+    response = None
+    for attempt in range(GH_RATE_LIMIT_RETRIES + 1):
+        if not await _acquire(budget, priority):
+            log.warning(f"Dropping {method.upper()} request to {url}: rate limit budget exhausted.")
+            return None
+
+        try:
+            response = await get_async_github_client().request(
+                method,
+                url,
+                headers=headers,
+                data=data,
+            )
+        except Exception as e:
+            log.exception(f"Could not make a successful API call to GitHub: {e}")
+            return None
+
+        budget.update(response.headers)
+        if not is_rate_limited(response) or priority == PRIORITY_LOW:
+            return response
+
+        delay = retry_delay(response, attempt)
+        if delay > RATE_LIMIT_MAX_WAIT or attempt == GH_RATE_LIMIT_RETRIES:
+            break
+
+        log.warning(f"Rate limited by GitHub ({response.status_code}), retrying {url} in {delay:.1f}s.")
+        budget.pause(delay)
+
+    log.error(f"Giving up on {method.upper()} request to {url}: rate limited.")
+    return response
+
+
+async def _acquire(budget, priority: int, timeout: float = RATE_LIMIT_MAX_WAIT) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    while True:
+        wait = budget.try_acquire(priority)
+        if wait is None:
+            return False
+        if wait <= 0:
+            return True
+        if loop.time() + wait > deadline:
+            return False
+        await asyncio.sleep(wait)
+
+
+async def post_check_run_result_async(name: str,
+                                      head_sha: str,
+                                      check_status: str,
+                                      base_url: str,
+                                      check_conclusion: str = None,
+                                      output_title: str = None,
+                                      output_summary: str = None,
+                                      priority: int = PRIORITY_NORMAL,
+                                      installation_id: str = None) -> Optional[int]:
+    """Create a new check run on the given commit and return its ID."""
+    payload = dict(name=name, head_sha=head_sha,
+                   **check_run_payload(check_status, check_conclusion, output_title, output_summary))
+
+    response = await make_github_rest_api_call_async(url=f"{base_url}/check-runs", method='POST', params=payload,
+                                                     priority=priority, installation_id=installation_id)
+    try:
+        return response.json()["id"]
+    except Exception as e:
+        log.error(f"Failed to create check run: {e}")
+        return None
+
+
+async def update_check_run_async(base_url: str,
+                                 check_run_id: int,
+                                 check_status: str,
+                                 check_conclusion: str = None,
+                                 output_title: str = None,
+                                 output_summary: str = None,
+                                 priority: int = PRIORITY_NORMAL,
+                                 annotations: List[Dict[str, Any]] = None,
+                                 installation_id: str = None) -> bool:
+    """Update an existing check run in place."""
+    payload = check_run_payload(check_status, check_conclusion, output_title, output_summary, annotations)
+
+    response = await make_github_rest_api_call_async(url=f"{base_url}/check-runs/{check_run_id}", method='PATCH',
+                                                     params=payload, priority=priority,
+                                                     installation_id=installation_id)
+    if response is None or not response.ok:
+        log.error(f"Failed to update check run {check_run_id}.")
+        return False
+    return True
+
+
+async def post_check_run_annotations_async(base_url: str,
+                                           check_run_id: int,
+                                           check_status: str,
+                                           check_conclusion: str,
+                                           output_title: str,
+                                           output_summary: str,
+                                           annotations: List[Dict[str, Any]],
+                                           installation_id: str = None) -> int:
+    """`gh_utils.post_check_run_annotations` for the asyncio engine."""
+    sent = 0
+    for batch in annotation_batches(annotations):
+        sent += await update_check_run_async(base_url=base_url,
+                                             check_run_id=check_run_id,
+                                             check_status=check_status,
+                                             check_conclusion=check_conclusion,
+                                             output_title=output_title,
+                                             output_summary=output_summary,
+                                             annotations=batch,
+                                             installation_id=installation_id,
+                                             )
+    return sent
+
+
+async def post_pull_request_review_async(base_url: str, pul_number: int, body: str, comments: List[Dict[str, Any]],
+                                         commit_id: str = None, installation_id: str = None) -> None:
+    """Post a request change on the PR, with the given review comments."""
+    payload = {"event": "REQUEST_CHANGES",
+               "body": body,
+               "comments": comments}
+
+    if commit_id:
+        payload["commit_id"] = commit_id
+
+    await make_github_rest_api_call_async(url=f"{base_url}/pulls/{pul_number}/reviews", method='POST', params=payload,
+                                          installation_id=installation_id)
+
+
+async def get_pull_request_files_async(base_url: str, pull_number: int, per_page: int = 100,
+                                       installation_id: str = None) -> Optional[List[str]]:
+    """Get the paths of every file changed by the PR (all pages), or None if they can't be fetched."""
+    url = f"{base_url}/pulls/{pull_number}/files?per_page={per_page}"
+    files = []
+
+    while url:
+        response = await make_github_rest_api_call_async(url, installation_id=installation_id)
+        if response is None or not response.ok:
+            log.error(f"Failed to get changed files: {url}")
+            return None
+
+        files.extend(f["filename"] for f in response.json())
+        url = response.links.get("next", {}).get("url")
+
+    return files
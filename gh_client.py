@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+import requests
+
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Optional, Tuple
+from urllib3.util.retry import Retry
+
+from bot_config import (
+    GH_HTTP_BACKOFF_FACTOR,
+    GH_HTTP_CONNECT_TIMEOUT,
+    GH_HTTP_POOL_CONNECTIONS,
+    GH_HTTP_POOL_MAXSIZE,
+    GH_HTTP_READ_TIMEOUT,
+    GH_HTTP_RETRIES,
+)
+from metrics import GITHUB_LATENCY, github_endpoint
+
+log = logging.getLogger(__name__)
+
+"""
+GITHUB HTTP CLIENT
+===================
+One `requests.Session` shared by every thread, so calls to api.github.com reuse
+kept-alive connections instead of paying for a TCP and TLS handshake each time.
+urllib3 keeps a pool per host; the pool size should be at least the number of
+threads that talk to GitHub at the same time.
+"""
+
+DEFAULT_HEADERS: Dict[str, str] = {"Accept": "application/vnd.github.antiope-preview+json",
+                                   "Content-Type": "application/json",
+                                   "User-Agent": "early-signal-platform",
+                                   }
+
+SUPPORTED_METHODS = frozenset(["GET", "POST", "PATCH", "PUT", "DELETE"])
+
+# Requests that are safe to send again when GitHub answers with a 5xx.
+_RETRYABLE_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"])
+_RETRYABLE_STATUSES = (500, 502, 503, 504)
+
+
+def _build_retry(retries: int, backoff_factor: float) -> Retry:
+    kwargs = dict(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=_RETRYABLE_STATUSES,
+                  raise_on_status=False,
+                  )
+    try:
+        return Retry(allowed_methods=_RETRYABLE_METHODS, **kwargs)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=_RETRYABLE_METHODS, **kwargs)
+
+
+class GitHubClient:
+    def __init__(self,
+                 pool_connections: int = GH_HTTP_POOL_CONNECTIONS,
+                 pool_maxsize: int = GH_HTTP_POOL_MAXSIZE,
+                 timeout: Tuple[float, float] = (GH_HTTP_CONNECT_TIMEOUT, GH_HTTP_READ_TIMEOUT),
+                 retries: int = GH_HTTP_RETRIES,
+                 backoff_factor: float = GH_HTTP_BACKOFF_FACTOR):
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              max_retries=_build_retry(retries, backoff_factor),
+                              pool_block=False,
+                              )
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                data: Any = None, **kwargs: Any) -> requests.Response:
+        """Send a request through the shared connection pool.
+        `headers` are merged on top of `DEFAULT_HEADERS`.
+        """
+        method = method.upper()
+        if method not in SUPPORTED_METHODS:
+            raise ValueError(f"Invalid Request Method {method}.")
+
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, url, headers=headers, data=data, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            GITHUB_LATENCY.labels(method, github_endpoint(url), status).observe(time.perf_counter() - started)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_client: Optional[GitHubClient] = None
+_client_lock = threading.Lock()
+
+
+def get_github_client() -> GitHubClient:
+    """Return the process-wide GitHub client."""
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GitHubClient()
+
+    return _client
@@ -1,15 +1,28 @@
+import calendar
 import datetime
 import json
 import jwt
 import logging
 import os
-import requests
 import sys
+import threading
 import time
 import traceback
 import uuid
 
-from bot_config import API_BASE_URL
+from contextlib import contextmanager, nullcontext
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from typing import Any, Dict, Iterator, Optional, Union
+
+from bot_config import API_BASE_URL, GH_APP_ID, GH_TOKEN_PERSIST, GH_TOKEN_REFRESH_MARGIN
+from gh_client import get_github_client
+from metrics import TOKEN_REFRESHES
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single process only
+    fcntl = None
 
 log = logging.getLogger(__name__)
 
@@ -25,8 +38,16 @@ authentication and authorization w/ GitHub.
 
 # The paths of two things that should never be checked into git
 _token_storage_path = f'private/.secret'
+_token_lock_path = f'private/.secret.lock'
 _private_key_path = f'private/gh-app.key'
 
+_expires_at_format = "%Y-%m-%dT%H:%M:%SZ"  # "2019-09-16T19:04:13Z"
+
+# A cached token is handed out until it has less than this many seconds left.
+# The background refresh normally replaces it long before that.
+_min_token_lifetime = 60
+_refresh_retry_delay = 30
+
 
 def get_token(app_id, installation_id):
     """Get a token from GitHub."""
@@ -44,14 +65,15 @@ def get_token(app_id, installation_id):
 
     try:
         # Create a Json Web Token object with the required params.
-        encoded = jwt.encode(params, private_key,
-                             algorithm='RS256').decode("utf-8")
+        encoded = jwt.encode(params, private_key, algorithm='RS256')
+        if isinstance(encoded, bytes):  # PyJWT < 2
+            encoded = encoded.decode("utf-8")
         headers = {'Accept': 'application/vnd.github.machine-man-preview+json',
                    'Authorization': f'Bearer {encoded}'  # OAuth 2.0
                    }
 
         # Send request to GitHub.
-        response = requests.post(token_url, headers=headers)
+        response = get_github_client().request("POST", token_url, headers=headers)
 
     except Exception as exc:
         log.error(f"Could get token for App - {app_id}", exc)
@@ -66,86 +88,315 @@ def get_token(app_id, installation_id):
     return json.dumps(response_json)
 
 
-def store_token(token_json):
+def store_token(token_json: Union[str, Dict[str, Any]]):
+    """Cache the token returned by `get_token` (and persist it, if enabled)."""
     if token_json:
         try:
-            if os.path.exists(_token_storage_path):
-                os.unlink(_token_storage_path)
-
-            with open(_token_storage_path, 'w') as secret_file:
-                secret_file.write(json.dumps(token_json))
+            if isinstance(token_json, str):
+                token_json = json.loads(token_json)
+            _token_cache.put(token_json)
 
         except Exception as exc:
-            log.error(f'Could not write secret file.\n{exc}')
+            log.error(f'Could not store token.\n{exc}')
             traceback.print_exc(file=sys.stderr)
 
     else:
         log.error("Invalid (empty) token for app")
 
 
-def peek_app_token():
+@contextmanager
+def token_file_lock() -> Iterator[None]:
+    """Exclusive lock on the secret file, held across processes (e.g. `worker.py` processes)."""
+    if fcntl is None:
+        yield
+        return
+
+    with open(_token_lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_token_file(token_json: Dict[str, Any]):
+    """Persist the token so that it survives a restart."""
+    with token_file_lock():
+        _replace_token_file(token_json)
+
+
+def _replace_token_file(token_json: Dict[str, Any]):
+    """Write the secret file atomically: readers see either the old token or the new one, never a partial file.
+    The caller holds `token_file_lock`.
+    """
+    temp_path = f'{_token_storage_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'w') as secret_file:
+            secret_file.write(json.dumps(token_json))
+            secret_file.flush()
+            os.fsync(secret_file.fileno())
+        os.replace(temp_path, _token_storage_path)
+
+    except Exception as exc:
+        log.error(f'Could not write secret file.\n{exc}')
+        traceback.print_exc(file=sys.stderr)
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def peek_app_token() -> Optional[Dict[str, Any]]:
     """Peek on secret file that has the token, deserialize it and return the dict."""
     if not os.path.exists(_token_storage_path):
         return None
 
     try:
         with open(_token_storage_path) as secret_file:
-            return json.loads(secret_file.read())
+            token_json = json.loads(secret_file.read())
+
+        # Files written by older versions hold the JSON encoded twice.
+        if isinstance(token_json, str):
+            token_json = json.loads(token_json)
+        return token_json
 
     except Exception as exc:
         log.error(f'Could not read secret file.\n{exc}')
         traceback.print_exc(file=sys.stderr)
 
 
-def refresh_token():
-    """Refresh tokens of an individual app."""
-    try:
-        deserialized_message = json.loads(peek_app_token())
-        app_id = deserialized_message.get('app_id')
-        installation_id = deserialized_message.get('installation_id')
-        store_token(get_token(app_id, installation_id))
+class InstallationToken:
+    __slots__ = ("token", "expires_at", "app_id", "installation_id")
+
+    def __init__(self, token: str, expires_at: float, app_id: str, installation_id: str):
+        self.token = token
+        self.expires_at = expires_at  # epoch seconds
+        self.app_id = app_id
+        self.installation_id = installation_id
+
+    @classmethod
+    def from_json(cls, token_json: Dict[str, Any]) -> "InstallationToken":
+        expires_at = calendar.timegm(time.strptime(token_json["expires_at"], _expires_at_format))
+        return cls(token_json["token"], expires_at,
+                   str(token_json.get("app_id")), str(token_json.get("installation_id")))
+
+    def seconds_left(self) -> float:
+        return self.expires_at - time.time()
+
+
+class TokenCache:
+    """Installation tokens kept in memory, keyed by installation id.
+
+    Every token gets a timer that refreshes it `refresh_margin` seconds before it expires,
+    so callers almost never wait on GitHub. Refreshes of the same installation are
+    single-flight: concurrent callers wait for the one refresh in progress and reuse its token.
+    The secret file, when enabled, is read at start-up and written after each refresh. Processes sharing it
+    refresh under a file lock and adopt the token another process has just written instead of getting their own.
+    """
+
+    def __init__(self, refresh_margin: float = GH_TOKEN_REFRESH_MARGIN, persist: bool = GH_TOKEN_PERSIST):
+        self.refresh_margin = refresh_margin
+        self.persist = persist
+        self.refresh_count = 0
+
+        self._tokens: Dict[str, InstallationToken] = {}
+        self._default_installation: Optional[str] = None
+        self._lock = threading.Lock()
+        self._refresh_locks: Dict[str, threading.Lock] = {}
+        self._timers: Dict[str, threading.Timer] = {}
+        # Its own lock: loading puts the token, and `put` takes `_lock`.
+        self._load_lock = threading.Lock()
+        self._loaded = False
+
+    def get(self, installation_id: Optional[str] = None) -> Optional[str]:
+        """Return a valid token, refreshing it first only if the cached one is about to expire."""
+        self._load_persisted()
+
+        installation_id = str(installation_id) if installation_id else self._default_installation
+        if installation_id is None:
+            log.error("No installation token has been stored yet.")
+            return None
+
+        cached = self._tokens.get(installation_id)
+        if cached and cached.seconds_left() > _min_token_lifetime:
+            return cached.token
+
+        refreshed = self.refresh(installation_id)
+        return refreshed.token if refreshed else None
+
+    def peek(self, installation_id: Optional[str] = None) -> Optional[str]:
+        """The cached token if it's still valid, None when getting one would mean a refresh or a disk read."""
+        if not self._loaded:
+            return None
+        installation_id = str(installation_id) if installation_id else self._default_installation
+        cached = self._tokens.get(installation_id) if installation_id else None
+        if cached and cached.seconds_left() > _min_token_lifetime:
+            return cached.token
+        return None
+
+    def status(self) -> Optional[Dict[str, Any]]:
+        """The default installation and how long its cached token is still valid, or None without a token.
+        Nothing is refreshed or read from disk.
+        """
+        installation_id = self._default_installation
+        token = self._tokens.get(installation_id) if installation_id else None
+        if token is None:
+            return None
+        return {"installation_id": installation_id, "seconds_left": round(token.seconds_left())}
+
+    def put(self, token_json: Dict[str, Any], persist: bool = True) -> InstallationToken:
+        token = InstallationToken.from_json(token_json)
+
+        with self._lock:
+            self._tokens[token.installation_id] = token
+            self._default_installation = token.installation_id
+
+        self._schedule_refresh(token)
+        if persist and self.persist:
+            write_token_file(token_json)
+        return token
+
+    def refresh(self, installation_id: str) -> Optional[InstallationToken]:
+        """Get a new token from GitHub, unless another thread, or another process sharing the secret file, just did."""
+        with self._refresh_lock(installation_id), (token_file_lock() if self.persist else nullcontext()):
+            current = self._tokens.get(installation_id)
+            if current and current.seconds_left() > self.refresh_margin:
+                return current
+
+            shared = self._read_persisted(installation_id)
+            if shared:
+                TOKEN_REFRESHES.labels("adopted").inc()
+                return shared
+
+            app_id = current.app_id if current else GH_APP_ID
+            try:
+                token_json = json.loads(get_token(app_id, installation_id))
+                token = self.put(token_json, persist=False)
+                if self.persist:
+                    _replace_token_file(token_json)  # the file lock is already held
+                self.refresh_count += 1
+                TOKEN_REFRESHES.labels("refreshed").inc()
+                log.info(f"Refreshed token of installation {installation_id}.")
+                return token
+
+            except Exception as exc:
+                TOKEN_REFRESHES.labels("failed").inc()
+                log.error(f'Could not refresh token of installation {installation_id}.\n{exc}')
+                self._schedule(installation_id, _refresh_retry_delay)
+
+        if current and current.seconds_left() > 0:
+            return current
+        return None
+
+    def _read_persisted(self, installation_id: str) -> Optional[InstallationToken]:
+        """Adopt the token of the secret file if it's a fresh one for `installation_id`,
+        i.e. another process has just refreshed it.
+        """
+        token_json = peek_app_token() if self.persist else None
+        if not token_json or str(token_json.get("installation_id")) != installation_id:
+            return None
+
+        try:
+            if InstallationToken.from_json(token_json).seconds_left() <= self.refresh_margin:
+                return None
+            return self.put(token_json, persist=False)
+        except Exception as exc:
+            log.error(f'Ignoring unreadable secret file.\n{exc}')
+            return None
+
+    def _refresh_lock(self, installation_id: str) -> threading.Lock:
+        with self._lock:
+            return self._refresh_locks.setdefault(installation_id, threading.Lock())
+
+    def _schedule_refresh(self, token: InstallationToken) -> None:
+        delay = max(token.seconds_left() - self.refresh_margin, 0)
+        self._schedule(token.installation_id, delay)
+
+    def _schedule(self, installation_id: str, delay: float) -> None:
+        timer = threading.Timer(delay, self.refresh, args=(installation_id,))
+        timer.daemon = True
+
+        with self._lock:
+            previous = self._timers.get(installation_id)
+            if previous:
+                previous.cancel()
+            self._timers[installation_id] = timer
+        timer.start()
+
+    def _load_persisted(self) -> None:
+        """Read the secret file once. Callers arriving meanwhile wait for it, rather than finding no token."""
+        if self._loaded:
+            return
+
+        with self._load_lock:
+            if self._loaded:
+                return
+
+            token_json = peek_app_token() if self.persist else None
+            if token_json:
+                try:
+                    self.put(token_json, persist=False)
+                except Exception as exc:
+                    log.error(f'Ignoring unreadable secret file.\n{exc}')
+            self._loaded = True
+
+
+_token_cache = TokenCache()
+
+
+def refresh_token(installation_id: Optional[str] = None):
+    """Refresh the token of an installation (the last stored one by default)."""
+    installation_id = installation_id or _token_cache._default_installation
+    if installation_id:
+        _token_cache.refresh(str(installation_id))
+    else:
+        log.error("Could not refresh token: no installation known yet.")
 
-    except Exception as exc:
-        log.error(f'Could not refresh token.\n{exc}')
-        traceback.print_exc(file=sys.stderr)
 
+def token_status() -> Optional[Dict[str, Any]]:
+    """Validity of the cached installation token, for health checks."""
+    return _token_cache.status()
 
-def retrieve_token():
-    """Retrieve latest token. If expired, refresh it."""
+
+def cached_token(installation_id: Optional[str] = None) -> Optional[str]:
+    """The cached token when it can be had without blocking (e.g. on an event loop), else None."""
+    return _token_cache.peek(installation_id)
+
+
+def retrieve_token(installation_id: Optional[str] = None) -> Optional[str]:
+    """Retrieve latest token from memory. If it's about to expire, refresh it."""
     try:
-        deserialized_message = json.loads(peek_app_token())
-
-        expires_at = deserialized_message.get('expires_at')
-        # Token is good, return it
-        if expires_at and check_expired_time(expires_at):
-            return deserialized_message.get('token')
-        else:  # Token expired, refresh it
-            refresh_token()
-
-            deserialized_message = json.loads(peek_app_token())
-            expires_at = deserialized_message.get('expires_at')
-            # Token is good, return it
-            try:
-                assert(expires_at and check_expired_time(expires_at))
-                return deserialized_message.get('token')
-            except:
-                raise  # When all else fails
+        return _token_cache.get(installation_id)
 
     except Exception as exc:
-        log.error(f'Could not refresh token.\n{exc}')
+        log.error(f'Could not retrieve token.\n{exc}')
         traceback.print_exc(file=sys.stderr)
 
     return None
 
 
+_private_key = None
+_private_key_lock = threading.Lock()
+
+
 def get_private_key():
-    """Read private key from hidden file and return it."""
+    """Read and parse the private key the first time it's needed, then keep it in memory."""
+    global _private_key
+
+    if _private_key is None:
+        with _private_key_lock:
+            if _private_key is None:
+                _private_key = load_private_key()
+
+    return _private_key
+
+
+def load_private_key():
+    """Read private key from hidden file and return it, parsed."""
     if not os.path.exists(_private_key_path):
         return None
 
     try:
-        with open(_private_key_path) as secret_file:
-            return secret_file.read()
+        with open(_private_key_path, 'rb') as secret_file:
+            return serialization.load_pem_private_key(secret_file.read(), password=None, backend=default_backend())
 
     except Exception as exc:
         log.error(f'Could not read private key.\n{exc}')
@@ -154,7 +405,7 @@ def get_private_key():
 
 def check_expired_time(date_time_str, date_time_format=None, buffer=300):
     """Given a DateTime string, check if that time has expired while taking into account the buffer time."""
-    date_format = "%Y-%m-%dT%H:%M:%SZ"  # "2019-09-16T19:04:13Z"
+    date_format = date_time_format or _expires_at_format
     date_time_obj = datetime.datetime.strptime(date_time_str, date_format)
 
     return date_time_obj.timestamp() > datetime.datetime.utcnow().timestamp() + buffer
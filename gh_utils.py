@@ -1,16 +1,22 @@
 import json
 import logging
+import random
 import requests
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
 
+from etag_cache import response_cache
+from gh_client import get_github_client
 from gh_oauth_token import retrieve_token
-from bot_config import API_BASE_URL
+from bot_config import API_BASE_URL, GH_PAYLOAD_LOG_SAMPLE_RATE, GH_RATE_LIMIT_RETRIES, RATE_LIMIT_MAX_WAIT
+from constances import CHECK_RUN_ANNOTATIONS_PER_REQUEST
+from rate_limiter import PRIORITY_LOW, PRIORITY_NORMAL, is_rate_limited, rate_limiter, retry_delay
 
 log = logging.getLogger(__name__)
 
 
 def make_github_rest_api_call(url: str = None, api_path: str = None, method: str = "GET",
-                              params: Dict[str, Any] = None) -> requests.Response:
+                              params: Dict[str, Any] = None, priority: int = PRIORITY_NORMAL,
+                              installation_id: str = None) -> Optional[requests.Response]:
     """Send API call to Github using a personal token.
 
 Use this function to make API calls to the GitHub REST api
@@ -23,7 +29,7 @@ For example:
 me = make_github_rest_api_call("login")
 ```
 
-`POST` to create a comment on a PR
+`POST` to create a comment on a PR (`PATCH`, `PUT` and `DELETE` work the same way)
 ---
 ```py
 new_comment = make_github_rest_api_call(
@@ -33,39 +39,91 @@ new_comment = make_github_rest_api_call(
     }
 )
 ```
+
+Calls wait for the installation's rate limit budget (see `rate_limiter`). Rate limited
+responses are retried with backoff, except for `PRIORITY_LOW` calls, which are simply
+dropped (None is returned) when the quota runs low.
+
+GETs are conditional: when the resource hasn't changed, the cached response is returned
+(see `etag_cache`).
+
+Request payloads are logged at DEBUG level, for a GH_PAYLOAD_LOG_SAMPLE_RATE share of the calls.
     """
 
-    token = retrieve_token()
+    token = retrieve_token(installation_id)
 
-    # Required headers.
-    headers = {"Accept": "application/vnd.github.antiope-preview+json",
-               "Content-Type": "application/json",
-               "Authorization": f"Bearer {token}"
-               }
+    # Accept and Content-Type are session defaults of the shared client.
+    headers = {"Authorization": f"Bearer {token}"}
 
     # API url
     if not url:
         url = f"{API_BASE_URL}/{api_path}"
 
-    log.info(
-        f"sending {method.upper()} request to {url} w/ data {json.dumps(params)}")
-    try:
-        if method.upper() == "POST":
-            response = requests.post(
-                url,
-                headers=headers,
-                data=json.dumps(params),
-            )
-        elif method.upper() == "GET":
-            response = requests.get(
+    # The body is serialized once, for every attempt; the payload is only logged for a sample of the calls, at DEBUG.
+    data = json.dumps(params) if params is not None else None
+    log.info(f"sending {method.upper()} request to {url}")
+    if data and log.isEnabledFor(logging.DEBUG) and random.random() < GH_PAYLOAD_LOG_SAMPLE_RATE:
+        log.debug(f"{method.upper()} {url} payload: {data}")
+
+    cache_key = response_cache.key(url, installation_id) if method.upper() == "GET" else None
+    if cache_key:
+        headers.update(response_cache.conditional_headers(cache_key))
+
+    budget = rate_limiter.budget(installation_id)
+    response = None
+    for attempt in range(GH_RATE_LIMIT_RETRIES + 1):
+        if not budget.acquire(priority):
+            log.warning(f"Dropping {method.upper()} request to {url}: rate limit budget exhausted.")
+            return None
+
+        try:
+            response = get_github_client().request(
+                method,
                 url,
                 headers=headers,
+                data=data,
             )
-        else:
-            raise Exception("Invalid Request Method.")
-        return response
-    except Exception as e:
-        log.exception(f"Could not make a successful API call to GitHub: {e}")
+        except Exception as e:
+            log.exception(f"Could not make a successful API call to GitHub: {e}")
+            return None
+
+        budget.update(response.headers)
+        if not is_rate_limited(response) or priority == PRIORITY_LOW:
+            return response_cache.resolve(cache_key, response) if cache_key else response
+
+        delay = retry_delay(response, attempt)
+        if delay > RATE_LIMIT_MAX_WAIT or attempt == GH_RATE_LIMIT_RETRIES:
+            break
+
+        log.warning(f"Rate limited by GitHub ({response.status_code}), retrying {url} in {delay:.1f}s.")
+        budget.pause(delay)
+
+    log.error(f"Giving up on {method.upper()} request to {url}: rate limited.")
+    return response
+
+
+def check_run_payload(check_status: str,
+                      check_conclusion: str = None,
+                      output_title: str = None,
+                      output_summary: str = None,
+                      annotations: List[Dict[str, Any]] = None) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"status": check_status}
+
+    if check_conclusion:
+        payload['conclusion'] = check_conclusion
+
+    if output_title and output_summary:
+        payload['output'] = dict(title=output_title, summary=output_summary)
+        if annotations:
+            payload['output']['annotations'] = annotations
+
+    return payload
+
+
+def annotation_batches(annotations: List[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+    """Slices of at most CHECK_RUN_ANNOTATIONS_PER_REQUEST annotations, the most GitHub takes per call."""
+    for start in range(0, len(annotations), CHECK_RUN_ANNOTATIONS_PER_REQUEST):
+        yield annotations[start:start + CHECK_RUN_ANNOTATIONS_PER_REQUEST]
 
 
 def post_check_run_result(name: str,
@@ -74,39 +132,92 @@ def post_check_run_result(name: str,
                           base_url: str,
                           check_conclusion: str = None,
                           output_title: str = None,
-                          output_summary: str = None) -> None:
+                          output_summary: str = None,
+                          priority: int = PRIORITY_NORMAL,
+                          installation_id: str = None) -> Optional[int]:
+    """Create a new check run on the given commit and return its ID."""
     check_suite_url = f"{base_url}/check-runs"
-    payload = {
-        "name": name,
-        "head_sha": head_sha,
-        "status": check_status,
-    }
+    payload = dict(name=name, head_sha=head_sha,
+                   **check_run_payload(check_status, check_conclusion, output_title, output_summary))
 
-    if check_conclusion:
-        payload['conclusion'] = check_conclusion
+    response = make_github_rest_api_call(url=check_suite_url, method='POST', params=payload, priority=priority,
+                                         installation_id=installation_id)
+    try:
+        return response.json()["id"]
+    except Exception as e:
+        log.error(f"Failed to create check run: {e}")
+        return None
 
-    if output_title and output_summary:
-        payload['output'] = dict(title=output_title, summary=output_summary)
 
-    make_github_rest_api_call(url=check_suite_url, method='POST', params=payload)
+def update_check_run(base_url: str,
+                     check_run_id: int,
+                     check_status: str,
+                     check_conclusion: str = None,
+                     output_title: str = None,
+                     output_summary: str = None,
+                     priority: int = PRIORITY_NORMAL,
+                     annotations: List[Dict[str, Any]] = None,
+                     installation_id: str = None) -> bool:
+    """Update an existing check run in place.
+    Progress updates should be sent with `PRIORITY_LOW` and conclusions with `PRIORITY_HIGH`.
+    `annotations` are added to the ones the check run already has (at most CHECK_RUN_ANNOTATIONS_PER_REQUEST).
+    """
+    check_run_url = f"{base_url}/check-runs/{check_run_id}"
+    payload = check_run_payload(check_status, check_conclusion, output_title, output_summary, annotations)
+
+    response = make_github_rest_api_call(url=check_run_url, method='PATCH', params=payload, priority=priority,
+                                         installation_id=installation_id)
+    if response is None or not response.ok:
+        log.error(f"Failed to update check run {check_run_id}.")
+        return False
+    return True
 
 
-def post_pull_request_review(base_url: str, pul_number: int, body: str, path: str, position: int, comment_body: str) -> None:
-    """Post a request change on the PR for the most recent commit.
-    Note: commit_id is not specified means the review will refers to the most recent commit.
+def post_check_run_annotations(base_url: str,
+                               check_run_id: int,
+                               check_status: str,
+                               check_conclusion: str,
+                               output_title: str,
+                               output_summary: str,
+                               annotations: List[Dict[str, Any]],
+                               installation_id: str = None) -> int:
+    """Add annotations to a check run, one update per CHECK_RUN_ANNOTATIONS_PER_REQUEST of them (the output
+    has to be sent with each). Returns how many batches went through.
+    """
+    sent = 0
+    for batch in annotation_batches(annotations):
+        sent += update_check_run(base_url=base_url,
+                                 check_run_id=check_run_id,
+                                 check_status=check_status,
+                                 check_conclusion=check_conclusion,
+                                 output_title=output_title,
+                                 output_summary=output_summary,
+                                 annotations=batch,
+                                 installation_id=installation_id,
+                                 )
+    return sent
+
+
+def post_pull_request_review(base_url: str, pul_number: int, body: str, comments: List[Dict[str, Any]],
+                             commit_id: str = None, installation_id: str = None) -> None:
+    """Post a request change on the PR, with the given review comments (dicts of path, position and body).
+    Note: when commit_id is not specified the review will refers to the most recent commit.
     """
     check_suite_url = f"{base_url}/pulls/{pul_number}/reviews"
     payload = {"event": "REQUEST_CHANGES",
                "body": body,
-               "comments": [dict(path=path, position=position, body=comment_body)]}
+               "comments": comments}
+
+    if commit_id:
+        payload["commit_id"] = commit_id
 
-    make_github_rest_api_call(url=check_suite_url, method='POST', params=payload)
+    make_github_rest_api_call(url=check_suite_url, method='POST', params=payload, installation_id=installation_id)
 
 
-def get_latest_sha(base_url: str, pr_id: int) -> Optional[str]:
+def get_latest_sha(base_url: str, pr_id: int, installation_id: str = None) -> Optional[str]:
     """Get the SHA of the last commit of the PR with the given ID."""
     url = f"{base_url}/pulls/{pr_id}"
-    response = make_github_rest_api_call(url)
+    response = make_github_rest_api_call(url, installation_id=installation_id)
     try:
         return response.json()["head"]["sha"]
     except Exception as e:
@@ -114,13 +225,43 @@ def get_latest_sha(base_url: str, pr_id: int) -> Optional[str]:
         return None
 
 
-def get_check_runs(base_url: str, head_sha: str) -> List[Dict[str, Any]]:
-    """Get a list of check runs of the given head SHA."""
+def iterate_pages(url: str, key: str = None, per_page: int = 100, installation_id: str = None) -> Iterator[Any]:
+    """Yield the items of a paginated list endpoint, following the `Link: rel="next"` header.
+    `key` names the list in the response body, for endpoints that wrap it in an object.
+    Raises `IOError` when a page can't be fetched.
+    """
+    separator = "&" if "?" in url else "?"
+    url = f"{url}{separator}per_page={per_page}"
+
+    while url:
+        response = make_github_rest_api_call(url, installation_id=installation_id)
+        if response is None or not response.ok:
+            raise IOError(f"Failed to fetch {url}")
+
+        body = response.json()
+        yield from (body[key] if key else body)
+        url = response.links.get("next", {}).get("url")
+
+
+def get_pull_request_files(base_url: str, pull_number: int, installation_id: str = None) -> Optional[List[str]]:
+    """Get the paths of every file changed by the PR, or None if they can't be fetched."""
+    try:
+        return [f["filename"] for f in iterate_pages(f"{base_url}/pulls/{pull_number}/files",
+                                                     installation_id=installation_id)]
+    except Exception as e:
+        log.error(f"Failed to get changed files: {e}")
+        return None
+
+
+def get_check_runs(base_url: str, head_sha: str, status: str = None,
+                   installation_id: str = None) -> List[Dict[str, Any]]:
+    """Get every check run of the given head SHA (all pages), optionally only the ones with the given status."""
     check_runs_url = f"{base_url}/commits/{head_sha}/check-runs"
-    response = make_github_rest_api_call(check_runs_url)
+    if status:
+        check_runs_url += f"?status={status}"
 
     try:
-        return response.json()["check_runs"]
+        return list(iterate_pages(check_runs_url, key="check_runs", installation_id=installation_id))
     except Exception as e:
         log.error(f"Failed to get check runs: {e}")
         return []
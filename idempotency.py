@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+from bot_config import DEDUP_DELIVERY_TTL, DEDUP_MAX_SIZE, DEDUP_SUITE_TTL
+
+log = logging.getLogger(__name__)
+
+"""
+WEBHOOK DEDUPLICATION
+======================
+GitHub redelivers webhooks, and a PR being opened is often followed by a
+`check_suite` event for the same commit. Both would start a second suite for the
+same commit; the caches below remember what we've already seen for a while.
+"""
+
+
+class TTLCache:
+    """Size-capped LRU set whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key: Hashable) -> bool:
+        """Remember `key`. Returns False if it was already there (and not expired)."""
+        now = time.monotonic()
+
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self._entries.move_to_end(key)
+                return False
+
+            self._entries[key] = now + self.ttl
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class WebhookDeduplicator:
+    def __init__(self, delivery_ttl: float = DEDUP_DELIVERY_TTL, suite_ttl: float = DEDUP_SUITE_TTL,
+                 max_size: int = DEDUP_MAX_SIZE):
+        self._deliveries = TTLCache(delivery_ttl, max_size)
+        self._suites = TTLCache(suite_ttl, max_size)
+        self.checked = 0  # webhook deliveries looked at
+        self.hits = 0     # duplicates found, at either level
+
+    def is_duplicate_delivery(self, delivery_id: str) -> bool:
+        """True if this `X-GitHub-Delivery` id was already processed."""
+        self.checked += 1
+        if delivery_id and not self._deliveries.add(delivery_id):
+            self.hits += 1
+            return True
+        return False
+
+    def is_duplicate_suite(self, repository: str, head_sha: str, trigger: str) -> bool:
+        """True if the same trigger already asked for a suite of this commit a moment ago."""
+        if not self._suites.add((repository, head_sha, trigger)):
+            self.hits += 1
+            return True
+        return False
+
+    def forget_delivery(self, delivery_id: str) -> None:
+        """Let a delivery through again, e.g. after it was rejected for lack of capacity."""
+        if delivery_id:
+            self._deliveries.discard(delivery_id)
+
+    def forget_suite(self, repository: str, head_sha: str, trigger: str) -> None:
+        self._suites.discard((repository, head_sha, trigger))
+
+    def record_hit(self) -> None:
+        """Count a duplicate detected by other means (e.g. the suite of that commit is still running)."""
+        self.hits += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"checked": self.checked,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.checked, 4) if self.checked else 0.0,
+                "deliveries_tracked": len(self._deliveries),
+                "suites_tracked": len(self._suites),
+                }
+
+
+webhook_deduplicator = WebhookDeduplicator()
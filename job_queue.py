@@ -0,0 +1,184 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from bot_config import JOB_QUEUE_MAX_SIZE, JOB_QUEUE_SUBMIT_TIMEOUT, JOB_QUEUE_WORKERS
+
+log = logging.getLogger(__name__)
+
+"""
+BACKGROUND JOBS
+================
+Webhook deliveries must be acknowledged quickly (GitHub gives up after 10 seconds),
+so anything that talks to GitHub or waits on validations is handed off to this queue
+and executed by a fixed pool of worker threads.
+
+The queue is bounded: when it is full, `submit` raises `QueueFullError` so the caller
+can push back on the sender instead of piling up work in memory.
+"""
+
+
+class QueueFullError(Exception):
+    """Raised when a job can't be queued because the queue is at capacity."""
+
+
+class Job:
+    __slots__ = ("name", "func", "args", "kwargs", "enqueued_at")
+
+    def __init__(self, name: str, func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+
+    def run(self) -> None:
+        self.func(*self.args, **self.kwargs)
+
+
+class JobQueue:
+    def __init__(self, max_size: int = JOB_QUEUE_MAX_SIZE, workers: int = JOB_QUEUE_WORKERS, name: str = "jobs"):
+        self.max_size = max_size
+        self.workers = workers
+        self.name = name
+
+        self._jobs: Deque[Job] = deque()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+
+        # Counters, read through `stats()`.
+        self._busy = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-worker-{i}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+        log.info(f"Started {self.workers} {self.name} workers (queue size {self.max_size}).")
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop accepting jobs, let the workers drain what is already queued and exit."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def submit(self, func: Callable[..., Any], *args: Any, name: str = None,
+               timeout: float = JOB_QUEUE_SUBMIT_TIMEOUT, **kwargs: Any) -> None:
+        """Queue `func(*args, **kwargs)` to run on a worker.
+        Waits at most `timeout` seconds for room in the queue, then raises `QueueFullError`.
+        """
+        job = Job(name or getattr(func, "__name__", "job"), func, args, kwargs)
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            while len(self._jobs) >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._rejected += 1
+                    raise QueueFullError(f"{self.name} queue is full ({self.max_size} jobs).")
+                self._cond.wait(remaining)
+
+            self._jobs.append(job)
+            self._submitted += 1
+            self._cond.notify_all()
+
+    def depth(self) -> int:
+        return len(self._jobs)
+
+    def oldest_job_age(self) -> float:
+        """Seconds the oldest queued (not yet started) job has been waiting."""
+        with self._cond:
+            if not self._jobs:
+                return 0.0
+            return time.monotonic() - self._jobs[0].enqueued_at
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            oldest = time.monotonic() - self._jobs[0].enqueued_at if self._jobs else 0.0
+            return {"depth": len(self._jobs),
+                    "max_size": self.max_size,
+                    "oldest_job_age": round(oldest, 3),
+                    "workers": self.workers,
+                    "busy_workers": self._busy,
+                    "submitted": self._submitted,
+                    "completed": self._completed,
+                    "failed": self._failed,
+                    "rejected": self._rejected,
+                    }
+
+    def _next_job(self) -> Optional[Job]:
+        with self._cond:
+            while not self._jobs:
+                if not self._running:
+                    return None
+                self._cond.wait()
+
+            job = self._jobs.popleft()
+            self._busy += 1
+            # Wake up any submitter waiting for room.
+            self._cond.notify_all()
+            return job
+
+    def _work(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            wait_time = time.monotonic() - job.enqueued_at
+            log.debug(f"Running job {job.name} after waiting {wait_time:.3f}s")
+            failed = False
+            try:
+                job.run()
+            except Exception:
+                failed = True
+                log.exception(f"Job {job.name} failed.")
+
+            with self._cond:
+                self._busy -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+
+
+_job_queue: Optional[JobQueue] = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Return the process-wide job queue, starting its workers on first use."""
+    global _job_queue
+
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                job_queue = JobQueue()
+                job_queue.start()
+                _job_queue = job_queue
+
+    return _job_queue
+
+
+def peek_job_queue() -> Optional[JobQueue]:
+    """Return the job queue if something already started it, without starting it (for probes and gauges)."""
+    return _job_queue
@@ -0,0 +1,234 @@
+import re
+import threading
+
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+from urllib.parse import urlsplit
+
+"""
+METRICS
+========
+In-process counters, gauges and latency histograms, served in the Prometheus
+text format by the app's /metrics route.
+
+Recording is meant for hot paths: a labelled child is looked up in a dict and
+updated under its own lock, nothing is formatted until /metrics is scraped.
+Label values must come from small sets (event types, validation names, GitHub
+endpoints with their ids replaced, see `github_endpoint`).
+"""
+
+# Seconds; Prometheus' default buckets, plus a few for validations that run for minutes.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: object):
+        """The child of these label values (in `labelnames` order), created on first use."""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {key}.")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the counter of a metric without labels."""
+        self.labels().inc(amount)
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def _samples(self):
+        return [("_total", tuple(zip(self.labelnames, key)), child.value) for key, child in self._items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float) -> None:
+        """Observe a value of a metric without labels."""
+        self.labels().observe(value)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def _samples(self):
+        samples = []
+        for key, child in self._items():
+            labels = tuple(zip(self.labelnames, key))
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", labels + (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+class Gauge(_Metric):
+    """A value read when /metrics is scraped, from a callback of the module that owns it."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def _samples(self):
+        try:
+            return [("", (), float(self.callback()))]
+        except Exception:
+            return []
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, documentation, callback))
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+_REPOSITORY = re.compile(r"^/repos/[^/]+/[^/]+")
+_SHA = re.compile(r"/[0-9a-f]{40}(?=/|$)")
+_NUMBER = re.compile(r"/\d+(?=/|$)")
+
+
+def github_endpoint(url: str) -> str:
+    """The endpoint of a GitHub API URL without the repository, ids, SHAs and query,
+    e.g. /repos/{repo}/check-runs/{id}.
+    """
+    path = urlsplit(url).path or "/"
+    path = _REPOSITORY.sub("/repos/{repo}", path)
+    path = _SHA.sub("/{sha}", path)
+    return _NUMBER.sub("/{id}", path)
+
+
+metrics = MetricsRegistry()
+
+WEBHOOK_LATENCY = metrics.histogram("esp_webhook_duration_seconds",
+                                    "Time to handle a webhook delivery, by event and action.",
+                                    ("event", "action"))
+CHECK_QUEUE_WAIT = metrics.histogram("esp_check_queue_wait_seconds",
+                                     "Time a validation waited for a worker (or an engine slot).", ("validation",))
+CHECK_RUN_TIME = metrics.histogram("esp_check_run_seconds", "Run time of the validations that finished.",
+                                   ("validation",))
+CHECK_RESULTS = metrics.counter("esp_checks", "Finished validations, by status and whether the result was cached.",
+                                ("validation", "status", "cached"))
+GITHUB_LATENCY = metrics.histogram("esp_github_request_duration_seconds",
+                                   "GitHub API call latency, including transport retries, by endpoint and status.",
+                                   ("method", "endpoint", "status"))
+OVERRIDE_LATENCY = metrics.histogram("esp_override_seconds",
+                                     "Time from an ESPOVERRIDE comment to its failed check runs being neutralized.")
+TOKEN_REFRESHES = metrics.counter("esp_token_refreshes", "Installation token refreshes, by outcome.", ("outcome",))
+
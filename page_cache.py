@@ -0,0 +1,87 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from email.utils import formatdate
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from bot_config import PAGE_CACHE_CHECK_INTERVAL
+
+log = logging.getLogger(__name__)
+
+"""
+RENDERED PAGES
+===============
+Static pages (the welcome page renders README.md with markdown2) are rendered
+once and kept in memory, with an ETag and a Last-Modified date, so that probes
+and browsers hitting them cost a dict lookup, or a 304.
+
+A page is rendered again when one of the files it's made of has a new mtime.
+The files are stat'ed at most every PAGE_CACHE_CHECK_INTERVAL seconds.
+"""
+
+
+class RenderedPage:
+    __slots__ = ("body", "etag", "last_modified", "mtimes", "checked_at")
+
+    def __init__(self, body: str, mtimes: Tuple[Optional[float], ...]):
+        self.body = body
+        self.etag = hashlib.sha1(body.encode()).hexdigest()
+        self.last_modified = formatdate(max(filter(None, mtimes), default=time.time()), usegmt=True)
+        self.mtimes = mtimes
+        self.checked_at = time.monotonic()
+
+
+class PageCache:
+    def __init__(self, check_interval: float = PAGE_CACHE_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._pages: Dict[str, RenderedPage] = {}
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.hits = 0
+
+    def get(self, name: str, files: Sequence[str], render: Callable[[], str]) -> RenderedPage:
+        """The page `name`, rendered by `render()` if it isn't cached or if one of its `files` changed since."""
+        page = self._pages.get(name)
+        if page is not None:
+            if time.monotonic() - page.checked_at < self.check_interval:
+                self.hits += 1
+                return page
+            if _mtimes(files) == page.mtimes:
+                page.checked_at = time.monotonic()
+                self.hits += 1
+                return page
+
+        with self._lock:
+            # Render once, even when several requests find the page stale at the same time.
+            current = self._pages.get(name)
+            mtimes = _mtimes(files)
+            if current is not None and current is not page and current.mtimes == mtimes:
+                return current
+
+            page = RenderedPage(render(), mtimes)
+            self._pages[name] = page
+            self.renders += 1
+            log.info(f"Rendered the {name} page.")
+            return page
+
+    def stats(self) -> Dict[str, int]:
+        return {"pages": len(self._pages),
+                "renders": self.renders,
+                "hits": self.hits,
+                }
+
+
+def _mtimes(files: Sequence[str]) -> Tuple[Optional[float], ...]:
+    mtimes = []
+    for path in files:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+page_cache = PageCache()
@@ -0,0 +1,53 @@
+import logging
+
+from fnmatch import fnmatch
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from constances import language_file_patterns, validations
+
+log = logging.getLogger(__name__)
+
+"""
+CHANGE-AWARE PLANNING
+======================
+Validations tagged with a `language` only run when the PR touches files of that
+language. Validations without a `language` always run.
+"""
+
+
+def detect_languages(files: Iterable[str]) -> Set[str]:
+    """Languages of the given file paths, according to `language_file_patterns`."""
+    languages = set()
+    remaining = dict(language_file_patterns)
+
+    for path in files:
+        for language, patterns in list(remaining.items()):
+            if any(fnmatch(path, pattern) for pattern in patterns):
+                languages.add(language)
+                del remaining[language]
+
+        if not remaining:
+            break
+
+    return languages
+
+
+def plan_validations(files: Optional[List[str]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Split `validations` into the ones to run and the ones to skip for the changed `files`.
+    When the changed files are unknown (`None`), everything runs.
+    """
+    if files is None:
+        return list(validations), []
+
+    languages = detect_languages(files)
+    scheduled, skipped = [], []
+
+    for test in validations:
+        if "language" not in test or test["language"] in languages:
+            scheduled.append(test)
+        else:
+            skipped.append(test)
+
+    log.info(f"Changed files touch {sorted(languages) or 'no known language'}: "
+             f"running {len(scheduled)} validations, skipping {len(skipped)}.")
+    return scheduled, skipped
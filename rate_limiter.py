@@ -0,0 +1,223 @@
+import logging
+import random
+import threading
+import time
+
+from typing import Any, Dict, Mapping, Optional
+
+from bot_config import (
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_DEFAULT_RATE,
+    RATE_LIMIT_HIGH_RESERVE,
+    RATE_LIMIT_LOW_RESERVE,
+    RATE_LIMIT_MAX_WAIT,
+)
+
+log = logging.getLogger(__name__)
+
+"""
+GITHUB RATE LIMITS
+===================
+Every GitHub call takes a token from the bucket of its installation first. The
+bucket refills at the pace that spreads the remaining quota (from the
+X-RateLimit-* response headers) until the quota resets, and stops completely
+while GitHub asks us to back off (Retry-After, secondary rate limits).
+
+Calls have a priority lane. When the quota runs low, low priority calls
+(intermediate progress updates) are shed first, then normal ones are held
+until the reset, so that conclusions and overrides still get through.
+"""
+
+PRIORITY_HIGH = 0      # final check run conclusions, override neutralizations
+PRIORITY_NORMAL = 1    # everything else
+PRIORITY_LOW = 2       # intermediate progress updates, safe to drop
+
+_PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+
+class InstallationBudget:
+    def __init__(self, burst: int = RATE_LIMIT_BURST, default_rate: float = RATE_LIMIT_DEFAULT_RATE):
+        self.burst = burst
+        self.default_rate = default_rate
+
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at: Optional[float] = None
+        self.paused_until = 0.0
+
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._waiting = {priority: 0 for priority in _PRIORITIES}
+        self._cond = threading.Condition()
+
+        self.shed = 0
+        self.delayed = 0
+
+    def acquire(self, priority: int = PRIORITY_NORMAL, timeout: float = RATE_LIMIT_MAX_WAIT) -> bool:
+        """Wait for permission to send a call. Returns False when the call should be dropped instead."""
+        deadline = time.monotonic() + timeout
+        waited = False
+
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    if priority == PRIORITY_LOW and self._below_reserve(RATE_LIMIT_LOW_RESERVE):
+                        self.shed += 1
+                        return False
+
+                    wait = self._wait_time(priority)
+                    if wait <= 0:
+                        self._tokens -= 1
+                        if waited:
+                            self.delayed += 1
+                        return True
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+
+                    waited = True
+                    self._cond.wait(min(wait, remaining))
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def try_acquire(self, priority: int = PRIORITY_NORMAL) -> Optional[float]:
+        """Non-blocking `acquire` for the asyncio engine: 0 when the call may go now, the seconds to wait
+        before trying again, or None when the call should be dropped.
+        """
+        with self._cond:
+            if priority == PRIORITY_LOW and self._below_reserve(RATE_LIMIT_LOW_RESERVE):
+                self.shed += 1
+                return None
+
+            wait = self._wait_time(priority)
+            if wait <= 0:
+                self._tokens -= 1
+                return 0
+            return wait
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """Track the quota reported by GitHub in a response."""
+        with self._cond:
+            try:
+                if "X-RateLimit-Limit" in headers:
+                    self.limit = int(headers["X-RateLimit-Limit"])
+                if "X-RateLimit-Remaining" in headers:
+                    self.remaining = int(headers["X-RateLimit-Remaining"])
+                if "X-RateLimit-Reset" in headers:
+                    self.reset_at = float(headers["X-RateLimit-Reset"])
+            except ValueError:
+                log.warning("Ignoring malformed rate limit headers.")
+
+            self._cond.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """Stop all calls for `seconds`, e.g. after a Retry-After."""
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self._cond.notify_all()
+
+    def _below_reserve(self, reserve: float) -> bool:
+        if self.remaining is None or not self.limit:
+            return False
+        if self.reset_at is not None and self.reset_at <= time.time():
+            return False  # the quota has been reset since we last heard
+        return self.remaining <= self.limit * reserve
+
+    def _refill_rate(self) -> float:
+        if self.remaining is None or self.reset_at is None:
+            return self.default_rate
+        return max(self.remaining, 1) / max(self.reset_at - time.time(), 1)
+
+    def _wait_time(self, priority: int) -> float:
+        """Seconds this priority has to wait before it may take a token, 0 if it may go now."""
+        now = time.time()
+        if self.paused_until > now:
+            return self.paused_until - now
+
+        # Below the high reserve, only high priority calls get through until the reset.
+        if priority != PRIORITY_HIGH and self._below_reserve(RATE_LIMIT_HIGH_RESERVE):
+            return max(self.reset_at - now, 0.1) if self.reset_at else 1.0
+        if self.remaining == 0 and self.reset_at and self.reset_at > now:
+            return self.reset_at - now
+
+        # Higher priority lanes go first.
+        if any(self._waiting[higher] for higher in _PRIORITIES[:priority]):
+            return 0.05
+
+        monotonic = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (monotonic - self._refilled_at) * self._refill_rate())
+        self._refilled_at = monotonic
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._refill_rate()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"limit": self.limit,
+                    "remaining": self.remaining,
+                    "reset_at": self.reset_at,
+                    "paused_for": round(max(self.paused_until - time.time(), 0), 3),
+                    "waiting": dict(self._waiting),
+                    "shed": self.shed,
+                    "delayed": self.delayed,
+                    }
+
+
+class RateLimiter:
+    def __init__(self):
+        self._budgets: Dict[str, InstallationBudget] = {}
+        self._lock = threading.Lock()
+
+    def budget(self, installation_id: Optional[str] = None) -> InstallationBudget:
+        key = str(installation_id or "default")
+        with self._lock:
+            budget = self._budgets.get(key)
+            if budget is None:
+                budget = self._budgets[key] = InstallationBudget()
+            return budget
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            budgets = dict(self._budgets)
+        return {key: budget.stats() for key, budget in budgets.items()}
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = RATE_LIMIT_MAX_WAIT) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_rate_limited(response) -> bool:
+    """True for 429s and for 403s caused by the primary or secondary rate limit."""
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    if response.headers.get("Retry-After") or response.headers.get("X-RateLimit-Remaining") == "0":
+        return True
+    return "rate limit" in response.text.lower()
+
+
+def retry_delay(response, attempt: int) -> float:
+    """How long to wait before retrying a rate limited response."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            pass
+
+    if response.headers.get("X-RateLimit-Remaining") == "0" and response.headers.get("X-RateLimit-Reset"):
+        try:
+            return max(float(response.headers["X-RateLimit-Reset"]) - time.time(), 0) + random.uniform(0, 1)
+        except ValueError:
+            pass
+
+    return backoff_delay(attempt, base=5)
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from bot_config import RESULT_CACHE_DB, RESULT_CACHE_SIZE
+
+log = logging.getLogger(__name__)
+
+"""
+VALIDATION RESULT CACHE
+========================
+A validation gives the same answer for the same content, so results are cached by
+(validation name, tree SHA - or head SHA when the tree isn't known -, validation
+config version). A re-requested suite for an unchanged commit then finishes at once.
+pull_request deliveries don't carry the tree SHA, so results are stored under both
+the tree and the head SHA when the tree is known, and looked up under both.
+
+Results live in an in-memory LRU. When RESULT_CACHE_DB is set they are also written
+to SQLite, so they survive restarts.
+"""
+
+ResultKey = Tuple[str, str, str]  # (validation name, tree or head SHA, config version)
+
+
+def validation_config_version(validation: Dict[str, Any]) -> str:
+    """Fingerprint of a validation's configuration; changing the config invalidates its cached results."""
+    return hashlib.sha1(json.dumps(validation, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class CachedResult:
+    __slots__ = ("status", "link")
+
+    def __init__(self, status: str, link: str):
+        self.status = status
+        self.link = link
+
+
+class ResultCache:
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE, db_path: Optional[str] = RESULT_CACHE_DB):
+        self.max_size = max_size
+        self._results: "OrderedDict[ResultKey, CachedResult]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                             "name TEXT, sha TEXT, version TEXT, status TEXT, link TEXT, created_at REAL, "
+                             "PRIMARY KEY (name, sha, version))")
+            self._db.commit()
+
+    def get(self, key: ResultKey) -> Optional[CachedResult]:
+        return self.lookup((key,))
+
+    def lookup(self, keys: Sequence[ResultKey]) -> Optional[CachedResult]:
+        """The result stored under the first of `keys` that has one, counted as a single hit or miss."""
+        with self._lock:
+            result = None
+            for key in keys:
+                result = self._find(key)
+                if result is not None:
+                    break
+
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def _find(self, key: ResultKey) -> Optional[CachedResult]:
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute("SELECT status, link FROM results WHERE name = ? AND sha = ? AND version = ?",
+                                   key).fetchone()
+            if row:
+                result = CachedResult(*row)
+                self._remember(key, result)
+        return result
+
+    def put(self, key: ResultKey, status: str, link: str) -> None:
+        result = CachedResult(status, link)
+
+        with self._lock:
+            self._remember(key, result)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                                     (*key, status, link, time.time()))
+                    self._db.commit()
+                except sqlite3.Error as exc:
+                    log.error(f"Could not persist result of {key[0]}: {exc}")
+
+    def _remember(self, key: ResultKey, result: CachedResult) -> None:
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._results),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from bot_config import (
+    SHARED_QUEUE_DB,
+    SHARED_QUEUE_LEASE_TIMEOUT,
+    SHARED_QUEUE_MAX_ATTEMPTS,
+    SHARED_QUEUE_MAX_SIZE,
+    SHARED_QUEUE_OWNER_TTL,
+    SHARED_QUEUE_POLL_INTERVAL,
+)
+from job_queue import QueueFullError
+
+log = logging.getLogger(__name__)
+
+"""
+SHARED JOB QUEUE
+=================
+Lets several processes (`worker.py`) share the work of one or more web
+processes, so that throughput scales with cores instead of being capped by the
+GIL of a single process.
+
+Jobs are rows in a SQLite database (WAL mode). A worker leases the oldest job
+it may run, hands it to its handler and acks it once the work is over: a suite
+job when the suite has sent its conclusion, not when it's queued in-process.
+The worker renews the leases of its jobs in flight meanwhile; a job whose lease
+runs out without an ack (the worker died) is leased again, up to
+SHARED_QUEUE_MAX_ATTEMPTS times.
+
+Every job of a PR carries the PR as its key. The first worker to lease a job of
+a PR becomes its owner and keeps renewing the ownership while the PR has a suite
+in flight, so the other workers leave that PR's jobs alone. That way a new
+commit always lands on the worker that can cancel the suite it supersedes, and
+duplicate requests meet the same deduplication cache.
+"""
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, key TEXT, payload TEXT, state TEXT, "
+    "lease_owner TEXT, lease_expires REAL, available_at REAL, attempts INTEGER, enqueued_at REAL)",
+    "CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, available_at)",
+    "CREATE TABLE IF NOT EXISTS owners (key TEXT PRIMARY KEY, worker TEXT, expires REAL)",
+)
+
+# Queued jobs that are due, and leased jobs whose worker didn't ack in time, except the ones of a PR that
+# another live worker owns.
+_NEXT_JOB = (
+    "SELECT id, kind, key, payload, attempts FROM jobs "
+    "WHERE ((state = 'queued' AND available_at <= :now) OR (state = 'leased' AND lease_expires < :now)) "
+    "AND (key IS NULL OR NOT EXISTS "
+    "(SELECT 1 FROM owners WHERE owners.key = jobs.key AND owners.worker != :worker AND owners.expires > :now)) "
+    "ORDER BY id LIMIT 1"
+)
+
+# Handles a job's payload; returns a future of the work it started, if it doesn't end with the call.
+Handler = Callable[[Dict[str, Any]], Optional[Future]]
+
+
+class LeasedJob:
+    __slots__ = ("id", "kind", "key", "payload", "attempts")
+
+    def __init__(self, job_id: int, kind: str, key: Optional[str], payload: Dict[str, Any], attempts: int):
+        self.id = job_id
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SharedJobQueue:
+    def __init__(self, db_path: str = SHARED_QUEUE_DB, max_size: int = SHARED_QUEUE_MAX_SIZE,
+                 lease_timeout: float = SHARED_QUEUE_LEASE_TIMEOUT, owner_ttl: float = SHARED_QUEUE_OWNER_TTL,
+                 max_attempts: int = SHARED_QUEUE_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.lease_timeout = lease_timeout
+        self.owner_ttl = owner_ttl
+        self.max_attempts = max_attempts
+
+        # One connection per process, shared by its threads. `isolation_level=None` lets us BEGIN IMMEDIATE,
+        # which takes the write lock up front so that two workers can't lease the same job.
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.acked = 0
+        self.retried = 0
+        self.dead = 0
+
+    def submit(self, kind: str, payload: Dict[str, Any], key: Optional[str] = None) -> None:
+        """Queue a job for any worker. Raises `QueueFullError` when SHARED_QUEUE_MAX_SIZE jobs are waiting."""
+        now = time.time()
+        with self._transaction() as db:
+            (queued,) = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()
+            if queued >= self.max_size:
+                raise QueueFullError(f"Shared queue is full ({self.max_size} jobs).")
+
+            db.execute("INSERT INTO jobs (kind, key, payload, state, available_at, attempts, enqueued_at) "
+                       "VALUES (?, ?, ?, 'queued', ?, 0, ?)", (kind, key, json.dumps(payload), now, now))
+        self.submitted += 1
+
+    def lease(self, worker: str) -> Optional[LeasedJob]:
+        """Take the next job this worker may run, making it the owner of the job's PR."""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(_NEXT_JOB, {"now": now, "worker": worker}).fetchone()
+            if row is None:
+                return None
+
+            job_id, kind, key, payload, attempts = row
+            if attempts >= self.max_attempts:
+                db.execute("UPDATE jobs SET state = 'dead' WHERE id = ?", (job_id,))
+                self.dead += 1
+                log.error(f"Giving up on {kind} job {job_id} after {attempts} attempts.")
+                return None
+
+            db.execute("UPDATE jobs SET state = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                       "WHERE id = ?", (worker, now + self.lease_timeout, job_id))
+            if key is not None:
+                db.execute("INSERT OR REPLACE INTO owners VALUES (?, ?, ?)", (key, worker, now + self.owner_ttl))
+
+        return LeasedJob(job_id, kind, key, json.loads(payload), attempts + 1)
+
+    def ack(self, job: LeasedJob, worker: str) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM jobs WHERE id = ? AND lease_owner = ?", (job.id, worker))
+        self.acked += 1
+
+    def release(self, job: LeasedJob, worker: str, delay: float, failed: bool = True) -> None:
+        """Give a job back, to be leased again in `delay` seconds. Unless it `failed`, the attempt doesn't count."""
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = 'queued', lease_owner = NULL, available_at = ?, attempts = attempts - ? "
+                       "WHERE id = ? AND lease_owner = ?", (time.time() + delay, 0 if failed else 1, job.id, worker))
+        self.retried += 1
+
+    def renew_leases(self, worker: str, job_ids: Iterable[int]) -> None:
+        """Keep the jobs this worker is still running from being leased again."""
+        expires = time.time() + self.lease_timeout
+        with self._transaction() as db:
+            db.executemany("UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ?",
+                           [(expires, job_id, worker) for job_id in job_ids])
+
+    def renew_ownership(self, worker: str, keys: Iterable[str]) -> None:
+        """Keep owning the PRs this worker still has suites for; the others lapse after SHARED_QUEUE_OWNER_TTL."""
+        expires = time.time() + self.owner_ttl
+        with self._transaction() as db:
+            db.executemany("UPDATE owners SET expires = ? WHERE key = ? AND worker = ?",
+                           [(expires, key, worker) for key in keys])
+            db.execute("DELETE FROM owners WHERE expires < ?", (time.time(),))
+
+    def consume(self, handlers: Dict[str, Handler], owned_keys: Callable[[], Iterable[str]],
+                stop: threading.Event, poll_interval: float = SHARED_QUEUE_POLL_INTERVAL) -> None:
+        """Lease and handle jobs until `stop` is set. A handler raising `QueueFullError` gets its job back
+        a bit later; any other exception, or a future that fails, counts as a failed attempt. Jobs still in
+        flight when `stop` is set aren't acked, so that another worker runs them once their lease runs out.
+        """
+        worker = worker_id()
+        renewed_at = 0.0
+        in_flight: Dict[int, Tuple[LeasedJob, Future]] = {}
+        log.info(f"Worker {worker} consuming {self.db_path}.")
+
+        while not stop.is_set():
+            if time.monotonic() - renewed_at > min(self.owner_ttl, self.lease_timeout) / 3:
+                self.renew_ownership(worker, owned_keys())
+                self.renew_leases(worker, list(in_flight))
+                renewed_at = time.monotonic()
+
+            for job, done in [item for item in in_flight.values() if item[1].done()]:
+                del in_flight[job.id]
+                self._settle(job, worker, done.exception())
+
+            job = self.lease(worker)
+            if job is None:
+                stop.wait(poll_interval)
+                continue
+
+            try:
+                done = handlers[job.kind](job.payload)
+            except QueueFullError as exc:
+                log.warning(f"Postponing {job.kind} job {job.id}: {exc}")
+                self.release(job, worker, delay=1, failed=False)
+                continue
+            except Exception:
+                log.exception(f"{job.kind} job {job.id} failed (attempt {job.attempts}).")
+                self.release(job, worker, delay=min(2 ** job.attempts, 60))
+                continue
+
+            if done is None:
+                self.ack(job, worker)
+            else:
+                in_flight[job.id] = (job, done)
+
+    def _settle(self, job: LeasedJob, worker: str, error: Optional[BaseException]) -> None:
+        if error is None:
+            self.ack(job, worker)
+            return
+
+        log.error(f"{job.kind} job {job.id} failed (attempt {job.attempts}): {error!r}")
+        self.release(job, worker, delay=min(2 ** job.attempts, 60))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            (owners,) = self._db.execute("SELECT COUNT(*) FROM owners WHERE expires > ?", (time.time(),)).fetchone()
+        return {"queued": counts.get("queued", 0),
+                "leased": counts.get("leased", 0),
+                "dead": counts.get("dead", 0),
+                "owned_pulls": owners,
+                "submitted": self.submitted,
+                "acked": self.acked,
+                "retried": self.retried,
+                }
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """`BEGIN IMMEDIATE` ... `COMMIT` (or `ROLLBACK` on error), one thread of the process at a time."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+
+def pull_key(repository: str, pull_number: int) -> str:
+    return f"{repository}#{pull_number}"
+
+
+_shared_queue: Optional[SharedJobQueue] = None
+_shared_queue_lock = threading.Lock()
+
+
+def get_shared_queue() -> Optional[SharedJobQueue]:
+    """Return the process' handle on the shared queue, or None when SHARED_QUEUE_DB isn't set."""
+    global _shared_queue
+
+    if not SHARED_QUEUE_DB:
+        return None
+
+    if _shared_queue is None:
+        with _shared_queue_lock:
+            if _shared_queue is None:
+                _shared_queue = SharedJobQueue()
+
+    return _shared_queue
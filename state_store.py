@@ -0,0 +1,228 @@
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot_config import SUITE_STATE_DB, SUITE_STATE_FLUSH_INTERVAL
+from constances import CHECK_RUN_STATUS_COMPLETED
+
+log = logging.getLogger(__name__)
+
+"""
+SUITE STATE STORE
+==================
+Suites, their finished checks, check run ids and conclusions are written to
+SQLite (WAL mode), so that:
+- on startup, the suites a restart interrupted can be resumed or closed instead
+  of leaving their check runs `in_progress` forever;
+- an ESPOVERRIDE comment finds the PR's latest check run here, without reading
+  the PR and its check runs back from GitHub.
+
+Writes are queued and committed by a background thread every
+SUITE_STATE_FLUSH_INTERVAL seconds, one transaction per batch. Reads flush the
+queue first, so they always see the writes made before them.
+"""
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS suites ("
+    "repository TEXT, head_sha TEXT, pull_number INTEGER, base_url TEXT, trigger TEXT, tree_sha TEXT, "
+    "check_run_id INTEGER, status TEXT, conclusion TEXT, summary TEXT, created_at REAL, updated_at REAL, "
+    "installation_id TEXT, PRIMARY KEY (repository, head_sha))",
+    "CREATE INDEX IF NOT EXISTS suites_by_pull ON suites (repository, pull_number, created_at)",
+    "CREATE INDEX IF NOT EXISTS suites_by_status ON suites (status)",
+    "CREATE TABLE IF NOT EXISTS checks ("
+    "repository TEXT, head_sha TEXT, name TEXT, status TEXT, link TEXT, updated_at REAL, "
+    "PRIMARY KEY (repository, head_sha, name))",
+)
+
+_UPSERT_SUITE = (
+    "INSERT INTO suites VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (repository, head_sha) DO UPDATE SET "
+    "pull_number = excluded.pull_number, base_url = excluded.base_url, trigger = excluded.trigger, "
+    "tree_sha = excluded.tree_sha, check_run_id = COALESCE(excluded.check_run_id, check_run_id), "
+    "status = excluded.status, conclusion = excluded.conclusion, summary = COALESCE(excluded.summary, summary), "
+    "updated_at = excluded.updated_at, installation_id = COALESCE(excluded.installation_id, installation_id)"
+)
+
+# Columns added since the first version of the schema, for the stores created before them.
+_ADDED_COLUMNS = (("suites", "installation_id", "TEXT"),)
+
+_UPSERT_CHECK = "INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?, ?)"
+
+_UPDATE_CONCLUSION = "UPDATE suites SET status = ?, conclusion = ?, updated_at = ? WHERE repository = ? AND head_sha = ?"
+
+_SUITE_COLUMNS = ("repository, head_sha, pull_number, base_url, trigger, tree_sha, check_run_id, status, conclusion, "
+                  "summary, created_at, updated_at, installation_id")
+
+
+class SuiteRecord:
+    __slots__ = ("repository", "head_sha", "pull_number", "base_url", "trigger", "tree_sha", "check_run_id", "status",
+                 "conclusion", "summary", "created_at", "updated_at", "installation_id")
+
+    def __init__(self, repository: str, head_sha: str, pull_number: Optional[int], base_url: str, trigger: str,
+                 tree_sha: str, check_run_id: Optional[int], status: str, conclusion: str, summary: Optional[str],
+                 created_at: float, updated_at: float, installation_id: Optional[str] = None):
+        self.repository = repository
+        self.head_sha = head_sha
+        self.pull_number = pull_number
+        self.base_url = base_url
+        self.trigger = trigger
+        self.tree_sha = tree_sha
+        self.check_run_id = check_run_id
+        self.status = status
+        self.conclusion = conclusion
+        self.summary = summary
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.installation_id = installation_id
+
+
+class StateStore:
+    def __init__(self, db_path: Optional[str] = SUITE_STATE_DB, flush_interval: float = SUITE_STATE_FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+
+        self._pending: List[Tuple[str, tuple]] = []
+        self._pending_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                for statement in _SCHEMA:
+                    self._db.execute(statement)
+                for table, column, column_type in _ADDED_COLUMNS:
+                    if column not in {row[1] for row in self._db.execute(f"PRAGMA table_info({table})")}:
+                        self._db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                self._db.commit()
+            except sqlite3.Error as exc:
+                log.error(f"Could not open the suite state store {db_path}, running without it: {exc}")
+                self._db = None
+
+        if self._db is not None:
+            threading.Thread(target=self._flush_periodically, name="state-store-writer", daemon=True).start()
+            atexit.register(self.close)
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def save_suite(self, suite, status: str, conclusion: str = "", summary: Optional[str] = None) -> None:
+        """Queue the current state of a `ProcessCheckRun`."""
+        if not self.enabled:
+            return
+
+        now = time.time()
+        self._queue(_UPSERT_SUITE, (suite.suite_key[0], suite.head_sha, suite.pull_number, suite.base_url,
+                                    suite.trigger, suite.tree_sha, suite.check_run_id, status, conclusion or "",
+                                    summary, now, now, suite.installation_id))
+
+    def save_check(self, suite, check) -> None:
+        """Queue the result of a finished check."""
+        if not self.enabled:
+            return
+
+        self._queue(_UPSERT_CHECK, (suite.suite_key[0], suite.head_sha, check.name, check.status, check.link,
+                                    time.time()))
+
+    def update_conclusion(self, repository: str, head_sha: str, status: str, conclusion: str) -> None:
+        if not self.enabled:
+            return
+
+        self._queue(_UPDATE_CONCLUSION, (status, conclusion, time.time(), repository, head_sha))
+
+    def latest_suite(self, repository: str, pull_number: int) -> Optional[SuiteRecord]:
+        """The suite of the most recent commit of a PR that we know of."""
+        rows = self._select(f"SELECT {_SUITE_COLUMNS} FROM suites WHERE repository = ? AND pull_number = ? "
+                            f"ORDER BY created_at DESC LIMIT 1", (repository, pull_number))
+        return SuiteRecord(*rows[0]) if rows else None
+
+    def unfinished_suites(self) -> List[SuiteRecord]:
+        """Suites whose check run was never completed, oldest first."""
+        rows = self._select(f"SELECT {_SUITE_COLUMNS} FROM suites WHERE status != ? ORDER BY created_at",
+                            (CHECK_RUN_STATUS_COMPLETED,))
+        return [SuiteRecord(*row) for row in rows]
+
+    def finished_checks(self, repository: str, head_sha: str) -> Dict[str, Tuple[str, str]]:
+        """Status and link of the checks of a suite that had finished, by name."""
+        rows = self._select("SELECT name, status, link FROM checks WHERE repository = ? AND head_sha = ?",
+                            (repository, head_sha))
+        return {name: (status, link) for name, status, link in rows}
+
+    def flush(self) -> None:
+        """Commit the queued writes now, as one transaction."""
+        # Batches are taken and committed under the same lock, so that they land in order.
+        with self._db_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            if not pending or self._db is None:
+                return
+            try:
+                with self._db:
+                    for statement, params in pending:
+                        self._db.execute(statement, params)
+                self.batches += 1
+                self.writes += len(pending)
+            except sqlite3.Error as exc:
+                self.errors += 1
+                log.error(f"Could not write {len(pending)} suite state change(s): {exc}")
+
+    def close(self) -> None:
+        if not self.enabled or self._closed:
+            return
+
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"enabled": self.enabled,
+                "pending": pending,
+                "batches": self.batches,
+                "writes": self.writes,
+                "errors": self.errors,
+                }
+
+    def _queue(self, statement: str, params: tuple) -> None:
+        with self._pending_lock:
+            self._pending.append((statement, params))
+
+    def _select(self, query: str, params: tuple) -> List[tuple]:
+        if not self.enabled:
+            return []
+
+        self.flush()
+        with self._db_lock:
+            if self._db is None:
+                return []
+            try:
+                return self._db.execute(query, params).fetchall()
+            except sqlite3.Error as exc:
+                log.error(f"Could not read the suite state store: {exc}")
+                return []
+
+    def _flush_periodically(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            if not self._closed:
+                self.flush()
+
+
+state_store = StateStore()
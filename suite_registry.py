@@ -0,0 +1,58 @@
+import logging
+import threading
+
+from typing import Any, Dict, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+"""
+IN-FLIGHT SUITES
+=================
+Keeps track of the check suite currently running for each pull request, so that
+a push of a new commit can cancel the suite of the commit it replaces.
+"""
+
+SuiteKey = Tuple[str, int]  # (repository full name, pull request number)
+
+
+class SuiteRegistry:
+    def __init__(self):
+        self._suites: Dict[SuiteKey, Any] = {}
+        self._lock = threading.Lock()
+        self.superseded_count = 0
+
+    def register(self, suite) -> Optional[Any]:
+        """Make `suite` the current one of its PR and return the suite it replaces, if any.
+        The caller is responsible for cancelling the returned suite.
+        """
+        key = suite.suite_key
+        with self._lock:
+            previous = self._suites.get(key)
+            self._suites[key] = suite
+
+            if previous is None or previous is suite:
+                return None
+            self.superseded_count += 1
+            return previous
+
+    def unregister(self, suite) -> None:
+        """Forget a finished suite, unless a newer one already took its place."""
+        with self._lock:
+            if self._suites.get(suite.suite_key) is suite:
+                del self._suites[suite.suite_key]
+
+    def get(self, repository: str, pull_number: int) -> Optional[Any]:
+        return self._suites.get((repository, pull_number))
+
+    def keys(self) -> List[SuiteKey]:
+        with self._lock:
+            return list(self._suites)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"in_flight": len(self._suites),
+                    "superseded": self.superseded_count,
+                    }
+
+
+suite_registry = SuiteRegistry()
@@ -0,0 +1,447 @@
+import asyncio
+import base64
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import requests
+
+from bot_config import (
+    VALIDATION_BACKEND,
+    VALIDATION_BACKENDS,
+    VALIDATION_CPU_LIMIT,
+    VALIDATION_GIT_URL,
+    VALIDATION_JOB_API_TOKEN,
+    VALIDATION_JOB_API_URL,
+    VALIDATION_JOB_POLL_INTERVAL,
+    VALIDATION_JOB_POLL_MAX_INTERVAL,
+    VALIDATION_LOG_LINES,
+    VALIDATION_MEMORY_LIMIT_MB,
+    VALIDATION_TIMEOUT,
+    VALIDATION_WORKSPACE_DIR,
+    VALIDATION_WORKSPACE_KEEP,
+)
+from constances import CHECK_STATUS_CANCELLED, CHECK_STATUS_FAILURE, CHECK_STATUS_SUCCESS, validations_by_name
+from gh_oauth_token import retrieve_token
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+if TYPE_CHECKING:
+    from checks import Check
+
+log = logging.getLogger(__name__)
+
+"""
+VALIDATION BACKENDS
+====================
+Where a check's validation actually runs. `Check.process_check` hands the check
+to the backend of its validation and applies the `ValidationResult` it gets back
+to the check's status, link, details and annotations.
+
+    simulated   waits for the validation's `estimate_time` (the default)
+    subprocess  runs the validation's `command` in a checkout of the head commit,
+                keeping the last VALIDATION_LOG_LINES lines of its output
+    http        submits a job to VALIDATION_JOB_API_URL and polls it, with backoff
+
+VALIDATION_BACKEND picks the backend of every validation, VALIDATION_BACKENDS
+overrides it for some (e.g. "flake8=subprocess,mypy=subprocess"). Every run is
+bounded by the validation's `timeout` (VALIDATION_TIMEOUT by default) and stops
+as soon as the suite is cancelled.
+
+The asyncio engine awaits the simulated backend on its loop; the other backends
+block, so it runs them on the loop's default thread pool.
+"""
+
+# Longer output lines are cut, so that the log buffer's size is bounded by lines and length.
+_MAX_LINE_LENGTH = 1000
+
+# The only variables of the bot's environment a validation command gets.
+_INHERITED_ENV = ("PATH", "LANG", "LC_ALL", "TZ", "TMPDIR")
+
+# Most annotations taken from one run's output.
+_MAX_ANNOTATIONS = 1000
+
+# "path:line: message" or "path:line:column: message", as printed by flake8, mypy, pylint --output-format=parseable...
+_LOCATION = re.compile(r"^(?P<path>[^:\s][^:]*):(?P<line>\d+):(?:\d+:)?\s*(?P<message>.+)$")
+
+# Job states of the HTTP job API that end a job.
+_JOB_DONE = {"success": CHECK_STATUS_SUCCESS, "failure": CHECK_STATUS_FAILURE, "error": CHECK_STATUS_FAILURE,
+             "cancelled": CHECK_STATUS_CANCELLED}
+
+
+class ValidationResult:
+    __slots__ = ("status", "link", "details", "annotations", "review_comments", "cacheable")
+
+    def __init__(self, status: str, link: str = "", details: str = "",
+                 annotations: Sequence[Dict[str, Any]] = (), review_comments: Sequence[Dict[str, Any]] = (),
+                 cacheable: bool = True):
+        self.status = status
+        self.link = link
+        self.details = details  # markdown for the check run summary
+        self.annotations = annotations
+        self.review_comments = review_comments
+        # False for infrastructure failures (timeouts, kills, job errors): a re-run may well pass.
+        self.cacheable = cacheable
+
+
+class ValidationBackend:
+    name = ""
+
+    def run(self, check: "Check") -> ValidationResult:
+        """Run the check's validation; returns early with a cancelled result when `check.cancel_event` is set."""
+        raise NotImplementedError
+
+    async def run_async(self, check: "Check", cancelled: asyncio.Event) -> ValidationResult:
+        """`run` for the asyncio engine. The suite's cancellation sets `check.cancel_event` too, which `run` watches."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.run, check)
+
+
+class SimulatedBackend(ValidationBackend):
+    """Waits for the validation's estimated time, then passes or fails as the suite's test variable says."""
+    name = "simulated"
+
+    def run(self, check: "Check") -> ValidationResult:
+        # imitate the delay each test would take before getting the result is back.
+        if check.cancel_event.wait(check.get_process_time()):
+            return ValidationResult(CHECK_STATUS_CANCELLED)
+        return self.result(check)
+
+    async def run_async(self, check: "Check", cancelled: asyncio.Event) -> ValidationResult:
+        """The wait holds no thread, `cancelled` cuts it short."""
+        try:
+            await asyncio.wait_for(cancelled.wait(), check.get_process_time())
+            return ValidationResult(CHECK_STATUS_CANCELLED)
+        except asyncio.TimeoutError:
+            return self.result(check)
+
+    @staticmethod
+    def result(check: "Check") -> ValidationResult:
+        if check._result:
+            return ValidationResult(CHECK_STATUS_SUCCESS, check.get_link())
+
+        # request changes when the check fails; the suite posts them in a single review.
+        return ValidationResult(CHECK_STATUS_FAILURE, check.get_link(),
+                                annotations=[dict(path="README.md", start_line=1, end_line=1,
+                                                  annotation_level="failure", title=check.name,
+                                                  message="This needs to be fixed.")],
+                                review_comments=[dict(path="README.md", position=1,
+                                                      body=f"{check.name}: This needs to be fixed.")])
+
+
+class LogBuffer:
+    """The last `max_lines` lines of a run's output, each cut to _MAX_LINE_LENGTH characters."""
+    __slots__ = ("lines", "total")
+
+    def __init__(self, max_lines: int = VALIDATION_LOG_LINES):
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+        self.total = 0
+
+    def append(self, line: str) -> None:
+        self.lines.append(line[:_MAX_LINE_LENGTH])
+        self.total += 1
+
+    def tail(self) -> str:
+        dropped = self.total - len(self.lines)
+        header = f"[{dropped} earlier line(s) not kept]\n" if dropped else ""
+        return header + "\n".join(self.lines)
+
+
+class SubprocessBackend(ValidationBackend):
+    """Runs the validation's `command` (an argument list) in a checkout of the suite's head commit.
+    Exit code 0 is a success. Output lines that point at a file and line become annotations.
+    """
+    name = "subprocess"
+
+    def __init__(self, workspaces: Optional["Workspaces"] = None):
+        self.workspaces = workspaces or Workspaces()
+
+    def run(self, check: "Check") -> ValidationResult:
+        test = validations_by_name.get(check.name) or {}
+        command = test.get("command")
+        if not command:
+            raise ValueError(f"Validation {check.name} has no command to run.")
+
+        with self.workspaces.checkout(check.suite.suite_key[0], check.head_sha,
+                                      check.suite.installation_id) as workspace:
+            if check.cancel_event.is_set():
+                return ValidationResult(CHECK_STATUS_CANCELLED)
+            return self._run_command(check, command, workspace, test.get("timeout", VALIDATION_TIMEOUT),
+                                     test.get("cpu_limit", VALIDATION_CPU_LIMIT))
+
+    def _run_command(self, check: "Check", command: List[str], workspace: str, timeout: float,
+                     cpu_limit: int) -> ValidationResult:
+        output = LogBuffer()
+        annotations: List[Dict[str, Any]] = []
+
+        process = subprocess.Popen(command, cwd=workspace, env=_command_env(workspace), stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                                   errors="replace", start_new_session=True)
+        _limit(process.pid, cpu_limit)
+
+        def read() -> None:
+            for line in process.stdout:
+                line = line.rstrip("\n")
+                output.append(line)
+                if len(annotations) < _MAX_ANNOTATIONS:
+                    annotation = _annotation(check.name, line)
+                    if annotation:
+                        annotations.append(annotation)
+
+        reader = threading.Thread(target=read, name=f"log-{check.name}", daemon=True)
+        reader.start()
+
+        deadline = time.monotonic() + timeout
+        outcome = None
+        while process.poll() is None:
+            if check.cancel_event.wait(0.2):
+                outcome = CHECK_STATUS_CANCELLED
+            elif time.monotonic() > deadline:
+                outcome = "timeout"
+            else:
+                continue
+            _kill(process)
+        reader.join(timeout=5)
+        process.stdout.close()
+
+        if outcome == CHECK_STATUS_CANCELLED:
+            return ValidationResult(CHECK_STATUS_CANCELLED)
+
+        # Timeouts and kills aren't cached, the next run may well get the time or CPU it needs.
+        cacheable = False
+        if outcome == "timeout":
+            log.warning(f"{check.name} timed out after {timeout:g}s.")
+            reason = f"Timed out after {timeout:g}s."
+        elif process.returncode == -signal.SIGXCPU or process.returncode == -signal.SIGKILL:
+            reason = f"Stopped by the CPU time limit ({cpu_limit}s)." if cpu_limit else "Killed."
+        elif process.returncode == 0:
+            return ValidationResult(CHECK_STATUS_SUCCESS)
+        else:
+            reason = f"Exited with code {process.returncode}."
+            cacheable = True
+
+        details = f"{reason}\n\n```\n{output.tail()}\n```" if output.total else reason
+        return ValidationResult(CHECK_STATUS_FAILURE, details=details, annotations=annotations, cacheable=cacheable)
+
+
+class HttpJobBackend(ValidationBackend):
+    """Runs the validation as a job of an external task API:
+
+        POST   {VALIDATION_JOB_API_URL}/jobs       {validation, repository, head_sha, tree_sha, pull_number}
+        GET    {VALIDATION_JOB_API_URL}/jobs/{id}  {id, status, link, summary}
+        DELETE {VALIDATION_JOB_API_URL}/jobs/{id}  when the suite is cancelled or the job times out
+
+    where status is one of queued, running, success, failure, error or cancelled. The job is polled every
+    VALIDATION_JOB_POLL_INTERVAL seconds at first, backing off to VALIDATION_JOB_POLL_MAX_INTERVAL.
+    """
+    name = "http"
+
+    def __init__(self, base_url: str = VALIDATION_JOB_API_URL, token: str = VALIDATION_JOB_API_TOKEN):
+        if not base_url:
+            raise ValueError("The http validation backend needs VALIDATION_JOB_API_URL.")
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def run(self, check: "Check") -> ValidationResult:
+        test = validations_by_name.get(check.name) or {}
+        timeout = test.get("timeout", VALIDATION_TIMEOUT)
+
+        response = self.session.post(f"{self.base_url}/jobs", timeout=10,
+                                     json={"validation": check.name,
+                                           "repository": check.suite.suite_key[0],
+                                           "head_sha": check.head_sha,
+                                           "tree_sha": check.suite.tree_sha,
+                                           "pull_number": check.pull_number,
+                                           })
+        response.raise_for_status()
+        job = response.json()
+        log.info(f"Submitted {check.name} as job {job['id']}.")
+
+        deadline = time.monotonic() + timeout
+        interval = VALIDATION_JOB_POLL_INTERVAL
+        while job.get("status") not in _JOB_DONE:
+            if check.cancel_event.wait(min(interval, max(deadline - time.monotonic(), 0))):
+                self._cancel(job)
+                return ValidationResult(CHECK_STATUS_CANCELLED)
+            if time.monotonic() >= deadline:
+                log.warning(f"{check.name} (job {job['id']}) timed out after {timeout:g}s.")
+                self._cancel(job)
+                return ValidationResult(CHECK_STATUS_FAILURE, job.get("link", ""),
+                                        details=f"Timed out after {timeout:g}s.", cacheable=False)
+
+            interval = min(interval * 1.5, VALIDATION_JOB_POLL_MAX_INTERVAL)
+            try:
+                response = self.session.get(f"{self.base_url}/jobs/{job['id']}", timeout=10)
+                response.raise_for_status()
+                job = response.json()
+            except (requests.RequestException, ValueError) as exc:
+                # The job keeps running; a flaky API only delays the result, until the timeout.
+                log.warning(f"Could not poll job {job['id']} of {check.name}: {exc}")
+
+        return ValidationResult(_JOB_DONE[job["status"]], job.get("link", ""), details=job.get("summary") or "",
+                                cacheable=job["status"] != "error")
+
+    def _cancel(self, job: Dict[str, Any]) -> None:
+        try:
+            self.session.delete(f"{self.base_url}/jobs/{job['id']}", timeout=10)
+        except requests.RequestException as exc:
+            log.warning(f"Could not cancel job {job['id']}: {exc}")
+
+
+class _Workspace:
+    __slots__ = ("path", "users", "ready", "lock")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.users = 0
+        self.ready = False
+        self.lock = threading.Lock()
+
+
+class Workspaces:
+    """Checkouts of head commits under `root`, one per (repository, head SHA), shared by the suite's checks.
+    The `keep` most recently used are kept; older ones are deleted once no check uses them.
+    """
+
+    def __init__(self, root: str = VALIDATION_WORKSPACE_DIR, keep: int = VALIDATION_WORKSPACE_KEEP):
+        self.root = root
+        self.keep = keep
+        self._workspaces: "OrderedDict[Tuple[str, str], _Workspace]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, repository: str, head_sha: str, installation_id: Optional[str] = None) -> Iterator[str]:
+        """The path of a checkout of `head_sha`, fetched on first use with the installation's token."""
+        key = (repository, head_sha)
+        with self._lock:
+            workspace = self._workspaces.get(key)
+            if workspace is None:
+                workspace = self._workspaces[key] = _Workspace(os.path.join(self.root, repository, head_sha))
+            self._workspaces.move_to_end(key)
+            workspace.users += 1
+
+        try:
+            with workspace.lock:
+                if not workspace.ready:
+                    self._fetch(repository, head_sha, workspace.path, installation_id)
+                    workspace.ready = True
+            yield workspace.path
+        finally:
+            with self._lock:
+                workspace.users -= 1
+                stale = self._evict()
+            for path in stale:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _evict(self) -> List[str]:
+        stale = []
+        for key, workspace in list(self._workspaces.items()):
+            if len(self._workspaces) <= self.keep:
+                break
+            if workspace.users == 0:
+                del self._workspaces[key]
+                stale.append(workspace.path)
+        return stale
+
+    @staticmethod
+    def _fetch(repository: str, head_sha: str, path: str, installation_id: Optional[str] = None) -> None:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+        # The token goes in an extra header from the environment, so it's neither in the command line nor in .git/config.
+        env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+        token = retrieve_token(installation_id)
+        if token:
+            credentials = base64.b64encode(f"x-access-token:{token}".encode()).decode()
+            env.update(GIT_CONFIG_COUNT="1", GIT_CONFIG_KEY_0="http.extraHeader",
+                       GIT_CONFIG_VALUE_0=f"Authorization: Basic {credentials}")
+
+        url = VALIDATION_GIT_URL.format(repository=repository)
+        log.info(f"Checking out {repository}@{head_sha} in {path}.")
+        for command in (["git", "init", "-q"],
+                        ["git", "fetch", "-q", "--depth", "1", url, head_sha],
+                        ["git", "checkout", "-q", "--detach", "FETCH_HEAD"]):
+            subprocess.run(command, cwd=path, env=env, check=True, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=VALIDATION_TIMEOUT)
+
+
+def _limit(pid: int, cpu_limit: int) -> None:
+    """Cap the CPU time and address space of a started process. Set from the parent rather than in a preexec_fn,
+    which isn't safe with threads; CPU time used before is counted anyway.
+    """
+    if resource is None or not hasattr(resource, "prlimit"):
+        return
+    try:
+        if cpu_limit:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+        if VALIDATION_MEMORY_LIMIT_MB:
+            memory = VALIDATION_MEMORY_LIMIT_MB * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory, memory))
+    except (OSError, ValueError) as exc:
+        log.warning(f"Could not limit the resources of process {pid}: {exc}")
+
+
+def _command_env(workspace: str) -> Dict[str, str]:
+    """The environment of a validation command. It runs tools on the PR's code (a mypy plugin, a setup.cfg...),
+    so it gets none of the bot's secrets: only _INHERITED_ENV, with the checkout as its home.
+    """
+    env = {name: os.environ[name] for name in _INHERITED_ENV if name in os.environ}
+    env["HOME"] = workspace
+    return env
+
+
+def _kill(process: subprocess.Popen) -> None:
+    """Kill the command and whatever it started."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+
+
+def _annotation(title: str, line: str) -> Optional[Dict[str, Any]]:
+    match = _LOCATION.match(line)
+    if not match:
+        return None
+    path = match.group("path")
+    path = path[2:] if path.startswith("./") else path
+    number = int(match.group("line"))
+    return dict(path=path, start_line=number, end_line=number, annotation_level="failure", title=title,
+                message=match.group("message"))
+
+
+_BACKENDS = {backend.name: backend for backend in (SimulatedBackend, SubprocessBackend, HttpJobBackend)}
+_instances: Dict[str, ValidationBackend] = {}
+_instances_lock = threading.Lock()
+
+
+def backend_name(validation: str) -> str:
+    """Name of the backend that runs a validation."""
+    return VALIDATION_BACKENDS.get(validation, VALIDATION_BACKEND)
+
+
+def get_validation_backend(validation: str) -> ValidationBackend:
+    """The process-wide instance of the backend of a validation, created on first use."""
+    name = backend_name(validation)
+    backend = _instances.get(name)
+    if backend is None:
+        if name not in _BACKENDS:
+            raise ValueError(f"Unknown validation backend {name!r} for {validation}.")
+        with _instances_lock:
+            backend = _instances.get(name)
+            if backend is None:
+                backend = _instances[name] = _BACKENDS[name]()
+    return backend
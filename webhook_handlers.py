@@ -1,6 +1,20 @@
 import logging
+import time
 
-from checks import ProcessCheckRun, neutralize_latest_check_suite
+from concurrent.futures import Future
+from typing import Optional
+
+from async_engine import AsyncProcessCheckRun, async_engine_enabled, get_async_engine
+from bot_config import SUITE_STATE_RESUME_MAX_AGE
+from checks import ProcessCheckRun, comment_contains_override_string, neutralize_latest_check_suite
+from events import CommentEvent, SuiteEvent, comment_event_from_dict, event_to_dict, suite_event_from_dict
+from idempotency import webhook_deduplicator
+from job_queue import get_job_queue
+from shared_queue import get_shared_queue, pull_key
+from gh_utils import update_check_run
+from state_store import state_store
+from suite_registry import suite_registry
+from constances import CHECK_RUN_STATUS_COMPLETED, CHECK_RUN_TITLE_INTERRUPTED, CHECK_STATUS_CANCELLED
 
 """
 SPECIALIZED WEBHOOK HANDLERS 
@@ -15,14 +29,143 @@ This is a good place for these specialized handlers
 log = logging.getLogger(__name__)
 
 
-def check_suite_request_handler(webhook):
-    """Directly create check runs though CheckSuite class right here.
-       We might be able to add a logic to kill existing CheckSuite (from previous hash) before kicking off a new one.
+def check_suite_request_handler(event: SuiteEvent, force_rerun=False):
+    """Queue the check suite so that the webhook can be acknowledged right away.
+       In multi-process mode it goes to the shared queue, for the worker that owns the PR.
+       Raises `QueueFullError` when there's no room for more work.
+    """
+    if event.pull_number is None:
+        log.info(f"Ignore check suite of {event.repository_full_name} {event.head_sha}: not part of a PR.")
+        return
+
+    shared_queue = get_shared_queue()
+    if shared_queue:
+        shared_queue.submit("suite", {"event": event_to_dict(event), "force_rerun": force_rerun},
+                            key=pull_key(event.repository_full_name, event.pull_number))
+        return
+
+    start_check_suite(event, force_rerun)
+
+
+def start_check_suite(event: SuiteEvent, force_rerun=False, check_run_id=None):
+    """Queue the check suite on this process' job queue, or asyncio engine.
+       The suite still running for the previous commit of the same PR, if any, is cancelled.
+       Requests for a commit whose suite was just requested or is still running are dropped.
+       With `force_rerun`, cached validation results are ignored. With `check_run_id`, an interrupted
+       suite is resumed on its existing check run.
+       Returns the queued suite, None when the request was dropped.
+       Raises `QueueFullError` when there's no room for more work.
+    """
+    repository, pull_number, trigger = event.repository_full_name, event.pull_number, event.trigger
+
+    if webhook_deduplicator.is_duplicate_suite(repository, event.head_sha, trigger):
+        log.info(f"Ignore duplicate {trigger} request for {repository} {event.head_sha}.")
+        return None
+
+    running = suite_registry.get(repository, pull_number)
+    if running and running.head_sha == event.head_sha and not running.cancelled:
+        webhook_deduplicator.record_hit()
+        log.info(f"Suite of {repository} {event.head_sha} is already running, attaching to it.")
+        return None
+
+    engine = get_async_engine() if async_engine_enabled() else None
+    if engine:
+        check_suite = AsyncProcessCheckRun(event, force_rerun=force_rerun, engine=engine)
+    else:
+        check_suite = ProcessCheckRun(event, force_rerun=force_rerun)
+    check_suite.check_run_id = check_run_id
+    superseded = suite_registry.register(check_suite)
+
+    try:
+        if engine:
+            engine.submit_suite(check_suite)
+        else:
+            get_job_queue().submit(check_suite.start, name=f"check suite {check_suite.head_sha}")
+    except Exception:
+        suite_registry.unregister(check_suite)
+        webhook_deduplicator.forget_suite(repository, event.head_sha, trigger)
+        raise
+
+    if superseded:
+        superseded.cancel()
+    return check_suite
+
+
+def check_suite_override_handler(event: CommentEvent):
+    """Override the check runs so that the PR can be merged.
+       Comments without the override string are ignored before any work is queued.
+       Raises `QueueFullError` when there's no room for more work.
     """
-    check_suite = ProcessCheckRun(webhook)
-    check_suite.start()
+    if not comment_contains_override_string(event.body):
+        log.debug(f"Ignore the comment.")
+        return
+
+    shared_queue = get_shared_queue()
+    if shared_queue:
+        shared_queue.submit("override", {"event": event_to_dict(event)},
+                            key=pull_key(event.repository_full_name, event.issue_number))
+        return
+
+    get_job_queue().submit(neutralize_latest_check_suite, event, name="override")
+
+
+def resume_unfinished_suites():
+    """Pick up the suites a restart interrupted, as recorded in the suite state store.
+       Recent ones are queued again on their existing check run; the others have their check run closed.
+    """
+    shared_queue = get_shared_queue()
+
+    for record in state_store.unfinished_suites():
+        if record.pull_number is None or time.time() - record.updated_at > SUITE_STATE_RESUME_MAX_AGE:
+            log.info(f"Closing interrupted suite of {record.repository} {record.head_sha}.")
+            if record.check_run_id:
+                update_check_run(base_url=record.base_url,
+                                 check_run_id=record.check_run_id,
+                                 check_status=CHECK_RUN_STATUS_COMPLETED,
+                                 check_conclusion=CHECK_STATUS_CANCELLED,
+                                 output_title=CHECK_RUN_TITLE_INTERRUPTED,
+                                 output_summary=record.summary or "",
+                                 installation_id=record.installation_id,
+                                 )
+            state_store.update_conclusion(record.repository, record.head_sha, CHECK_RUN_STATUS_COMPLETED,
+                                          CHECK_STATUS_CANCELLED)
+            continue
+
+        log.info(f"Resuming interrupted suite of {record.repository} {record.head_sha}.")
+        event = SuiteEvent(record.trigger, "resumed", record.base_url, record.repository, record.head_sha,
+                           record.tree_sha, record.pull_number, record.installation_id)
+
+        # Unfinished suites come oldest first, so a newer commit of the same PR supersedes an older one.
+        if shared_queue:
+            shared_queue.submit("suite", {"event": event_to_dict(event), "check_run_id": record.check_run_id},
+                                key=pull_key(record.repository, record.pull_number))
+        else:
+            start_check_suite(event, check_run_id=record.check_run_id)
+
+
+def _run_shared_suite_job(payload) -> Optional[Future]:
+    check_suite = start_check_suite(suite_event_from_dict(payload["event"]), payload.get("force_rerun", False),
+                                    payload.get("check_run_id"))
+    return check_suite.done if check_suite else None
+
+
+def _run_shared_override_job(payload) -> Future:
+    done = Future()
+
+    def neutralize(event: CommentEvent) -> None:
+        try:
+            neutralize_latest_check_suite(event)
+            done.set_result(None)
+        except Exception as exc:
+            done.set_exception(exc)
+            raise
+
+    get_job_queue().submit(neutralize, comment_event_from_dict(payload["event"]), name="override")
+    return done
 
 
-def check_suite_override_handler(webhook):
-    """Override the check runs so that the PR can be merged."""
-    neutralize_latest_check_suite(webhook)
+# What `worker.py` processes do with the jobs of the shared queue; a job is acked once the future they return is done.
+SHARED_JOB_HANDLERS = {
+    "suite": _run_shared_suite_job,
+    "override": _run_shared_override_job,
+}
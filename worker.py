@@ -0,0 +1,72 @@
+"""
+ESP WORKERS
+============
+Multi-process mode. The Flask app(s) only queue the webhooks they accept in the
+SHARED_QUEUE_DB SQLite file; the processes started here run them, each with its
+own job queue, check executor and GitHub connection pool.
+
+    SHARED_QUEUE_DB=private/esp-jobs.db python worker.py --processes 4
+    SHARED_QUEUE_DB=private/esp-jobs.db flask run
+
+The app and the workers must share the same SHARED_QUEUE_DB (and SUITE_STATE_DB)
+files, so they have to run on the same host. Unfinished suites are resumed by
+this script rather than by the app.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+from bot_config import SHARED_QUEUE_DB
+
+log = logging.getLogger(__name__)
+
+
+def run_worker() -> None:
+    """Consume the shared queue until SIGTERM/SIGINT."""
+    from shared_queue import get_shared_queue, pull_key
+    from suite_registry import suite_registry
+    from webhook_handlers import SHARED_JOB_HANDLERS
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    get_shared_queue().consume(SHARED_JOB_HANDLERS,
+                               owned_keys=lambda: [pull_key(*key) for key in suite_registry.keys()],
+                               stop=stop)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if not SHARED_QUEUE_DB:
+        parser.error("SHARED_QUEUE_DB must be set.")
+
+    # Queue the suites a previous run left unfinished, once, before the workers start taking jobs.
+    from webhook_handlers import resume_unfinished_suites
+    resume_unfinished_suites()
+
+    # Workers are spawned, not forked, so none of them inherits this process' threads or SQLite connections.
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, name=f"esp-worker-{i}") for i in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    log.info(f"Started {len(workers)} worker processes.")
+
+    def stop(*_):
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()